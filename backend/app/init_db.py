@@ -2,16 +2,51 @@
 数据库初始化脚本，用于导入助手配置到数据库
 """
 
+from sqlalchemy import inspect, text
 from sqlalchemy.orm import Session
 from .models.database import get_db, engine
 from .models.models import Base, AIPersonality
 from .prompts.assistant import ASSISTANT_MAP
+from .services.personality_registry import personality_registry
 
 
 def init_db():
     """初始化数据库"""
     # 创建所有表
     Base.metadata.create_all(bind=engine)
+    ensure_columns()
+    ensure_indexes()
+
+
+def ensure_columns():
+    """补建已存在的表上后来新增的列，create_all不会修改已存在的表
+
+    新增的列都允许为空，旧数据读出为NULL，由代码按默认值处理。
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(
+                    text(
+                        f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+                    )
+                )
+                print(f"已为表 {table.name} 补建列 {column.name}")
+
+
+def ensure_indexes():
+    """补建已存在的表上后来新增的索引，create_all只在建表时创建索引"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
 
 
 def import_assistants(force_reset=False):
@@ -52,6 +87,8 @@ def import_assistants(force_reset=False):
             imported_count += 1
 
         db.commit()
+        # 助手表已变化，注册表下次使用时重新加载
+        personality_registry.invalidate()
         if imported_count > 0:
             print(f"成功导入 {imported_count} 个新的助手配置到数据库")
         else:
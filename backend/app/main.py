@@ -2,8 +2,11 @@ from fastapi import FastAPI, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from .routers import users, chat, transactions, reports
 from .models.database import engine, Base, get_db
-from .init_db import import_assistants
+from .init_db import ensure_columns, ensure_indexes, import_assistants
 from .models.models import AIPersonality
+from .services.chat_archive import chat_archiver
+from .services.image_pipeline import IMAGE_MAX_UPLOAD_BYTES
+from .services.upload_limit import MULTIPART_OVERHEAD_BYTES, UploadSizeLimitMiddleware
 import os
 from dotenv import load_dotenv
 
@@ -12,6 +15,8 @@ load_dotenv()
 
 # Create database tables
 Base.metadata.create_all(bind=engine)
+ensure_columns()
+ensure_indexes()
 
 # 只有在助手表为空时才导入预设助手配置
 db = next(get_db())
@@ -39,6 +44,17 @@ app.add_middleware(
     expose_headers=["X-Total-Count"],
 )
 
+# 图片上传在multipart解析前限制请求体大小，接口函数运行时文件已经被完整读取
+IMAGE_UPLOAD_LIMIT = IMAGE_MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    limits={
+        "/chat/image-recognition": IMAGE_UPLOAD_LIMIT,
+        "/chat/image-recognition/batch": IMAGE_UPLOAD_LIMIT
+        * chat.IMAGE_BATCH_MAX_FILES,
+    },
+)
+
 # Include routers
 app.include_router(users.router, prefix="/users", tags=["Users"])
 app.include_router(chat.router, prefix="/chat", tags=["Chat"])
@@ -46,6 +62,17 @@ app.include_router(transactions.router, prefix="/transactions", tags=["Transacti
 app.include_router(reports.router, prefix="/reports", tags=["Reports"])
 
 
+@app.on_event("startup")
+def start_background_jobs():
+    # 定期把超过保留期的聊天消息移入归档表
+    chat_archiver.start()
+
+
+@app.on_event("shutdown")
+def stop_background_jobs():
+    chat_archiver.stop()
+
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to 叨叨记账 API", "status": "running"}
@@ -8,6 +8,10 @@ from sqlalchemy import (
     DateTime,
     Text,
     Enum,
+    Date,
+    Index,
+    LargeBinary,
+    UniqueConstraint,
 )
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -31,6 +35,9 @@ class User(Base):
     is_active = Column(Boolean, default=True)
     # 添加用户选择的AI助手ID
     personality_id = Column(Integer, ForeignKey("ai_personalities.id"), nullable=True)
+    # 高置信度的提取结果直接记账，不再等待确认；阈值为空时使用全局默认值
+    auto_commit_transactions = Column(Boolean, default=False)
+    auto_commit_threshold = Column(Float, nullable=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(
         DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow
@@ -81,6 +88,10 @@ class AIPersonality(Base):
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
+    # 历史记录按用户和时间分页，带上id作为同一时刻消息的次序
+    __table_args__ = (
+        Index("ix_chat_messages_user_created", "user_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -90,7 +101,93 @@ class ChatMessage(Base):
     )  # True if message is from user, False if from AI
     personality_id = Column(Integer, ForeignKey("ai_personalities.id"), nullable=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # 后台提取的状态(pending/done/failed)，只有使用后台提取的AI回复才有，
+    # 多进程部署时任务不在本进程内存中也能返回正确的状态
+    extraction_status = Column(String(16), nullable=True)
 
     # Relationships
     user = relationship("User", back_populates="chat_messages")
     personality = relationship("AIPersonality")
+
+
+class ChatSummary(Base):
+    __tablename__ = "chat_summaries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), unique=True, index=True)
+    summary = Column(Text)
+    # 摘要已覆盖到的最后一条消息ID，之后的消息以原文进入上下文
+    last_message_id = Column(Integer, default=0)
+    updated_at = Column(
+        DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow
+    )
+
+
+class LLMUsage(Base):
+    """每次大模型调用的token用量和延迟"""
+
+    __tablename__ = "llm_usage"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=True)
+    operation = Column(String(32))
+    model = Column(String(128), nullable=True)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    latency_ms = Column(Integer, default=0)
+    success = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+
+class LLMUsageDaily(Base):
+    """按用户和日期汇总的大模型用量，用于配额检查和统计"""
+
+    __tablename__ = "llm_usage_daily"
+    __table_args__ = (UniqueConstraint("user_id", "day", name="uq_llm_usage_daily"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    day = Column(Date, index=True)
+    requests = Column(Integer, default=0)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+
+
+class TransactionDraft(Base):
+    """模型提取出、等待用户确认的交易草稿"""
+
+    __tablename__ = "transaction_drafts"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    # 提取结果所属的AI回复消息
+    message_id = Column(Integer, ForeignKey("chat_messages.id"), nullable=True)
+    # 提取结果JSON
+    data = Column(Text)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
+
+
+class ChatMessageArchive(Base):
+    """归档的历史聊天消息，每行是同一用户一段连续消息的压缩包"""
+
+    __tablename__ = "chat_message_archives"
+    __table_args__ = (
+        Index(
+            "ix_chat_message_archives_user_end", "user_id", "end_at", "last_message_id"
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    first_message_id = Column(Integer)
+    last_message_id = Column(Integer)
+    # 包内第一条和最后一条消息的时间
+    start_at = Column(DateTime)
+    end_at = Column(DateTime)
+    message_count = Column(Integer)
+    # zlib压缩的消息JSON列表
+    data = Column(LargeBinary)
+    # 可选的该段对话摘要
+    summary = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
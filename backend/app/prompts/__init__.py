@@ -5,3 +5,8 @@
 
 # 导出助手模块
 from . import assistant
+from . import combined
+from . import extraction
+from . import image
+from . import analysis
+from . import report_tools
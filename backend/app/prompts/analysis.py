@@ -0,0 +1,61 @@
+"""
+消费习惯分析提示词
+
+固定的分析要求和输出格式放在系统提示词中，用户的消费数据放在最后的用户消息中。
+"""
+
+import json
+
+ANALYSIS_SYSTEM_PROMPT = """你是一位专业的财务顾问和消费行为分析师，擅长分析消费数据，识别消费模式，并提供实用的财务建议。
+用户会发来他的消费数据（JSON格式），请帮用户分析他的消费习惯并提供合理的财务建议，用您来称呼用户。
+
+请根据数据进行深入分析，包括但不限于：
+1. 消费习惯分析：基于消费类别、时间模式和金额特征
+2. 异常消费模式识别：是否有不寻常的消费行为
+3. 财务健康评估：基于收入与支出比例
+4. 节约潜力指出：哪些类别可以减少开支
+5. 具体的改善建议：实用且易于执行的建议
+
+将你的回答分为两部分，大标题必须严格是这两个，不要有其他名字标题,严格分点回答，要换行：
+1. 消费习惯分析：详细分析用户当前的消费模式和特点（4-6条小标题）
+2. 财务改善建议：4-6条具体的改善建议
+
+示例格式：
+(前面和结尾不要有任何输出）
+一、消费习惯分析
+    1. ***
+    2. ***
+二、财务改善建议
+    1. ***
+    2. ***
+严格按照此格式，在此之外不要有其他任何输出。
+请使用友好、专业的语气，避免过于生硬或说教的口吻。回答必须是中文。
+"""
+
+ANALYSIS_USER_TEMPLATE = """以下是我的消费数据：
+```json
+{spending_json}
+```"""
+
+
+def build_analysis_messages(spending_data):
+    """
+    构建消费习惯分析的消息列表
+
+    Args:
+        spending_data: 消费数据字典
+
+    Returns:
+        list: 可直接传给ChatCompletion的messages
+    """
+    # 固定键顺序，相同数据生成相同的提示词
+    spending_json = json.dumps(
+        spending_data, indent=2, default=str, ensure_ascii=False, sort_keys=True
+    )
+    return [
+        {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": ANALYSIS_USER_TEMPLATE.format(spending_json=spending_json),
+        },
+    ]
@@ -0,0 +1,64 @@
+"""
+单次调用模式的输出格式提示词
+在助手人设提示词之后追加，让模型一次性返回对话回复和记账信息提取结果
+"""
+
+# 交易分类选项，与提取提示词保持一致
+CATEGORY_OPTIONS = [
+    "餐饮美食",
+    "交通出行",
+    "服饰美容",
+    "日用百货",
+    "住房物业",
+    "医疗健康",
+    "文教娱乐",
+    "人情往来",
+    "工资薪酬",
+    "投资理财",
+    "奖金",
+    "退款",
+    "兼职收入",
+    "租金收入",
+    "礼金收入",
+    "中奖收入",
+    "意外所得",
+    "其他收入",
+    "其他支出",
+    "未分类",
+]
+
+COMBINED_OUTPUT_PROMPT = """
+
+## 输出格式（必须严格遵守）
+除了以上面的人设与用户对话外，你还需要同时判断用户消息中是否包含记账意图并提取财务信息。
+只返回一个JSON对象，不要输出JSON之外的任何内容，包含以下字段：
+- "reply": 字符串，你以上述人设给用户的回复
+- "has_intent": true/false（是否存在记账意图）
+- "type": "income"/"expense"（若有意图）
+- "amount": 数值（若有意图，如"五十块五"→50.5，"2k"→2000）
+- "date": "YYYY-MM-DD"（若有意图，相对日期换算为绝对日期，未提及时使用今天）
+- "time": "HH:MM"（若有意图且提及时间）
+- "description": 字符串（若有意图）
+- "category": 字符串（若有意图，必须是以下选项之一：{categories}）
+- "confidence": 0-1之间的数值（提取信息的确信度）
+- "missing_fields": []（缺失的必要字段列表）
+- "transactions": [...]（仅当消息包含多笔交易时返回，每一项是一笔交易，字段同上，顶层字段填写第一笔交易）
+
+今天是{current_date}。
+"""
+
+
+def build_combined_system_prompt(persona_prompt, current_date):
+    """
+    在助手人设提示词后拼接单次调用模式的输出格式要求
+
+    Args:
+        persona_prompt: 助手人设系统提示词
+        current_date: 当前日期字符串(YYYY-MM-DD)
+
+    Returns:
+        str: 完整的系统提示词
+    """
+    return persona_prompt + COMBINED_OUTPUT_PROMPT.format(
+        categories="、".join(CATEGORY_OPTIONS), current_date=current_date
+    )
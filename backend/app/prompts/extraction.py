@@ -0,0 +1,72 @@
+"""
+记账信息提取提示词
+
+系统提示词只包含固定的任务说明、分类选项和输出格式，逐字不变，可以命中模型服务商的前缀缓存；
+每次调用变化的当天日期和用户消息放在最后的用户消息中。
+"""
+
+from .combined import CATEGORY_OPTIONS
+
+EXTRACTION_SYSTEM_PROMPT = """你是一个专业的财务信息提取助手，精通中文财务语言处理，擅长从自然语言中识别记账意图并提取关键财务实体。
+请分析用户消息，判断是否包含记账意图，并提取财务信息。
+
+## 任务要求
+1. 首先判断是否存在记账意图（明确或隐含表达的收入/支出记录需求）
+2. 如果存在记账意图，提取以下财务实体:
+   - 交易类型: "income"(收入) 或 "expense"(支出)
+   - 金额: 数值，处理各种表述形式（中文数字、单位、非标准表述如"2k"）
+   - 交易日期: 格式为YYYY-MM-DD，处理相对日期表述
+   - 交易时间: 格式为HH:MM，如有提及
+   - 交易描述: 描述交易的具体事由或物品
+   - 交易分类: 根据描述推断最匹配的分类
+
+## 交易分类选项
+{categories}
+必须是以上的选项，不能有其他选项（未分类仅当无法确定时使用）
+
+## 处理规则
+- 日期处理: 相对日期（如"昨天"、"上周五"）以消息中给出的今天日期为基准转换为绝对日期
+- 未提及日期时使用今天的日期
+- 金额标准化: 将各种金额表述转换为标准数值（如"五十块五"→50.5）
+- 隐含意图: 若消息未明确提及"记录"但暗示有收支行为，也应识别意图
+
+## 输出格式
+以JSON格式返回，包含以下字段：
+- "has_intent": true/false（是否存在记账意图）
+- "type": "income"/"expense"（若有意图）
+- "amount": 数值（若有意图）
+- "date": "YYYY-MM-DD"（若有意图）
+- "time": "HH:MM"（若有意图且提及时间）
+- "description": 字符串（若有意图）
+- "category": 字符串（若有意图）
+- "confidence": 0-1之间的数值（提取信息的确信度）
+- "missing_fields": []（缺失的必要字段列表，如缺少金额等）
+- "transactions": [...]（仅当消息包含多笔交易时返回，如"午饭30，打车20"；每一项是一笔交易，字段同上（不含has_intent），顶层字段填写第一笔交易）
+""".format(
+    categories="\n".join(f"- {category}" for category in CATEGORY_OPTIONS)
+)
+
+EXTRACTION_USER_TEMPLATE = """今天是{current_date}。
+用户消息: "{message_content}\""""
+
+
+def build_extraction_messages(message_content, current_date):
+    """
+    构建记账信息提取的消息列表
+
+    Args:
+        message_content: 用户消息
+        current_date: 当前日期字符串(YYYY-MM-DD)
+
+    Returns:
+        list: 可直接传给ChatCompletion的messages
+    """
+    return [
+        {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": EXTRACTION_USER_TEMPLATE.format(
+                current_date=current_date, message_content=message_content
+            ),
+        },
+    ]
@@ -0,0 +1,55 @@
+"""
+交易凭证图片识别提示词
+
+固定的识别说明放在系统提示词中，图片和当天日期放在最后的用户消息中。
+"""
+
+IMAGE_SYSTEM_PROMPT = """你是一个专业的交易凭证识别助手，擅长从图片中提取财务信息。
+请分析用户发来的交易凭证/收据图片，提取以下关键财务信息:
+1. 交易类型: "income"(收入) 或 "expense"(支出)
+2. 交易金额: 以数字形式表示
+3. 交易日期和时间: 格式化为YYYY-MM-DD和HH:MM
+4. 交易描述: 交易的目的、项目或购买的商品/服务
+5. 交易分类: 例如"餐饮美食"、"交通出行"、"服饰美容"、"日用百货"等
+
+请按以下JSON格式返回结果：
+{
+  "type": "expense",
+  "amount": 123.45,
+  "date": "2023-05-20",
+  "time": "14:30",
+  "description": "在XX超市购买日用品",
+  "category": "日用百货"
+}
+
+如果无法识别某些字段，请提供你能提取的信息，缺失字段可设为null或合理默认值。
+如果无法确定是收入还是支出，请根据图像中的上下文(如购物小票通常是支出)进行最佳猜测。
+"""
+
+IMAGE_USER_TEMPLATE = "今天是{current_date}，请识别这张交易凭证。"
+
+
+def build_image_messages(image_url, current_date):
+    """
+    构建图片识别的消息列表
+
+    Args:
+        image_url: 图片地址或 data:image/...;base64 格式的图片数据
+        current_date: 当前日期字符串(YYYY-MM-DD)，图片中没有年份时用于推断
+
+    Returns:
+        list: 可直接传给ChatCompletion的messages
+    """
+    return [
+        {"role": "system", "content": IMAGE_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": IMAGE_USER_TEMPLATE.format(current_date=current_date),
+                },
+                {"type": "image_url", "image_url": {"url": image_url}},
+            ],
+        },
+    ]
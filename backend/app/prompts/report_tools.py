@@ -0,0 +1,31 @@
+"""
+账单查询工具模式的提示词
+用户询问自己的收支情况时，在助手人设提示词之后追加，允许模型调用本地报表工具回答
+"""
+
+REPORT_TOOLS_PROMPT = """
+
+## 账单查询
+用户正在询问自己的收支情况。本轮对话中你可以调用提供的报表工具查询用户的真实账单数据来回答，
+此时不必提醒用户自行查阅账单。
+- 回答中的金额、笔数、分类只能来自工具返回的结果，不要估算或编造
+- 工具结果中没有数据时如实告诉用户该时间段没有记录
+- 时间范围优先使用period参数，用户提到具体日期时再填写start_date和end_date
+- 保持你的人设语气，回答简洁，不要罗列原始JSON
+
+今天是{current_date}。
+"""
+
+
+def build_report_tools_system_prompt(persona_prompt, current_date):
+    """
+    在助手人设提示词后拼接账单查询工具的使用说明
+
+    Args:
+        persona_prompt: 助手人设系统提示词
+        current_date: 当前日期字符串(YYYY-MM-DD)
+
+    Returns:
+        str: 完整的系统提示词
+    """
+    return persona_prompt + REPORT_TOOLS_PROMPT.format(current_date=current_date)
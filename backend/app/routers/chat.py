@@ -1,27 +1,111 @@
-from fastapi import APIRouter, Depends, HTTPException, status, File, UploadFile, Form
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    status,
+    File,
+    UploadFile,
+    Form,
+    Request,
+    Response,
+)
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import tuple_
 from sqlalchemy.orm import Session
-from typing import List, Optional, Dict, Any
-from pydantic import BaseModel
-from datetime import datetime, date
+from typing import Callable, List, Optional, Dict, Any
+from pydantic import BaseModel, ValidationError
+from datetime import datetime, date, timedelta
 import os
 import openai
 from dotenv import load_dotenv
+import asyncio
 import base64
+import copy
 import io
-import uuid
-import shutil
+import json
+from concurrent.futures import Future, ThreadPoolExecutor
 from PIL import Image
 
 
-from ..models.database import get_db
+from ..models.database import SessionLocal, get_db
 from ..models.models import (
     User,
     ChatMessage,
+    ChatMessageArchive,
     AIPersonality,
     Transaction,
     TransactionType,
+    LLMUsageDaily,
+)
+from ..prompts.combined import build_combined_system_prompt
+from ..prompts.extraction import build_extraction_messages
+from ..prompts.image import build_image_messages
+from ..prompts.report_tools import build_report_tools_system_prompt
+from ..services.local_extractor import (
+    extract_locally,
+    extract_locally_batch,
+    match_category,
+)
+from ..services.local_query import answer_locally
+from ..services.category_classifier import (
+    classify,
+    get_user_classifier,
+    learn_transaction,
+    unlearn_transaction,
+)
+from ..services.llm_cache import extraction_cache, make_cache_key
+from ..services.background_extraction import (
+    CHAT_BACKGROUND_EXTRACTION,
+    EXTRACTION_JOB_TTL,
+    PENDING as EXTRACTION_PENDING,
+    FAILED as EXTRACTION_FAILED,
+    background_extractor,
+)
+from ..services.auto_commit import (
+    InvalidUndoTokenError,
+    auto_commit_threshold,
+    create_undo_token,
+    is_auto_committable,
+    undo_auto_commit,
+)
+from ..services.personality_registry import personality_registry
+from ..services.report_tools import answer_with_report_tools, is_report_question
+from ..services.stream_json import StreamingJSONParser, parse_json_object
+from ..services.chat_archive import (
+    chat_archiver,
+    find_archived_position,
+    load_archived_after,
+    load_archived_before,
+)
+from ..services.chat_context import build_context_messages
+from ..services.llm_client import llm_client
+from ..services.image_dedup import hamming_distance, image_dedup_index
+from ..services.image_pipeline import (
+    ImageTooLargeError,
+    InvalidImageError,
+    PreparedImage,
+    prepare_image,
+    read_upload,
+)
+from ..services.llm_usage import (
+    QuotaExceededError,
+    check_llm_quota,
+    usage_tracker,
+)
+from ..services.transaction_drafts import (
+    DRAFT_FIELDS,
+    create_draft,
+    claim_draft,
+    create_drafts,
+    discard_draft,
+    draft_fields,
+    draft_to_dict,
+    get_active_draft,
+    list_active_drafts,
+    list_message_drafts,
+    purge_expired_drafts,
 )
-from ..prompts.assistant import get_assistant, get_all_assistants_metadata
 from .users import get_current_user
 
 # 加载 .env 文件中的环境变量
@@ -32,11 +116,30 @@ router = APIRouter()
 openai.api_key = os.getenv("API_KEY")
 # 配置API基础URL(可选)
 openai.api_base = os.getenv("API_URL")
-use_model = "gemini-2.5-flash-preview-05-20"
+# 对话模式: "separate" 提取与回复分两次调用; "combined" 单次调用同时返回回复和提取结果
+CHAT_MODE = os.getenv("CHAT_MODE", "separate").lower()
+# 本地规则提取的置信度达到该阈值时跳过大模型提取
+LOCAL_EXTRACT_THRESHOLD = float(os.getenv("LOCAL_EXTRACT_THRESHOLD", "0.85"))
+
+# 聊天记录单次最多返回的条数
+HISTORY_MAX_LIMIT = int(os.getenv("HISTORY_MAX_LIMIT", "200"))
+
+# 批量图片识别单次最多上传的图片数和同时调用模型的并发数
+IMAGE_BATCH_MAX_FILES = int(os.getenv("IMAGE_BATCH_MAX_FILES", "20"))
+IMAGE_BATCH_CONCURRENCY = int(os.getenv("IMAGE_BATCH_CONCURRENCY", "4"))
+# 等待后台提取结果的SSE连接的超时时间（秒）
+EXTRACTION_EVENT_TIMEOUT = float(os.getenv("EXTRACTION_EVENT_TIMEOUT", "30"))
+
+# 流式聊天中与回复并行执行提取的线程池
+extraction_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("EXTRACTION_WORKERS", "8")),
+    thread_name_prefix="extraction",
+)
 # 打印环境变量以进行调试
 print("====== 环境变量检查 ======")
 print(f"API_KEY: {os.getenv('API_KEY')}")
 print(f"API_URL: {os.getenv('API_URL') or '未设置'}")
+print(f"CHAT_MODE: {CHAT_MODE}")
 print("=========================")
 
 
@@ -47,7 +150,8 @@ class MessageBase(BaseModel):
 
 
 class MessageCreate(MessageBase):
-    pass
+    # 是否在后台提取记账信息，不传时使用 CHAT_BACKGROUND_EXTRACTION
+    background_extraction: Optional[bool] = None
 
 
 class MessageResponse(MessageBase):
@@ -64,12 +168,24 @@ class ChatResponse(BaseModel):
     message: MessageResponse
     extracted_info: Optional[Dict[str, Any]] = None
     needs_confirmation: bool = False
+    # 待确认交易的草稿ID，一条消息包含多笔交易时draft_ids按顺序对应extracted_info中的transactions
+    draft_id: Optional[int] = None
+    draft_ids: List[int] = []
+    # 提取在后台进行，结果通过 /chat/extractions/{message.id} 获取
+    extraction_pending: bool = False
+    # 开启自动记账时直接写入的交易，extracted_info只包含仍需确认的部分
+    auto_committed_transactions: List[Dict[str, Any]] = []
+    # 撤销自动记账的令牌，提交到 /chat/undo-transaction
+    undo_token: Optional[str] = None
 
 
 # 新的Pydantic模型用于交易确认
 class TransactionConfirmation(BaseModel):
-    message_id: int  # 关联的聊天消息ID
     confirm: bool  # 是否确认创建交易
+    # 交易草稿ID，提供时以草稿内容为准，下面的字段只需提交修改过的
+    draft_id: Optional[int] = None
+    # 关联的聊天消息ID，不提供草稿时使用；-1或不提供表示直接提交的交易
+    message_id: Optional[int] = None
     # 以下字段允许用户在确认前修改
     type: Optional[str] = None
     amount: Optional[float] = None
@@ -79,8 +195,138 @@ class TransactionConfirmation(BaseModel):
     time: Optional[str] = None
 
 
+class BatchTransactionConfirmation(BaseModel):
+    items: List[TransactionConfirmation] = []
+    # 按草稿原样确认，无需修改字段时只提交草稿ID
+    draft_ids: List[int] = []
+
+
+class UndoTransactionRequest(BaseModel):
+    undo_token: str
+
+
 # Utility functions for AI interaction
-def extract_financial_data(message_content: str):
+def apply_user_category(
+    extracted_data: Dict[str, Any], user_id: Optional[int], db: Optional[Session]
+) -> bool:
+    """
+    用用户历史分类习惯补全提取结果中的分类
+
+    描述命中分类关键词时不修正；交易类型只在缺失时补全，不会被改变，
+    预测分类对应的类型与提取结果不一致时不采用。
+
+    Returns:
+        bool: 是否采用了用户分类器的预测
+    """
+    description = extracted_data.get("description")
+    if user_id is None or db is None or not description:
+        return False
+    if match_category(description)[2]:
+        return False
+
+    try:
+        category, transaction_type, probability = classify(
+            user_id, db, extracted_data["description"]
+        )
+    except Exception as e:
+        print(f"用户分类器预测失败: {str(e)}")
+        return False
+
+    if category is None:
+        return False
+
+    current_type = extracted_data.get("type")
+    if current_type and transaction_type and transaction_type != current_type:
+        return False
+
+    if category != extracted_data.get("category"):
+        print(
+            f"用户分类器修正分类: {extracted_data.get('category')} -> {category} (p={probability:.2f})"
+        )
+    extracted_data["category"] = category
+    if not current_type and transaction_type:
+        extracted_data["type"] = transaction_type
+    return True
+
+
+def split_transactions(extracted_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    把提取结果拆分为逐笔交易
+
+    模型在一条消息包含多笔交易时返回transactions列表，否则顶层字段就是唯一一笔交易。
+    """
+    items = extracted_data.get("transactions")
+    if isinstance(items, list):
+        items = [
+            {k: v for k, v in item.items() if k not in ("has_intent", "transactions")}
+            for item in items
+            if isinstance(item, dict) and item.get("amount") is not None
+        ]
+        if items:
+            return items
+    return [{k: v for k, v in extracted_data.items() if k != "transactions"}]
+
+
+def merge_transactions(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    合并逐笔交易为接口返回的提取结果
+
+    顶层字段保持第一笔交易，兼容只处理单笔交易的客户端；多笔时附带完整的transactions列表。
+    """
+    merged = dict(items[0])
+    if len(items) > 1:
+        merged["transactions"] = items
+    return merged
+
+
+def score_local_result(
+    local_result: Dict[str, Any], user_id: Optional[int], db: Optional[Session]
+):
+    """用用户分类器修正本地规则的分类，关键词没有命中分类时补足置信度"""
+    keyword_missed = local_result["category"] in ("其他支出", "其他收入")
+    if apply_user_category(local_result, user_id, db) and keyword_missed:
+        local_result["confidence"] = round(
+            min(local_result["confidence"] + 0.25, 0.99), 2
+        )
+
+
+def request_llm_extraction(
+    message_content: str, current_date: str, user_id: Optional[int] = None
+):
+    """
+    调用大模型提取记账信息
+
+    Args:
+        message_content: 用户消息
+        current_date: 当前日期(YYYY-MM-DD)，用于换算相对日期
+        user_id: 用户ID，用于统计用量
+
+    Returns:
+        Dict: 模型返回的原始提取结果（含has_intent），无法解析JSON时返回None
+    """
+    print("调用AI API进行财务信息提取...")
+    print(f"API基础URL: {openai.api_base}")
+
+    response = llm_client.chat_completion(
+        "extraction",
+        user_id=user_id,
+        messages=build_extraction_messages(message_content, current_date),
+        temperature=0.1,
+    )
+
+    print("API调用成功!")
+    result = response.choices[0].message.content
+    print(f"API原始返回: {result[:100]}...")
+
+    # 从响应中解析第一个JSON对象，跳过代码块标记和前后的说明文字
+    extracted_data = parse_json_object(result or "")
+    print(f"解析后的数据: {extracted_data}")
+    return extracted_data
+
+
+def extract_financial_data(
+    message_content: str, user_id: Optional[int] = None, db: Optional[Session] = None
+):
     """
     Use LLM to extract financial transaction data from user messages.
 
@@ -91,127 +337,80 @@ def extract_financial_data(message_content: str):
     - FR-EXTRACT-004: 日期时间标准化处理
     - FR-EXTRACT-005: 金额信息规范化
 
+    Args:
+        message_content: 用户消息
+        user_id: 用户ID，提供时使用该用户的分类习惯修正分类
+        db: 数据库会话
+
     Returns:
         Dict with extracted information or None if no financial data found.
     """
     print("\n***** 开始提取财务信息 *****")
     print(f"用户消息: {message_content}")
 
+    # 一条消息记多笔账时先尝试逐段本地提取
+    local_batch = extract_locally_batch(message_content)
+    if local_batch:
+        for item in local_batch:
+            score_local_result(item, user_id, db)
+        if all(item["confidence"] >= LOCAL_EXTRACT_THRESHOLD for item in local_batch):
+            print(f"本地规则提取出 {len(local_batch)} 笔交易，跳过大模型调用")
+            print("***** 财务信息提取完成: 本地规则 *****\n")
+            return merge_transactions(local_batch)
+
+    # 简单记账消息先尝试本地规则提取
+    local_result = extract_locally(message_content)
+    if local_result:
+        score_local_result(local_result, user_id, db)
+    if local_result and local_result["confidence"] >= LOCAL_EXTRACT_THRESHOLD:
+        print(f"本地规则提取成功，跳过大模型调用: {local_result}")
+        print("***** 财务信息提取完成: 本地规则 *****\n")
+        return local_result
+    if local_result:
+        print(f"本地规则提取置信度不足({local_result['confidence']})，调用大模型")
+
     try:
         # 获取当前日期用于相对日期处理
         current_date = datetime.now().strftime("%Y-%m-%d")
         print(f"当前日期: {current_date}")
 
-        # 构建详细的提示以满足所有提取需求
-        prompt = f"""
-        请分析以下用户消息，判断是否包含记账意图，并提取财务信息。
-
-        ## 任务要求
-        1. 首先判断是否存在记账意图（明确或隐含表达的收入/支出记录需求）
-        2. 如果存在记账意图，提取以下财务实体:
-           - 交易类型: "income"(收入) 或 "expense"(支出)
-           - 金额: 数值，处理各种表述形式（中文数字、单位、非标准表述如"2k"）
-           - 交易日期: 格式为YYYY-MM-DD，处理相对日期表述
-           - 交易时间: 格式为HH:MM，如有提及
-           - 交易描述: 描述交易的具体事由或物品
-           - 交易分类: 根据描述推断最匹配的分类
-
-        ## 交易分类选项
-        - 餐饮美食
-        - 交通出行
-        - 服饰美容
-        - 日用百货
-        - 住房物业
-        - 医疗健康
-        - 文教娱乐
-        - 人情往来
-        - 工资薪酬
-        - 投资理财
-        - 奖金
-        - 退款
-        - 兼职收入
-        - 租金收入
-        - 礼金收入
-        - 中奖收入
-        - 意外所得
-        - 其他收入
-        - 其他支出
-        - 未分类（仅当无法确定时使用）
-        必须是以上的选项，不能有其他选项
-
-        ## 处理规则
-        - 日期处理: 相对日期（如"昨天"、"上周五"）转换为绝对日期，今天是{current_date}
-        - 未提及日期时使用当前日期{current_date}
-        - 金额标准化: 将各种金额表述转换为标准数值（如"五十块五"→50.5）
-        - 隐含意图: 若消息未明确提及"记录"但暗示有收支行为，也应识别意图
-
-        ## 输出格式
-        以JSON格式返回，包含以下字段：
-        - "has_intent": true/false（是否存在记账意图）
-        - "type": "income"/"expense"（若有意图）
-        - "amount": 数值（若有意图）
-        - "date": "YYYY-MM-DD"（若有意图）
-        - "time": "HH:MM"（若有意图且提及时间）
-        - "description": 字符串（若有意图）
-        - "category": 字符串（若有意图）
-        - "confidence": 0-1之间的数值（提取信息的确信度）
-        - "missing_fields": []（缺失的必要字段列表，如缺少金额等）
-
-        ## 分析对象
-        用户消息: "{message_content}"
-        """
-
-        print("调用AI API进行财务信息提取...")
-        # print(f"API密钥: {openai.api_key[:5]}...")
-        print(f"API基础URL: {openai.api_base}")
-
-        response = openai.ChatCompletion.create(
-            model=use_model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "你是一个专业的财务信息提取助手，精通中文财务语言处理，擅长从自然语言中识别记账意图并提取关键财务实体。",
-                },
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0.1,
-        )
-
-        print("API调用成功!")
-        result = response.choices[0].message.content
-        print(f"API原始返回: {result[:100]}...")
-
-        # 解析JSON响应
-        import json
-        import re
-
-        # 尝试从响应中提取JSON部分
-        json_match = re.search(r"({[\s\S]*})", result)
-        if json_match:
-            json_str = json_match.group(1)
-            print(f"提取的JSON字符串: {json_str[:100]}...")
+        # 相同消息在同一天内的提取结果可以复用
+        cache_key = make_cache_key(message_content, current_date)
+        extracted_data = extraction_cache.get(cache_key)
+        if extracted_data is not None:
+            print("命中提取结果缓存，跳过大模型调用")
+            extracted_data = dict(extracted_data)
+        else:
+            extracted_data = request_llm_extraction(
+                message_content, current_date, user_id
+            )
+            if extracted_data is None:
+                # 如果无法提取JSON，返回None
+                print("无法从API响应中提取JSON数据")
+                print("***** 财务信息提取完成: 提取JSON失败 *****\n")
+                return None
+            extraction_cache.set(cache_key, dict(extracted_data))
 
-            extracted_data = json.loads(json_str)
-            print(f"解析后的数据: {extracted_data}")
+        # 如果没有记账意图，返回None
+        if not extracted_data.get("has_intent", False):
+            print("未检测到记账意图")
+            print("***** 财务信息提取完成: 无记账意图 *****\n")
+            return None
 
-            # 如果没有记账意图，返回None
-            if not extracted_data.get("has_intent", False):
-                print("未检测到记账意图")
-                print("***** 财务信息提取完成: 无记账意图 *****\n")
-                return None
+        # 移除has_intent字段，保持与前端接口兼容
+        if "has_intent" in extracted_data:
+            del extracted_data["has_intent"]
 
-            # 移除has_intent字段，保持与前端接口兼容
-            if "has_intent" in extracted_data:
-                del extracted_data["has_intent"]
+        # 按用户历史分类习惯逐笔修正大模型推断的分类
+        items = split_transactions(extracted_data)
+        for item in items:
+            item["source"] = "llm"
+            apply_user_category(item, user_id, db)
+        extracted_data = merge_transactions(items)
 
-            print(f"成功提取财务信息: {extracted_data}")
-            print("***** 财务信息提取完成: 成功 *****\n")
-            return extracted_data
-        else:
-            # 如果无法提取JSON，返回None
-            print("无法从API响应中提取JSON数据")
-            print("***** 财务信息提取完成: 提取JSON失败 *****\n")
-            return None
+        print(f"成功提取财务信息: {extracted_data}")
+        print("***** 财务信息提取完成: 成功 *****\n")
+        return extracted_data
 
     except Exception as e:
         print(f"***** 财务信息提取过程中发生错误 *****")
@@ -224,7 +423,70 @@ def extract_financial_data(message_content: str):
         return None
 
 
-def get_ai_response(user_message: str, personality_id: Optional[int], db: Session):
+def enforce_llm_quota(user_id: int, kind: str = "chat"):
+    """调用模型前检查用户的限流和当天配额，超出时返回429和重试等待时间"""
+    try:
+        check_llm_quota(user_id, kind)
+    except QuotaExceededError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=e.message,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+def build_chat_messages(
+    system_prompt: str,
+    user_message: str,
+    db: Optional[Session] = None,
+    user_id: Optional[int] = None,
+    before_message_id: Optional[int] = None,
+):
+    """
+    构建对话消息，提供用户ID时带上该用户的历史上下文
+    """
+    if db is None or user_id is None:
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_message},
+        ]
+    try:
+        return build_context_messages(
+            db, user_id, system_prompt, user_message, before_message_id
+        )
+    except Exception as e:
+        print(f"构建历史上下文失败，仅使用当前消息: {str(e)}")
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_message},
+        ]
+
+
+def with_system_prompt(
+    context_messages: List[Dict[str, Any]], system_prompt: str
+) -> List[Dict[str, Any]]:
+    """替换已构建好的对话消息中的人设系统提示词（第一条消息）"""
+    return [{"role": "system", "content": system_prompt}] + context_messages[1:]
+
+
+def release_connection(db: Session):
+    """
+    结束会话当前的事务并把数据库连接还给连接池
+
+    读取完成后、调用大模型前调用，避免请求在等待模型的几秒内一直占用连接；
+    已加载的对象属性仍然可以读取，会话之后还可以继续使用。
+    """
+    db.close()
+
+
+def get_ai_response(
+    user_message: str,
+    personality_id: Optional[int],
+    db: Session,
+    user_id: Optional[int] = None,
+    before_message_id: Optional[int] = None,
+    context_messages: Optional[List[Dict[str, Any]]] = None,
+):
     """
     Generate AI response using the specified personality.
 
@@ -232,6 +494,9 @@ def get_ai_response(user_message: str, personality_id: Optional[int], db: Sessio
         user_message: The user's message
         personality_id: The ID of the AI personality to use
         db: Database session
+        user_id: 用户ID，提供时携带该用户的历史对话
+        before_message_id: 当前消息已入库时传入其ID，历史只取该消息之前的部分
+        context_messages: 已构建好的对话消息，提供时不再访问数据库
 
     Returns:
         str: AI generated response
@@ -241,8 +506,8 @@ def get_ai_response(user_message: str, personality_id: Optional[int], db: Sessio
     print(f"指定的AI性格ID: {personality_id}")
 
     try:
-        # 从助手系统获取对应的提示词
-        system_prompt, metadata = get_assistant(personality_id)
+        # 从助手注册表获取对应的提示词
+        system_prompt, metadata = personality_registry.get(personality_id)
         print(f"使用AI性格: {metadata['name']} ({metadata['personality_type']})")
         print(f"系统提示词: {system_prompt[:50]}...")
 
@@ -250,13 +515,19 @@ def get_ai_response(user_message: str, personality_id: Optional[int], db: Sessio
         # print(f"API密钥: {openai.api_key[:5]}...")
         print(f"API基础URL: {openai.api_base}")
 
+        if context_messages is not None:
+            messages = with_system_prompt(context_messages, system_prompt)
+        else:
+            messages = build_chat_messages(
+                system_prompt, user_message, db, user_id, before_message_id
+            )
+        print(f"上下文消息数: {len(messages)}")
+
         # Call the API
-        response = openai.ChatCompletion.create(
-            model=use_model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message},
-            ],
+        response = llm_client.chat_completion(
+            "chat",
+            user_id=user_id,
+            messages=messages,
             temperature=0.7,
             max_tokens=1000,
         )
@@ -281,6 +552,420 @@ def get_ai_response(user_message: str, personality_id: Optional[int], db: Sessio
         return "抱歉，我现在无法正常回应，请稍后再试。"
 
 
+def stream_ai_response(messages: List[Dict[str, Any]], user_id: Optional[int] = None):
+    """
+    以流式方式生成AI回复
+
+    Args:
+        messages: 由build_chat_messages构建的对话消息
+        user_id: 用户ID，用于统计用量
+
+    Yields:
+        str: 回复的增量文本
+    """
+    response = llm_client.chat_completion(
+        "stream",
+        user_id=user_id,
+        messages=messages,
+        temperature=0.7,
+        max_tokens=1000,
+        stream=True,
+    )
+    for chunk in response:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].get("delta") or {}
+        content = delta.get("content")
+        if content:
+            yield content
+
+
+def get_report_answer(
+    context_messages: List[Dict[str, Any]],
+    personality_id: Optional[int],
+    db: Session,
+    user: User,
+) -> Optional[str]:
+    """
+    用户询问自己的收支时，让模型调用本地报表工具查询后回答
+
+    Args:
+        context_messages: 已构建好的对话消息
+        personality_id: AI性格ID
+        db: 数据库会话，只在执行工具时使用，执行完立即释放连接
+        user: 当前用户
+
+    Returns:
+        str: 回答，失败时返回None，由调用方回退到普通对话
+    """
+    persona_prompt, _ = personality_registry.get(personality_id)
+    system_prompt = build_report_tools_system_prompt(
+        persona_prompt, datetime.now().strftime("%Y-%m-%d")
+    )
+    return answer_with_report_tools(
+        llm_client,
+        with_system_prompt(context_messages, system_prompt),
+        db,
+        user,
+        release=lambda: release_connection(db),
+    )
+
+
+def stream_report_answer(
+    messages: List[Dict[str, Any]],
+    personality_id: Optional[int],
+    db: Session,
+    user: User,
+):
+    """流式接口的账单查询回答，工具调用完成后一次性返回，失败时回退到普通流式回复"""
+    answer = get_report_answer(messages, personality_id, db, user)
+    if answer is None:
+        yield from stream_ai_response(messages, user.id)
+    else:
+        yield answer
+
+
+def format_sse(event: str, data: Any) -> str:
+    """格式化一条Server-Sent Events消息"""
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+def parse_combined_response(raw: Optional[str]):
+    """
+    解析单次调用模式的模型输出
+
+    Args:
+        raw: 模型返回的原始文本
+
+    Returns:
+        tuple: (reply, extracted_info)，extracted_info在无记账意图时为None；
+        无法解析出有效回复时返回None，由调用方回退到两次调用模式
+    """
+    if not raw:
+        return None
+
+    data = parse_json_object(raw)
+    if data is None:
+        return None
+
+    reply = data.get("reply")
+    if not isinstance(reply, str) or not reply.strip():
+        return None
+    return reply.strip(), combined_extracted_info(data)
+
+
+def combined_extracted_info(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    从单次调用模式解析出的对象中整理提取结果
+
+    Returns:
+        Dict: 提取结果（不含reply和has_intent），无记账意图时返回None
+    """
+    data = {k: v for k, v in data.items() if k != "reply"}
+    if not data.pop("has_intent", False):
+        return None
+
+    items = split_transactions(data)
+    for item in items:
+        item["source"] = "llm"
+    data = merge_transactions(items)
+    # 有记账意图但缺少金额或类型时视为提取不可靠
+    if data.get("amount") is None or data.get("type") not in ("income", "expense"):
+        data.setdefault("missing_fields", [])
+        for field in ("amount", "type"):
+            if data.get(field) is None and field not in data["missing_fields"]:
+                data["missing_fields"].append(field)
+    return data
+
+
+def stream_combined_response(
+    messages: List[Dict[str, Any]],
+    user_id: Optional[int],
+    extraction_future: Future,
+    fallback_extract: Callable[[], Optional[Dict[str, Any]]],
+):
+    """
+    单次调用模式的流式回复：模型流式返回JSON，边接收边增量解析
+
+    回复文本逐段产出；其余字段完整时立即产出 ("field", {...})，客户端可以提前渲染确认卡片；
+    顶层对象闭合时设置extraction_future，不等模型输出结束。
+    模型没有按格式返回时把原文作为回复，并用fallback_extract单独提取。
+
+    Args:
+        messages: 已拼接单次调用输出格式要求的对话消息
+        user_id: 用户ID，用于统计用量
+        extraction_future: 提取结果，生成器结束前一定会被设置
+        fallback_extract: 没有解析出结果时的提取函数
+
+    Yields:
+        str 或 tuple: 回复的增量文本，或 ("field", {"name": 字段名, "value": 值})
+    """
+    parser = StreamingJSONParser(stream_fields=("reply",))
+    raw_parts = []
+    reply_streamed = False
+    completed = False
+    try:
+        response = llm_client.chat_completion(
+            "combined",
+            user_id=user_id,
+            messages=messages,
+            temperature=0.3,
+            max_tokens=1000,
+            stream=True,
+        )
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            content = (chunk.choices[0].get("delta") or {}).get("content")
+            if not content:
+                continue
+            raw_parts.append(content)
+            for kind, name, value in parser.feed(content):
+                if kind == "delta":
+                    reply_streamed = True
+                    yield value
+                elif name != "reply":
+                    yield ("field", {"name": name, "value": value})
+            if parser.done and not extraction_future.done():
+                extraction_future.set_result(combined_extracted_info(parser.result))
+
+        if not reply_streamed and not parser.started:
+            print("单次调用的流式返回不是JSON，按普通回复处理")
+            raw = "".join(raw_parts).strip()
+            if raw:
+                yield raw
+        completed = True
+    finally:
+        if not extraction_future.done():
+            # 输出中断时不再提取，格式不对时回退到单独提取
+            extraction_future.set_result(fallback_extract() if completed else None)
+
+
+def get_combined_response(
+    user_message: str,
+    personality_id: Optional[int],
+    db: Optional[Session] = None,
+    user_id: Optional[int] = None,
+    before_message_id: Optional[int] = None,
+    context_messages: Optional[List[Dict[str, Any]]] = None,
+):
+    """
+    单次调用同时生成AI回复并提取财务信息
+
+    Args:
+        user_message: 用户消息
+        personality_id: AI性格ID
+        db: 数据库会话
+        user_id: 用户ID，提供时携带该用户的历史对话
+        before_message_id: 当前消息已入库时传入其ID
+        context_messages: 已构建好的对话消息，提供时不再访问数据库
+
+    Returns:
+        tuple: (reply, extracted_info)，调用或解析失败时返回None
+    """
+    print("\n------ 开始单次调用生成回复和提取信息 ------")
+
+    try:
+        persona_prompt, metadata = personality_registry.get(personality_id)
+        print(f"使用AI性格: {metadata['name']} ({metadata['personality_type']})")
+        system_prompt = build_combined_system_prompt(
+            persona_prompt, datetime.now().strftime("%Y-%m-%d")
+        )
+
+        if context_messages is not None:
+            messages = with_system_prompt(context_messages, system_prompt)
+        else:
+            messages = build_chat_messages(
+                system_prompt, user_message, db, user_id, before_message_id
+            )
+
+        response = llm_client.chat_completion(
+            "combined",
+            user_id=user_id,
+            messages=messages,
+            temperature=0.3,
+            max_tokens=1000,
+        )
+
+        result = response.choices[0].message.content
+        print(f"API原始返回: {(result or '')[:100]}...")
+
+        parsed = parse_combined_response(result)
+        if parsed is None:
+            print("无法解析单次调用的返回结果，将回退到两次调用模式")
+        print("------ 单次调用完成 ------\n")
+        return parsed
+
+    except Exception as e:
+        print(f"------ 单次调用时发生错误 ------")
+        print(f"错误类型: {type(e).__name__}")
+        print(f"错误信息: {str(e)}")
+        print("将回退到两次调用模式")
+        print("------ 错误信息结束 ------\n")
+        return None
+
+
+def extract_in_worker(message_content: str, user_id: Optional[int]):
+    """
+    在工作线程中提取记账信息，使用独立的数据库会话
+
+    数据库会话不是线程安全的，客户端断开时请求会话会被关闭，提取线程不能使用请求会话。
+    用户分类器已在请求线程中加载，提取通常不会访问数据库，会话在首次使用时才获取连接。
+    """
+    db = SessionLocal()
+    try:
+        return extract_financial_data(message_content, user_id, db)
+    finally:
+        db.close()
+
+
+def prepare_user_classifier(user_id: int, db: Session):
+    """在释放数据库连接前加载用户分类器，之后的提取只使用内存中的分类器"""
+    try:
+        get_user_classifier(user_id, db)
+    except Exception as e:
+        print(f"加载用户分类器失败: {str(e)}")
+
+
+def save_chat_turn(
+    db: Session,
+    user_id: int,
+    user_content: str,
+    ai_content: str,
+    personality_id: Optional[int],
+    received_at: datetime,
+    extracted_info: Optional[Dict[str, Any]] = None,
+):
+    """
+    把一轮对话的用户消息、AI回复和交易草稿加入会话并flush（不提交）
+
+    flush后ID和默认值已经可用，调用方在构建好响应后提交一次即可，
+    提交后不需要再refresh。
+
+    Returns:
+        tuple: (用户消息, AI回复, 草稿列表)
+    """
+    db_user_message = ChatMessage(
+        user_id=user_id,
+        content=user_content,
+        is_user=True,
+        personality_id=personality_id,
+        created_at=received_at,
+    )
+    db_ai_message = ChatMessage(
+        user_id=user_id,
+        content=ai_content,
+        is_user=False,
+        personality_id=personality_id,
+        created_at=datetime.utcnow(),
+    )
+    db.add_all([db_user_message, db_ai_message])
+    db.flush()
+    drafts = (
+        create_drafts(db, user_id, extracted_info, db_ai_message.id)
+        if extracted_info is not None
+        else []
+    )
+    return db_user_message, db_ai_message, drafts
+
+
+def split_auto_commit(
+    user_id: int,
+    threshold: Optional[float],
+    extracted_info: Optional[Dict[str, Any]],
+):
+    """
+    按用户的自动记账设置拆分提取结果
+
+    符合条件的交易构建为交易对象（不写入数据库），其余的仍生成草稿等待确认。
+
+    Args:
+        user_id: 用户ID
+        threshold: 生效的置信度阈值（auto_commit_threshold），未开启自动记账时为None
+        extracted_info: 提取结果
+
+    Returns:
+        tuple: (直接记账的交易列表, 仍需确认的提取结果或None)
+    """
+    if extracted_info is None or threshold is None:
+        return [], extracted_info
+
+    transactions, pending = [], []
+    for item in split_transactions(extracted_info):
+        if not is_auto_committable(item, threshold):
+            pending.append(item)
+            continue
+        try:
+            # 提取结果来自本次请求，不需要再做归属校验
+            confirmation = TransactionConfirmation(
+                confirm=True, **{field: item.get(field) for field in DRAFT_FIELDS}
+            )
+            transactions.append(build_transaction(confirmation, user_id))
+        except ValidationError as e:
+            print(f"自动记账失败，改为等待确认: {e.errors()[0]['msg']}")
+            pending.append(item)
+        except HTTPException as e:
+            print(f"自动记账失败，改为等待确认: {e.detail}")
+            pending.append(item)
+    return transactions, merge_transactions(pending) if pending else None
+
+
+def save_auto_committed(db: Session, user_id: int, transactions: List[Transaction]):
+    """
+    把自动记账的交易加入会话并flush（不提交），与对话在同一个事务中写入
+
+    Returns:
+        tuple: (序列化的交易列表, 撤销令牌)，没有交易时为 ([], None)
+    """
+    if not transactions:
+        return [], None
+    db.add_all(transactions)
+    db.flush()
+    print(f"自动记账 {len(transactions)} 笔交易")
+    return (
+        [serialize_transaction(transaction) for transaction in transactions],
+        create_undo_token(user_id, [transaction.id for transaction in transactions]),
+    )
+
+
+def learn_transactions(user_id: int, transactions: List[Transaction]):
+    """用已记账的交易增量训练用户分类器，在事务提交后调用"""
+    for transaction in transactions:
+        learn_transaction(
+            user_id,
+            transaction.description,
+            transaction.category,
+            transaction.type.value,
+        )
+
+
+def background_auto_commit(current_user: User):
+    """
+    后台提取使用的自动记账钩子，用户未开启自动记账时返回None
+
+    与同步模式相同：符合条件的交易在提取任务的事务中记账，其余的生成草稿，
+    事务提交后再训练用户分类器。
+    """
+    # 在请求线程中读取用户设置，后台线程不访问请求会话中的用户对象
+    threshold = auto_commit_threshold(current_user)
+    if threshold is None:
+        return None
+    user_id = current_user.id
+
+    def auto_commit(db: Session, extracted_info: Optional[Dict[str, Any]]):
+        committed, pending_info = split_auto_commit(user_id, threshold, extracted_info)
+        auto_committed, undo_token = save_auto_committed(db, user_id, committed)
+        return (
+            pending_info,
+            auto_committed,
+            undo_token,
+            lambda: learn_transactions(user_id, committed),
+        )
+
+    return auto_commit
+
+
 # Endpoints
 @router.post("/", response_model=ChatResponse)
 def create_chat_message(
@@ -290,51 +975,103 @@ def create_chat_message(
 ):
     print("\n\n========= 接收到聊天请求 =========")
     print(f"用户: {current_user.username}, 消息内容: {message.content}")
-    print(f"AI性格ID: {message.personality_id}")
+    user_id = current_user.id
+    # 能在本地解析的账单查询直接查库回答，不调用大模型，也不消耗模型配额
+    local_answer = answer_locally(message.content, db, user_id)
+    if local_answer is None:
+        enforce_llm_quota(user_id)
+
+    # 未指定助手时使用用户设置的助手，从内存注册表解析，不额外查询数据库
+    personality_id = personality_registry.resolve_id(
+        message.personality_id or current_user.personality_id
+    )
+    print(f"AI性格ID: {personality_id}")
+    # 用户消息的时间取收到请求的时刻，与AI回复一起写入时保持先后顺序
+    received_at = datetime.utcnow()
 
     try:
-        # Save the user message to the database
-        print("保存用户消息到数据库...")
-        db_user_message = ChatMessage(
-            user_id=current_user.id,
-            content=message.content,
-            is_user=True,
-            personality_id=message.personality_id,
-        )
-        db.add(db_user_message)
-        db.commit()
-        db.refresh(db_user_message)
-        print(f"用户消息已保存，ID: {db_user_message.id}")
+        combined = None
+        if local_answer is not None:
+            print(f"本地回答账单查询: {local_answer}")
+            combined = (local_answer, None)
+        else:
+            # 读取阶段：构建历史上下文并预加载用户分类器，然后释放数据库连接，
+            # 大模型调用期间不占用连接
+            system_prompt, _ = personality_registry.get(personality_id)
+            context_messages = build_chat_messages(
+                system_prompt, message.content, db, user_id
+            )
+            prepare_user_classifier(user_id, db)
+            release_connection(db)
+
+        if combined is None and is_report_question(message.content):
+            # 询问收支情况时不做记账提取，由模型调用本地报表工具回答
+            print("检测到账单查询，使用报表工具回答...")
+            answer = get_report_answer(
+                context_messages, personality_id, db, current_user
+            )
+            if answer is not None:
+                combined = (answer, None)
+        if combined is None and CHAT_MODE == "combined":
+            # 单次调用同时获取回复和提取结果，失败时回退到两次调用
+            combined = get_combined_response(
+                message.content,
+                personality_id,
+                user_id=user_id,
+                context_messages=context_messages,
+            )
 
-        # Extract financial information if present
-        print("开始提取财务信息...")
-        extracted_info = extract_financial_data(message.content)
-        needs_confirmation = extracted_info is not None
+        background = False
+        if combined is not None:
+            ai_response_content, extracted_info = combined
+        else:
+            background = (
+                message.background_extraction
+                if message.background_extraction is not None
+                else CHAT_BACKGROUND_EXTRACTION
+            )
+            if background:
+                # 后台提取模式：回复生成后立即返回，提取结果稍后推送
+                extracted_info = None
+            else:
+                # Extract financial information if present
+                print("开始提取财务信息...")
+                extracted_info = extract_financial_data(message.content, user_id, db)
+
+            # Generate AI response
+            print("正在生成AI回复...")
+            ai_response_content = get_ai_response(
+                message.content,
+                personality_id,
+                db,
+                user_id,
+                context_messages=context_messages,
+            )
         print(f"财务信息提取结果: {extracted_info}")
-        print(f"需要确认: {needs_confirmation}")
-
-        # Generate AI response
-        print("正在生成AI回复...")
-        ai_response_content = get_ai_response(
-            message.content, message.personality_id, db
+        # 开启自动记账时高置信度的交易直接写入，只有其余的需要确认
+        committed, extracted_info = split_auto_commit(
+            user_id, auto_commit_threshold(current_user), extracted_info
         )
+        needs_confirmation = extracted_info is not None
+        print(f"需要确认: {needs_confirmation}")
         print(f"AI回复内容: {ai_response_content[:100]}...")
 
-        # Save AI response to database
-        print("保存AI回复到数据库...")
-        db_ai_message = ChatMessage(
-            user_id=current_user.id,
-            content=ai_response_content,
-            is_user=False,
-            personality_id=message.personality_id,
+        # 写入阶段：用户消息、AI回复、草稿和自动记账的交易在一个事务中写入
+        print("保存对话到数据库...")
+        db_user_message, db_ai_message, drafts = save_chat_turn(
+            db,
+            user_id,
+            message.content,
+            ai_response_content,
+            personality_id,
+            received_at,
+            extracted_info,
         )
-        db.add(db_ai_message)
-        db.commit()
-        db.refresh(db_ai_message)
-        print(f"AI回复已保存，ID: {db_ai_message.id}")
-
-        print("========= 请求处理完成 =========\n")
-        return ChatResponse(
+        auto_committed, undo_token = save_auto_committed(db, user_id, committed)
+        if background:
+            # 与消息一起提交任务状态，其他进程收到轮询时也知道提取还在进行
+            db_ai_message.extraction_status = EXTRACTION_PENDING
+        response = ChatResponse(
             message=MessageResponse(
                 id=db_ai_message.id,
                 content=db_ai_message.content,
@@ -345,7 +1082,31 @@ def create_chat_message(
             ),
             extracted_info=extracted_info,
             needs_confirmation=needs_confirmation,
+            draft_id=drafts[0].id if drafts else None,
+            draft_ids=[draft.id for draft in drafts],
+            extraction_pending=background,
+            auto_committed_transactions=auto_committed,
+            undo_token=undo_token,
+        )
+        print(
+            f"对话已保存，用户消息ID: {db_user_message.id}, AI回复ID: {db_ai_message.id}"
         )
+        db.commit()
+        learn_transactions(user_id, committed)
+
+        if background:
+            # 消息提交后再提交任务，草稿关联到已存在的AI回复
+            content = message.content
+            background_extractor.submit(
+                user_id,
+                response.message.id,
+                lambda session: extract_financial_data(content, user_id, session),
+                background_auto_commit(current_user),
+            )
+            print(f"已提交后台提取任务，消息ID: {response.message.id}")
+
+        print("========= 请求处理完成 =========\n")
+        return response
 
     except Exception as e:
         print(f"========= 请求处理出错 =========")
@@ -361,191 +1122,666 @@ def create_chat_message(
         )
 
 
-@router.get("/history", response_model=List[MessageResponse])
-def get_chat_history(
-    limit: int = 50,
-    skip: int = 0,
+@router.post("/stream")
+def create_chat_message_stream(
+    message: MessageCreate,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    messages = (
-        db.query(ChatMessage)
-        .filter(ChatMessage.user_id == current_user.id)
-        .order_by(ChatMessage.created_at.desc())
-        .offset(skip)
-        .limit(limit)
-        .all()
+    """
+    流式聊天接口，通过Server-Sent Events返回
+
+    事件类型:
+    - token: 回复的增量文本 {"content": "..."}
+    - field: 单次调用模式下提取字段完整时立即发送 {"name": "amount", "value": 35}
+    - extraction: 财务信息提取结果，提取完成后立即发送 {"extracted_info": ..., "needs_confirmation": ..., "auto_committed": 自动记账笔数}
+    - done: 回复已保存 {"message": MessageResponse, "extracted_info": ..., "draft_id": ..., "auto_committed_transactions": [...], "undo_token": ...}
+    - error: 生成回复出错 {"detail": "..."}
+    """
+    print("\n\n========= 接收到流式聊天请求 =========")
+    print(f"用户: {current_user.username}, 消息内容: {message.content}")
+    user_id = current_user.id
+    local_answer = answer_locally(message.content, db, user_id)
+    if local_answer is None:
+        enforce_llm_quota(user_id)
+
+    received_at = datetime.utcnow()
+    personality_id = personality_registry.resolve_id(
+        message.personality_id or current_user.personality_id
+    )
+
+    if local_answer is not None:
+        # 本地解析的账单查询直接返回查询结果，不调用大模型
+        print(f"本地回答账单查询: {local_answer}")
+        release_connection(db)
+        extraction_future = Future()
+        extraction_future.set_result(None)
+        reply_stream = iter([local_answer])
+    else:
+        # 上下文和用户分类器在提取线程启动前加载，然后释放数据库连接，
+        # 流式回复期间不占用连接，结束后用户消息、回复和草稿在一个事务中写入
+        system_prompt, _ = personality_registry.get(personality_id)
+        chat_messages = build_chat_messages(system_prompt, message.content, db, user_id)
+        prepare_user_classifier(user_id, db)
+        release_connection(db)
+
+        if is_report_question(message.content):
+            # 询问收支情况时不做记账提取，由模型调用本地报表工具回答
+            extraction_future = Future()
+            extraction_future.set_result(None)
+            reply_stream = stream_report_answer(
+                chat_messages, personality_id, db, current_user
+            )
+        elif CHAT_MODE == "combined":
+            # 单次调用模式：回复和提取结果从同一个流中增量解析
+            extraction_future = Future()
+            content = message.content
+            reply_stream = stream_combined_response(
+                with_system_prompt(
+                    chat_messages,
+                    build_combined_system_prompt(
+                        system_prompt, datetime.now().strftime("%Y-%m-%d")
+                    ),
+                ),
+                user_id,
+                extraction_future,
+                lambda: extract_in_worker(content, user_id),
+            )
+        else:
+            # 提取与回复并行执行，提取线程使用自己的数据库会话
+            extraction_future = extraction_executor.submit(
+                extract_in_worker, message.content, user_id
+            )
+            reply_stream = stream_ai_response(chat_messages, user_id)
+
+    def event_stream():
+        extraction_sent = False
+        extracted_info = None
+        reply_parts = []
+
+        committed = []
+
+        def extraction_event():
+            nonlocal committed
+            committed, info = split_auto_commit(
+                user_id, auto_commit_threshold(current_user), extraction_future.result()
+            )
+            return info, format_sse(
+                "extraction",
+                {
+                    "extracted_info": info,
+                    "needs_confirmation": info is not None,
+                    "auto_committed": len(committed),
+                },
+            )
+
+        try:
+            for content in reply_stream:
+                if isinstance(content, tuple):
+                    yield format_sse(*content)
+                else:
+                    reply_parts.append(content)
+                    yield format_sse("token", {"content": content})
+                if not extraction_sent and extraction_future.done():
+                    extracted_info, event = extraction_event()
+                    extraction_sent = True
+                    yield event
+        except Exception as e:
+            print(f"流式生成回复时出错: {type(e).__name__}: {str(e)}")
+            if not reply_parts:
+                reply_parts = ["抱歉，我现在无法正常回应，请稍后再试。"]
+            yield format_sse("error", {"detail": str(e)})
+
+        if not extraction_sent:
+            extracted_info, event = extraction_event()
+            yield event
+
+        try:
+            _, db_ai_message, drafts = save_chat_turn(
+                db,
+                user_id,
+                message.content,
+                "".join(reply_parts),
+                personality_id,
+                received_at,
+                extracted_info,
+            )
+            auto_committed, undo_token = save_auto_committed(db, user_id, committed)
+            done = {
+                "message": MessageResponse(
+                    id=db_ai_message.id,
+                    content=db_ai_message.content,
+                    personality_id=db_ai_message.personality_id,
+                    user_id=db_ai_message.user_id,
+                    is_user=db_ai_message.is_user,
+                    created_at=db_ai_message.created_at,
+                ).model_dump(),
+                "extracted_info": extracted_info,
+                "needs_confirmation": extracted_info is not None,
+                "draft_id": drafts[0].id if drafts else None,
+                "draft_ids": [draft.id for draft in drafts],
+                "auto_committed_transactions": auto_committed,
+                "undo_token": undo_token,
+            }
+            db.commit()
+            learn_transactions(user_id, committed)
+        except Exception as e:
+            db.rollback()
+            print(f"保存流式回复失败: {str(e)}")
+            yield format_sse("error", {"detail": f"保存回复失败: {str(e)}"})
+            return
+
+        print(f"流式回复已保存，ID: {done['message']['id']}")
+        print("========= 流式请求处理完成 =========\n")
+        yield format_sse("done", done)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
+
+
+@router.get("/history", response_model=List[MessageResponse])
+def get_chat_history(
+    limit: int = 50,
+    skip: int = 0,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    获取聊天记录
+
+    - 不带游标: 最新的limit条，按时间倒序（skip为兼容旧客户端的偏移分页）
+    - before=消息ID: 该消息之前的limit条，按时间倒序，用于向上翻页
+    - after=消息ID: 该消息之后的limit条，按时间正序，用于重新打开聊天或轮询时只取新消息；
+      返回条数等于limit时用最后一条的ID继续请求
+
+    游标分页走 (user_id, created_at, id) 索引，翻到多深都不需要扫描前面的记录。
+    热表中的消息不够时继续从归档中读取，归档的消息都早于热表中的消息。
+    """
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail="before和after不能同时使用")
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+    user_id = current_user.id
+
+    query = db.query(ChatMessage).filter(ChatMessage.user_id == user_id)
+    newest_first = (ChatMessage.created_at.desc(), ChatMessage.id.desc())
+    cursor_id = before if before is not None else after
+    if cursor_id is None:
+        messages = query.order_by(*newest_first).offset(skip).limit(limit).all()
+        if len(messages) < limit:
+            archived_skip = max(0, skip - query.count()) if skip else 0
+            messages += load_archived_before(
+                db, user_id, None, limit - len(messages), archived_skip
+            )
+        return messages
+
+    cursor = (
+        db.query(ChatMessage.created_at, ChatMessage.id)
+        .filter(ChatMessage.id == cursor_id, ChatMessage.user_id == user_id)
+        .first()
+    )
+    position = (
+        (cursor.created_at, cursor.id)
+        if cursor is not None
+        else find_archived_position(db, user_id, cursor_id)
+    )
+    if position is None:
+        raise HTTPException(status_code=404, detail="游标消息不存在")
+
+    if before is not None:
+        messages = (
+            query.filter(tuple_(ChatMessage.created_at, ChatMessage.id) < position)
+            .order_by(*newest_first)
+            .limit(limit)
+            .all()
+        )
+        if len(messages) < limit:
+            messages += load_archived_before(
+                db, user_id, position, limit - len(messages)
+            )
+        return messages
+
+    messages = []
+    if cursor is None:
+        # 游标在归档中，先读游标之后的归档消息
+        messages = load_archived_after(db, user_id, position, limit)
+    if len(messages) < limit:
+        messages += (
+            query.filter(tuple_(ChatMessage.created_at, ChatMessage.id) > position)
+            .order_by(ChatMessage.created_at, ChatMessage.id)
+            .limit(limit - len(messages))
+            .all()
+        )
     return messages
 
 
+@router.get("/archives", response_model=List[Dict[str, Any]])
+def get_chat_archives(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """列出当前用户的聊天归档（时间范围、条数和摘要），不包含消息内容"""
+    archives = (
+        db.query(ChatMessageArchive)
+        .filter(ChatMessageArchive.user_id == current_user.id)
+        .order_by(ChatMessageArchive.end_at.desc())
+        .all()
+    )
+    return [
+        {
+            "id": archive.id,
+            "start_at": archive.start_at,
+            "end_at": archive.end_at,
+            "message_count": archive.message_count,
+            "first_message_id": archive.first_message_id,
+            "last_message_id": archive.last_message_id,
+            "summary": archive.summary,
+        }
+        for archive in archives
+    ]
+
+
 @router.get("/personalities", response_model=List[dict])
 def get_ai_personalities(
-    db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_user),
 ):
-    # 使用新的模块获取所有助手元数据
-    result = get_all_assistants_metadata()
-    return result
-
+    """
+    获取所有AI助手的元数据
 
-@router.post("/confirm-transaction", response_model=Dict[str, Any])
-def confirm_transaction(
-    confirmation: TransactionConfirmation,
+    数据来自内存中的助手注册表，响应带ETag，客户端带 If-None-Match 请求且助手未变化时返回304
+    """
+    etag = personality_registry.snapshot().etag
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return personality_registry.metadata_list()
+
+
+@router.get("/metrics", response_model=Dict[str, Any])
+def get_chat_metrics(current_user: User = Depends(get_current_user)):
+    """获取聊天相关的运行指标，如提取缓存命中率"""
+    return {
+        "extraction_cache": extraction_cache.stats(),
+        "llm": llm_client.stats(),
+        "usage": usage_tracker.stats(),
+        "image_dedup": image_dedup_index.stats(),
+        "archive": chat_archiver.stats(),
+        "background_extraction": background_extractor.stats(),
+    }
+
+
+@router.get("/usage", response_model=Dict[str, Any])
+def get_llm_usage(
+    days: int = 7,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    print("\n\n========= 接收到交易确认请求 =========")
-    print(f"消息ID: {confirmation.message_id}, 确认: {confirmation.confirm}")
+    """获取当前用户最近几天的AI用量和当天剩余配额"""
+    start_day = date.today() - timedelta(days=max(days, 1) - 1)
+    rows = (
+        db.query(LLMUsageDaily)
+        .filter(
+            LLMUsageDaily.user_id == current_user.id, LLMUsageDaily.day >= start_day
+        )
+        .order_by(LLMUsageDaily.day)
+        .all()
+    )
+    used_today = usage_tracker.daily_tokens(current_user.id)
+    quota = usage_tracker.daily_quota
+    return {
+        "today_tokens": used_today,
+        "daily_quota": quota or None,
+        "remaining_tokens": max(quota - used_today, 0) if quota else None,
+        "daily": [
+            {
+                "day": row.day.isoformat(),
+                "requests": row.requests,
+                "prompt_tokens": row.prompt_tokens,
+                "completion_tokens": row.completion_tokens,
+            }
+            for row in rows
+        ],
+    }
 
-    try:
-        if confirmation.confirm:
-            print("用户确认，创建交易...")
 
-            # 特殊处理：如果message_id为-1，表示这是一个直接提交的交易，跳过消息验证
-            if confirmation.message_id != -1:
-                # 获取聊天消息
-                chat_message = (
-                    db.query(ChatMessage)
-                    .filter(ChatMessage.id == confirmation.message_id)
-                    .first()
-                )
-                if not chat_message:
-                    raise HTTPException(
-                        status_code=404, detail="Chat message not found"
-                    )
+def build_confirmed_transaction(
+    confirmation: TransactionConfirmation, db: Session, current_user: User
+) -> Transaction:
+    """
+    校验用户确认的交易信息并构建交易对象（不写入数据库）
 
-                # 确认聊天消息属于当前用户
-                if chat_message.user_id != current_user.id:
-                    raise HTTPException(
-                        status_code=403,
-                        detail="Not authorized to confirm this transaction",
-                    )
-            else:
-                print("使用特殊ID -1，跳过消息验证")
-
-            # 构建交易数据
-            transaction_data = {
-                "user_id": current_user.id,
-                "amount": confirmation.amount,
-                "description": confirmation.description,
-                "category": confirmation.category,
-            }
+    确认的是草稿时，以草稿内容为准并应用用户修改过的字段，草稿随交易一起提交时删除；
+    不是草稿时必须关联当前用户自己的聊天消息。
 
-            # 设置类型 - 小写处理并添加详细日志
-            print(f"接收到的交易类型: '{confirmation.type}'")
+    Raises:
+        HTTPException: 草稿或消息不存在、无权确认或交易信息无效
+    """
+    if confirmation.draft_id is not None:
+        draft = get_active_draft(db, confirmation.draft_id, current_user.id)
+        if draft is None:
+            raise HTTPException(status_code=404, detail="交易草稿不存在或已过期")
+        overrides = confirmation.model_dump(
+            include=set(DRAFT_FIELDS), exclude_none=True
+        )
+        try:
+            # 重新构建模型，合并后的字段同样经过校验
+            confirmation = TransactionConfirmation(
+                **{**confirmation.model_dump(), **draft_fields(draft), **overrides}
+            )
+        except ValidationError as e:
+            raise HTTPException(
+                status_code=400, detail=f"交易草稿内容无效: {e.errors()[0]['msg']}"
+            )
+        if not claim_draft(db, draft.id, current_user.id):
+            raise HTTPException(status_code=409, detail="交易草稿已被确认或已过期")
+    elif confirmation.message_id in (None, -1):
+        raise HTTPException(
+            status_code=400, detail="请提供交易草稿ID或关联的聊天消息ID"
+        )
+    else:
+        # 获取聊天消息
+        chat_message = (
+            db.query(ChatMessage)
+            .filter(ChatMessage.id == confirmation.message_id)
+            .first()
+        )
+        if not chat_message:
+            raise HTTPException(status_code=404, detail="Chat message not found")
+
+        # 确认聊天消息属于当前用户
+        if chat_message.user_id != current_user.id:
+            raise HTTPException(
+                status_code=403,
+                detail="Not authorized to confirm this transaction",
+            )
+
+    return build_transaction(confirmation, current_user.id)
 
-            # 确保类型为字符串并转换为小写
-            type_lower = str(confirmation.type).lower() if confirmation.type else ""
-            print(f"处理后的类型(小写): '{type_lower}'")
 
-            # 映射到正确的枚举值
-            if type_lower == "income":
-                transaction_type = TransactionType.INCOME
-                print(f"映射为 TransactionType.INCOME: {TransactionType.INCOME}")
-            elif type_lower == "expense":
-                transaction_type = TransactionType.EXPENSE
-                print(f"映射为 TransactionType.EXPENSE: {TransactionType.EXPENSE}")
+def build_transaction(
+    confirmation: TransactionConfirmation, user_id: int
+) -> Transaction:
+    """
+    校验交易字段并构建交易对象，不做归属校验，调用方负责确认数据来源
+
+    Raises:
+        HTTPException: 交易信息无效
+    """
+    if confirmation.amount is None:
+        raise HTTPException(status_code=400, detail="缺少交易金额")
+
+    # 构建交易数据
+    transaction_data = {
+        "user_id": user_id,
+        "amount": confirmation.amount,
+        "description": confirmation.description,
+        "category": confirmation.category,
+    }
+
+    # 设置类型 - 小写处理并添加详细日志
+    print(f"接收到的交易类型: '{confirmation.type}'")
+
+    # 确保类型为字符串并转换为小写
+    type_lower = str(confirmation.type).lower() if confirmation.type else ""
+    print(f"处理后的类型(小写): '{type_lower}'")
+
+    # 映射到正确的枚举值
+    if type_lower == "income":
+        transaction_type = TransactionType.INCOME
+        print(f"映射为 TransactionType.INCOME: {TransactionType.INCOME}")
+    elif type_lower == "expense":
+        transaction_type = TransactionType.EXPENSE
+        print(f"映射为 TransactionType.EXPENSE: {TransactionType.EXPENSE}")
+    else:
+        error_msg = f"无效的交易类型: '{confirmation.type}'"
+        print(error_msg)
+        raise HTTPException(status_code=400, detail=error_msg)
+
+    transaction_data["type"] = transaction_type
+
+    # 处理日期和时间
+    if confirmation.date:
+        try:
+            print(f"处理日期: {confirmation.date}")
+            transaction_date = datetime.strptime(confirmation.date, "%Y-%m-%d").date()
+            # 使用正确的字段名称transaction_date而不是date
+            transaction_data["transaction_date"] = datetime.combine(
+                transaction_date, datetime.min.time()
+            )
+            print(f"设置transaction_date为: {transaction_data['transaction_date']}")
+        except ValueError as e:
+            error_msg = f"无效的日期格式: {str(e)}"
+            print(error_msg)
+            raise HTTPException(status_code=400, detail=error_msg)
+
+    if confirmation.time:
+        try:
+            print(f"处理时间: {confirmation.time}")
+            time_obj = datetime.strptime(confirmation.time, "%H:%M").time()
+            # 使用正确的字段名称transaction_time而不是time
+            if "transaction_date" in transaction_data:
+                # 如果已经有日期，则将时间合并到同一个字段中
+                date_part = transaction_data["transaction_date"].date()
+                transaction_data["transaction_time"] = datetime.combine(
+                    date_part, time_obj
+                )
             else:
-                error_msg = f"无效的交易类型: '{confirmation.type}'"
-                print(error_msg)
-                raise HTTPException(status_code=400, detail=error_msg)
+                # 如果没有日期，则使用当前日期
+                transaction_data["transaction_time"] = datetime.combine(
+                    datetime.now().date(), time_obj
+                )
+            print(f"设置transaction_time为: {transaction_data['transaction_time']}")
+        except ValueError as e:
+            error_msg = f"无效的时间格式: {str(e)}"
+            print(error_msg)
+            raise HTTPException(status_code=400, detail=error_msg)
+
+    return Transaction(**transaction_data)
+
+
+def serialize_transaction(transaction: Transaction) -> Dict[str, Any]:
+    """构建确认接口返回的交易数据"""
+    return {
+        "id": transaction.id,
+        "amount": transaction.amount,
+        "type": str(transaction.type.value) if transaction.type else None,
+        "description": transaction.description,
+        "category": transaction.category,
+        "date": (
+            transaction.transaction_date.isoformat()
+            if transaction.transaction_date
+            else None
+        ),
+        "time": (
+            transaction.transaction_time.isoformat()
+            if transaction.transaction_time
+            else None
+        ),
+    }
+
+
+@router.get("/drafts", response_model=List[Dict[str, Any]])
+def get_transaction_drafts(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """获取当前用户未过期的待确认交易草稿"""
+    drafts = list_active_drafts(db, current_user.id)
+    if purge_expired_drafts(db, current_user.id):
+        db.commit()
+    return [draft_to_dict(draft) for draft in drafts]
 
-            transaction_data["type"] = transaction_type
 
-            # 处理日期和时间
-            if confirmation.date:
-                try:
-                    print(f"处理日期: {confirmation.date}")
-                    transaction_date = datetime.strptime(
-                        confirmation.date, "%Y-%m-%d"
-                    ).date()
-                    # 使用正确的字段名称transaction_date而不是date
-                    transaction_data["transaction_date"] = datetime.combine(
-                        transaction_date, datetime.min.time()
-                    )
-                    print(
-                        f"设置transaction_date为: {transaction_data['transaction_date']}"
-                    )
-                except ValueError as e:
-                    error_msg = f"无效的日期格式: {str(e)}"
-                    print(error_msg)
-                    raise HTTPException(status_code=400, detail=error_msg)
+def get_extraction_result(db: Session, user_id: int, message_id: int) -> Dict[str, Any]:
+    """
+    获取消息的后台提取结果
+
+    任务不在本进程内存中时（已清理或由其他进程执行）根据AI回复记录的提取状态和该消息的草稿返回结果：
+    仍在进行的返回pending，已完成的返回草稿（没有草稿表示未提取到交易或已全部自动记账）。
+
+    Raises:
+        HTTPException: 消息不存在、不属于该用户或没有使用后台提取时返回404
+    """
+    job = background_extractor.get(user_id, message_id)
+    if job is not None:
+        return job.to_dict()
+
+    message = (
+        db.query(ChatMessage)
+        .filter(ChatMessage.id == message_id, ChatMessage.user_id == user_id)
+        .first()
+    )
+    drafts = list_message_drafts(db, user_id, message_id) if message else []
+    if message is None or (message.extraction_status is None and not drafts):
+        raise HTTPException(status_code=404, detail="提取任务不存在或已过期")
+
+    status_value = message.extraction_status or "done"
+    error = None
+    if status_value == EXTRACTION_PENDING:
+        started_at = message.created_at or datetime.utcnow()
+        if datetime.utcnow() - started_at > timedelta(seconds=EXTRACTION_JOB_TTL):
+            # 执行任务的进程已退出，任务不会再完成
+            status_value, error = EXTRACTION_FAILED, "提取任务已中断"
+    elif status_value == EXTRACTION_FAILED:
+        error = "提取失败"
+
+    extracted_info = (
+        merge_transactions([draft_to_dict(draft)["extracted_info"] for draft in drafts])
+        if drafts
+        else None
+    )
+    return {
+        "message_id": message_id,
+        "status": status_value,
+        "extracted_info": extracted_info,
+        "needs_confirmation": extracted_info is not None,
+        "draft_id": drafts[0].id if drafts else None,
+        "draft_ids": [draft.id for draft in drafts],
+        # 撤销令牌只在任务结果中返回，不会从数据库恢复
+        "auto_committed_transactions": [],
+        "undo_token": None,
+        "error": error,
+    }
+
+
+@router.get("/extractions/{message_id}", response_model=Dict[str, Any])
+def get_extraction(
+    message_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    轮询后台提取结果
+
+    status为pending时稍后再查；done时extracted_info、draft_ids、auto_committed_transactions
+    和undo_token与同步模式的聊天响应一致
+    """
+    return get_extraction_result(db, current_user.id, message_id)
+
+
+@router.get("/extractions/{message_id}/events")
+async def stream_extraction(
+    message_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    通过Server-Sent Events等待后台提取结果
+
+    事件类型:
+    - extraction: 提取完成，数据与轮询接口相同
+    - error: 等待超时或任务由其他进程执行 {"detail": "..."}，客户端可以改用轮询接口
+    """
+    user_id = current_user.id
+    job = background_extractor.get(user_id, message_id)
+    if job is None:
+        result = await run_in_threadpool(get_extraction_result, db, user_id, message_id)
+
+    async def event_stream():
+        if job is None:
+            if result["status"] == EXTRACTION_PENDING:
+                # 任务由其他进程执行，本进程无法等待它完成
+                yield format_sse(
+                    "error", {"detail": "提取仍在进行，请稍后通过轮询接口查询"}
+                )
+                return
+            yield format_sse("extraction", result)
+            return
+        try:
+            # shield避免超时取消任务本身的Future
+            await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(job.future)),
+                EXTRACTION_EVENT_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            yield format_sse("error", {"detail": "提取超时，请稍后通过轮询接口查询"})
+            return
+        yield format_sse("extraction", job.to_dict())
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-            if confirmation.time:
-                try:
-                    print(f"处理时间: {confirmation.time}")
-                    time_obj = datetime.strptime(confirmation.time, "%H:%M").time()
-                    # 使用正确的字段名称transaction_time而不是time
-                    if "transaction_date" in transaction_data:
-                        # 如果已经有日期，则将时间合并到同一个字段中
-                        date_part = transaction_data["transaction_date"].date()
-                        transaction_data["transaction_time"] = datetime.combine(
-                            date_part, time_obj
-                        )
-                    else:
-                        # 如果没有日期，则使用当前日期
-                        transaction_data["transaction_time"] = datetime.combine(
-                            datetime.now().date(), time_obj
-                        )
-                    print(
-                        f"设置transaction_time为: {transaction_data['transaction_time']}"
-                    )
-                except ValueError as e:
-                    error_msg = f"无效的时间格式: {str(e)}"
-                    print(error_msg)
-                    raise HTTPException(status_code=400, detail=error_msg)
+
+@router.post("/confirm-transaction", response_model=Dict[str, Any])
+def confirm_transaction(
+    confirmation: TransactionConfirmation,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    print("\n\n========= 接收到交易确认请求 =========")
+    print(
+        f"草稿ID: {confirmation.draft_id}, 消息ID: {confirmation.message_id}, "
+        f"确认: {confirmation.confirm}"
+    )
+
+    try:
+        if confirmation.confirm:
+            print("用户确认，创建交易...")
 
             # 创建交易
-            transaction = Transaction(**transaction_data)
+            transaction = build_confirmed_transaction(confirmation, db, current_user)
             db.add(transaction)
             db.commit()
             db.refresh(transaction)
 
             print(f"交易已创建，ID: {transaction.id}")
 
-            # 准备返回数据
-            print("准备返回交易数据...")
-
-            # 为了调试，输出transaction对象的所有属性
-            print(f"交易ID: {transaction.id}")
-            print(f"交易金额: {transaction.amount}")
-            print(f"交易类型: {transaction.type}")
-            print(f"交易描述: {transaction.description}")
-            print(f"交易分类: {transaction.category}")
-            print(f"交易日期: {transaction.transaction_date}")
-            print(f"交易时间: {transaction.transaction_time}")
+            # 用确认的交易增量训练用户分类器
+            learn_transaction(
+                current_user.id,
+                transaction.description,
+                transaction.category,
+                transaction.type.value,
+            )
 
-            # 构建返回数据，使用正确的属性名
             result = {
                 "confirmed": True,
-                "transaction": {
-                    "id": transaction.id,
-                    "amount": transaction.amount,
-                    "type": str(transaction.type.value) if transaction.type else None,
-                    "description": transaction.description,
-                    "category": transaction.category,
-                    "date": (
-                        transaction.transaction_date.isoformat()
-                        if transaction.transaction_date
-                        else None
-                    ),
-                    "time": (
-                        transaction.transaction_time.isoformat()
-                        if transaction.transaction_time
-                        else None
-                    ),
-                },
+                "transaction": serialize_transaction(transaction),
             }
             print("响应数据构建完成")
 
         else:
             print("用户拒绝，不创建交易")
+            if confirmation.draft_id is not None:
+                discard_draft(db, confirmation.draft_id, current_user.id)
+                db.commit()
             result = {"confirmed": False}
 
         print("========= 交易确认请求处理完成 =========\n")
         return result
 
     except HTTPException:
+        db.rollback()
         raise
 
     except Exception as e:
@@ -562,6 +1798,164 @@ def confirm_transaction(
         )
 
 
+@router.post("/confirm-transactions", response_model=Dict[str, Any])
+def confirm_transactions(
+    batch: BatchTransactionConfirmation,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    一次确认多条待确认的交易（如批量图片识别的结果）
+
+    items 中可以逐条修改字段或拒绝，draft_ids 中的草稿按原样确认。
+    所有交易在同一个数据库事务中创建，任意一条无效时全部不创建。
+    """
+    items = list(batch.items) + [
+        TransactionConfirmation(confirm=True, draft_id=draft_id)
+        for draft_id in batch.draft_ids
+    ]
+    print("\n\n========= 接收到批量交易确认请求 =========")
+    print(f"用户: {current_user.username}, 条数: {len(items)}")
+    if not items:
+        raise HTTPException(status_code=400, detail="没有需要确认的交易")
+
+    transactions = []
+    try:
+        draft_ids = [item.draft_id for item in items if item.draft_id is not None]
+        if len(draft_ids) != len(set(draft_ids)):
+            raise HTTPException(status_code=400, detail="同一草稿不能重复确认")
+        for index, item in enumerate(items):
+            if not item.confirm:
+                if item.draft_id is not None:
+                    discard_draft(db, item.draft_id, current_user.id)
+                continue
+            try:
+                transactions.append(build_confirmed_transaction(item, db, current_user))
+            except HTTPException as e:
+                raise HTTPException(
+                    status_code=e.status_code, detail=f"第{index + 1}条: {e.detail}"
+                )
+
+        db.add_all(transactions)
+        db.commit()
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        print(f"批量创建交易失败: {type(e).__name__}: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+        )
+
+    learn_transactions(current_user.id, transactions)
+
+    print(f"批量创建交易 {len(transactions)} 条")
+    return {
+        "confirmed": len(transactions),
+        "skipped": len(items) - len(transactions),
+        "transactions": [serialize_transaction(t) for t in transactions],
+    }
+
+
+@router.post("/undo-transaction", response_model=Dict[str, Any])
+def undo_transaction(
+    request: UndoTransactionRequest,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """撤销聊天中自动记账的交易，凭聊天接口返回的undo_token软删除，并回退分类器的学习"""
+    try:
+        undone = undo_auto_commit(db, current_user.id, request.undo_token)
+    except InvalidUndoTokenError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    db.commit()
+    for transaction in undone:
+        unlearn_transaction(
+            current_user.id,
+            transaction.description,
+            transaction.category,
+            transaction.type.value,
+        )
+    print(f"用户 {current_user.id} 撤销自动记账 {len(undone)} 笔")
+    return {"undone": len(undone)}
+
+
+def save_image_recognition_result(
+    db: Session, user_id: int, extracted_data: Dict[str, Any], deduplicated: bool
+) -> Dict[str, Any]:
+    """
+    生成图片识别的AI回复消息并保存
+
+    Args:
+        db: 数据库会话
+        user_id: 用户ID
+        extracted_data: 图片识别结果
+        deduplicated: 结果是否来自重复图片的缓存
+
+    Returns:
+        dict: 图片识别接口的响应
+    """
+    ai_message = (
+        f"我已从图片中识别出以下交易信息：\n"
+        f"类型：{'收入' if extracted_data.get('type') == 'income' else '支出'}\n"
+        f"金额：¥{extracted_data.get('amount')}\n"
+        f"日期：{extracted_data.get('date')}\n"
+        f"描述：{extracted_data.get('description')}\n"
+        f"分类：{extracted_data.get('category')}\n\n"
+    )
+    if deduplicated:
+        ai_message += "这张图片之前已经识别过，以上是上次的识别结果。\n"
+    ai_message += "请核对以上信息，确认无误后可点击确认按钮进行记账。"
+
+    # 保存AI消息到数据库
+    db_ai_message = ChatMessage(
+        user_id=user_id,
+        content=ai_message,
+        is_user=False,
+    )
+    db.add(db_ai_message)
+    db.flush()
+    draft = create_draft(db, user_id, extracted_data, db_ai_message.id)
+    db.commit()
+
+    return {
+        "message": ai_message,
+        "message_id": db_ai_message.id,
+        "draft_id": draft.id,
+        "extracted_info": extracted_data,
+        "needs_confirmation": True,
+        "deduplicated": deduplicated,
+    }
+
+
+def call_image_model(prepared: PreparedImage, user_id: int) -> Dict[str, Any]:
+    """
+    调用视觉模型识别一张处理后的图片，并把结果加入去重索引
+
+    Raises:
+        ValueError: 模型返回中没有JSON数据
+    """
+    response = llm_client.chat_completion(
+        "image",
+        user_id=user_id,
+        messages=build_image_messages(
+            prepared.to_data_url(), datetime.now().strftime("%Y-%m-%d")
+        ),
+        temperature=0.1,
+    )
+    result = response.choices[0].message.content
+    print(f"API原始返回: {result[:200]}...")
+
+    extracted_data = parse_json_object(result or "")
+    if extracted_data is None:
+        raise ValueError("无法从API响应中提取JSON数据")
+    print(f"解析后的数据: {extracted_data}")
+
+    image_dedup_index.add(user_id, prepared.image_hash, extracted_data)
+    return extracted_data
+
+
 @router.post("/image-recognition", response_model=Dict[str, Any])
 async def recognize_image(
     image: UploadFile = File(...),
@@ -574,136 +1968,68 @@ async def recognize_image(
     print("\n\n========= 接收到图片识别请求 =========")
     print(f"用户: {current_user.username}")
     print(f"文件名: {image.filename}")
+    enforce_llm_quota(current_user.id, "image")
 
     try:
-        # 创建临时目录存储上传的图片
-        temp_dir = os.path.join("temp", "uploads")
-        os.makedirs(temp_dir, exist_ok=True)
-
-        # 生成唯一文件名
-        file_extension = os.path.splitext(image.filename)[1]
-        temp_file_name = f"{uuid.uuid4()}{file_extension}"
-        temp_file_path = os.path.join(temp_dir, temp_file_name)
-
-        # 保存上传的图片
-        print(f"保存图片到临时路径: {temp_file_path}")
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
+        # 限制大小读取 → 摆正、缩小、重新编码，请求体大小已在解析前由中间件检查
+        try:
+            raw_image = await read_upload(image)
+            prepared = await run_in_threadpool(prepare_image, raw_image)
+        except ImageTooLargeError as e:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e)
+            )
+        except InvalidImageError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        print(
+            f"图片处理完成: {prepared.original_size // 1024}KB -> {len(prepared.data) // 1024}KB, "
+            f"{prepared.width}x{prepared.height}"
+        )
 
-        # 读取图片并转换为base64编码用于API调用
-        with open(temp_file_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
+        # 同一用户最近识别过相同或几乎相同的图片时直接返回上次的结果
+        duplicate = image_dedup_index.lookup(current_user.id, prepared.image_hash)
+        if duplicate is not None:
+            extracted_data, distance = duplicate
+            print(f"命中重复图片(汉明距离 {distance})，跳过模型调用")
+            return await run_in_threadpool(
+                save_image_recognition_result,
+                db,
+                current_user.id,
+                extracted_data,
+                deduplicated=True,
+            )
 
         # 调用AI API提取图片中的交易信息
         print("调用AI API识别图片中的交易信息...")
 
         try:
-            # 构建提示词，要求AI提取图片中的交易信息
-            prompt = """
-            请分析这张交易凭证/收据图片，提取以下关键财务信息:
-            1. 交易类型: "income"(收入) 或 "expense"(支出)
-            2. 交易金额: 以数字形式表示
-            3. 交易日期和时间: 格式化为YYYY-MM-DD和HH:MM
-            4. 交易描述: 交易的目的、项目或购买的商品/服务
-            5. 交易分类: 例如"餐饮美食"、"交通出行"、"服饰美容"、"日用百货"等
-
-            请按以下JSON格式返回结果：
-            {
-              "type": "expense",
-              "amount": 123.45,
-              "date": "2023-05-20",
-              "time": "14:30",
-              "description": "在XX超市购买日用品",
-              "category": "日用百货"
-            }
-
-            如果无法识别某些字段，请提供你能提取的信息，缺失字段可设为null或合理默认值。
-            如果无法确定是收入还是支出，请根据图像中的上下文(如购物小票通常是支出)进行最佳猜测。
-            """
-
-            response = openai.ChatCompletion.create(
-                model=use_model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "你是一个专业的交易凭证识别助手，擅长从图片中提取财务信息。",
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{encoded_image}"
-                                },
-                            },
-                        ],
-                    },
-                ],
-                temperature=0.1,
-            )
-
-            print("API调用成功!")
-            result = response.choices[0].message.content
-            print(f"API原始返回: {result[:200]}...")
-
-            # 解析JSON响应
-            import json
-            import re
-
-            # 尝试从响应中提取JSON部分
-            json_match = re.search(r"({[\s\S]*})", result)
-            if json_match:
-                json_str = json_match.group(1)
-                print(f"提取的JSON字符串: {json_str[:100]}...")
-
-                extracted_data = json.loads(json_str)
-                print(f"解析后的数据: {extracted_data}")
-
-                # 生成AI响应消息
-                ai_message = (
-                    f"我已从图片中识别出以下交易信息：\n"
-                    f"类型：{'收入' if extracted_data.get('type') == 'income' else '支出'}\n"
-                    f"金额：¥{extracted_data.get('amount')}\n"
-                    f"日期：{extracted_data.get('date')}\n"
-                    f"描述：{extracted_data.get('description')}\n"
-                    f"分类：{extracted_data.get('category')}\n\n"
-                    f"请核对以上信息，确认无误后可点击确认按钮进行记账。"
-                )
-
-                # 保存AI消息到数据库
-                db_ai_message = ChatMessage(
-                    user_id=current_user.id,
-                    content=ai_message,
-                    is_user=False,
-                )
-                db.add(db_ai_message)
-                db.commit()
-                db.refresh(db_ai_message)
-
-                # 删除临时文件
-                os.remove(temp_file_path)
-
-                print("图片识别完成，返回提取的交易信息")
-                return {
-                    "message": ai_message,
-                    "extracted_info": extracted_data,
-                    "needs_confirmation": True,
-                }
-            else:
-                error_msg = "无法从API响应中提取JSON数据"
-                print(error_msg)
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=error_msg
-                )
-
+            # 模型调用是阻塞的，放到线程池中执行，避免阻塞事件循环
+            extracted_data = await run_in_threadpool(
+                call_image_model, prepared, current_user.id
+            )
+            print("图片识别完成，返回提取的交易信息")
+            return await run_in_threadpool(
+                save_image_recognition_result,
+                db,
+                current_user.id,
+                extracted_data,
+                deduplicated=False,
+            )
+        except ValueError as e:
+            print(str(e))
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+            )
+        except HTTPException:
+            raise
         except Exception as e:
             print(f"图片识别过程中出错: {str(e)}")
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=f"图片识别失败: {str(e)}",
             )
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"处理图片上传请求时出错: {str(e)}")
         import traceback
@@ -713,3 +2039,187 @@ async def recognize_image(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"处理图片失败: {str(e)}",
         )
+
+
+@router.post("/image-recognition/batch")
+async def recognize_images_batch(
+    images: List[UploadFile] = File(...),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """
+    批量识别多张交易凭证图片，通过Server-Sent Events逐张返回结果
+
+    最多同时向模型发起IMAGE_BATCH_CONCURRENCY个请求，先识别完的图片先返回；
+    每张需要调用模型的图片单独计入限流，被限流或识别失败的图片单独返回错误。
+
+    事件类型:
+    - result: 一张图片识别完成 {"index", "filename", "message_id", "draft_id", "extracted_info", "deduplicated"}
+    - error: 一张图片识别失败 {"index", "filename", "status_code", "detail"}
+    - done: 全部处理完成 {"pending": [...], "succeeded": n, "failed": n}，
+      pending 中的草稿可以通过 /chat/confirm-transactions 一次确认
+    """
+    print("\n\n========= 接收到批量图片识别请求 =========")
+    print(f"用户: {current_user.username}, 图片数: {len(images)}")
+    if len(images) > IMAGE_BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"一次最多上传 {IMAGE_BATCH_MAX_FILES} 张图片",
+        )
+
+    user_id = current_user.id
+    # 响应开始前把上传内容读入内存，流式响应期间上传文件可能已被关闭
+    uploads = []
+    for index, image in enumerate(images):
+        try:
+            uploads.append((index, image.filename, await read_upload(image), None))
+        except ImageTooLargeError as e:
+            uploads.append(
+                (
+                    index,
+                    image.filename,
+                    None,
+                    (status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, str(e)),
+                )
+            )
+
+    semaphore = asyncio.Semaphore(IMAGE_BATCH_CONCURRENCY)
+    # 本批次中正在调用模型识别的图片 [(图片哈希, 识别结果)]，同一批里重复的图片只识别一次
+    in_flight = []
+
+    async def recognize_one(index, filename, data, error):
+        """Returns: (index, filename, 识别结果, 是否命中去重, (状态码, 错误信息))"""
+        if error:
+            return index, filename, None, False, error
+        try:
+            async with semaphore:
+                prepared = await run_in_threadpool(prepare_image, data)
+        except ImageTooLargeError as e:
+            return (
+                index,
+                filename,
+                None,
+                False,
+                (status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, str(e)),
+            )
+        except InvalidImageError as e:
+            return index, filename, None, False, (status.HTTP_400_BAD_REQUEST, str(e))
+        except Exception as e:
+            # 其它解码错误只影响这一张图片，不中断整个批次
+            print(f"第{index + 1}张图片处理失败: {type(e).__name__}: {str(e)}")
+            return (
+                index,
+                filename,
+                None,
+                False,
+                (status.HTTP_400_BAD_REQUEST, "无法处理的图片"),
+            )
+
+        duplicate = image_dedup_index.lookup(user_id, prepared.image_hash)
+        if duplicate is not None:
+            return index, filename, duplicate[0], True, None
+        for image_hash, future in in_flight:
+            if (
+                hamming_distance(image_hash, prepared.image_hash)
+                <= image_dedup_index.threshold
+            ):
+                # 同一批中已有相同的图片在识别，等待并复用它的结果
+                extracted, error = await future
+                if extracted is not None:
+                    extracted = copy.deepcopy(extracted)
+                return index, filename, extracted, extracted is not None, error
+
+        future = asyncio.get_running_loop().create_future()
+        in_flight.append((prepared.image_hash, future))
+        outcome = (
+            None,
+            (status.HTTP_500_INTERNAL_SERVER_ERROR, "图片识别已取消"),
+        )
+        try:
+            async with semaphore:
+                check_llm_quota(user_id, "image")
+                extracted = await run_in_threadpool(call_image_model, prepared, user_id)
+            outcome = (extracted, None)
+        except QuotaExceededError as e:
+            outcome = (None, (status.HTTP_429_TOO_MANY_REQUESTS, e.message))
+        except Exception as e:
+            print(f"第{index + 1}张图片识别失败: {type(e).__name__}: {str(e)}")
+            outcome = (
+                None,
+                (status.HTTP_500_INTERNAL_SERVER_ERROR, f"图片识别失败: {str(e)}"),
+            )
+        finally:
+            # 取消时也要设置结果，避免等待同一图片的任务一直挂起
+            future.set_result(outcome)
+        return index, filename, outcome[0], False, outcome[1]
+
+    async def event_stream():
+        tasks = [asyncio.ensure_future(recognize_one(*upload)) for upload in uploads]
+        pending = []
+        failed = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, filename, extracted, deduplicated, error = await next_done
+                if error:
+                    failed += 1
+                    yield format_sse(
+                        "error",
+                        {
+                            "index": index,
+                            "filename": filename,
+                            "status_code": error[0],
+                            "detail": error[1],
+                        },
+                    )
+                    continue
+
+                try:
+                    # 数据库写入是同步的，放到线程池中执行，避免阻塞事件循环
+                    result = await run_in_threadpool(
+                        save_image_recognition_result,
+                        db,
+                        user_id,
+                        extracted,
+                        deduplicated,
+                    )
+                except Exception as e:
+                    db.rollback()
+                    print(f"保存第{index + 1}张图片的识别结果失败: {str(e)}")
+                    failed += 1
+                    yield format_sse(
+                        "error",
+                        {
+                            "index": index,
+                            "filename": filename,
+                            "status_code": status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            "detail": f"保存识别结果失败: {str(e)}",
+                        },
+                    )
+                    continue
+                item = {
+                    "index": index,
+                    "message_id": result["message_id"],
+                    "draft_id": result["draft_id"],
+                    "extracted_info": extracted,
+                }
+                pending.append(item)
+                yield format_sse(
+                    "result",
+                    dict(item, filename=filename, deduplicated=deduplicated),
+                )
+        finally:
+            # 客户端断开时取消尚未完成的识别
+            for task in tasks:
+                task.cancel()
+
+        pending.sort(key=lambda item: item["index"])
+        print(f"批量图片识别完成: 成功 {len(pending)} 张, 失败 {failed} 张")
+        yield format_sse(
+            "done", {"pending": pending, "succeeded": len(pending), "failed": failed}
+        )
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -8,6 +8,12 @@ from datetime import datetime, date, timedelta
 from ..models.database import get_db
 from ..models.models import Transaction, User, TransactionType
 from .users import get_current_user
+from ..services.llm_usage import QuotaExceededError, check_llm_quota
+from ..services.report_queries import (
+    query_category_ranking,
+    query_summary,
+    query_transaction_ranking,
+)
 from ..services.spending_habits import analyze_spending_habits
 
 router = APIRouter()
@@ -74,146 +80,9 @@ def get_summary(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    # 如果未指定日期，默认查询当月数据
-    if not start_date:
-        today = date.today()
-        start_date = date(today.year, today.month, 1)
-    if not end_date:
-        today = date.today()
-        # 获取下个月的第一天，然后减去一天得到当月最后一天
-        if today.month == 12:
-            end_date = date(today.year + 1, 1, 1) - timedelta(days=1)
-        else:
-            end_date = date(today.year, today.month + 1, 1) - timedelta(days=1)
-
-    # 确保参数是date类型而不是datetime类型
-    if isinstance(start_date, datetime):
-        start_date = start_date.date()
-    if isinstance(end_date, datetime):
-        end_date = end_date.date()
-
-    # 修复日期范围查询
-    print(f"[Summary] Using date range: {start_date} to {end_date}")
-
-    # 创建下一天日期，用于查询条件
-    next_day = end_date + timedelta(days=1)
-    print(
-        f"[Summary] Using < {next_day} instead of <= {end_date} for end date condition"
-    )
-
-    # 查询总收入
-    total_income = (
-        db.query(func.sum(Transaction.amount))
-        .filter(
-            Transaction.user_id == current_user.id,
-            Transaction.type == TransactionType.INCOME,
-            Transaction.is_deleted == False,
-            Transaction.transaction_date >= start_date,
-            Transaction.transaction_date
-            < next_day,  # 使用 < next_day 而不是 <= end_date
-        )
-        .scalar()
-        or 0.0
-    )
-
-    # 查询总支出
-    total_expense = (
-        db.query(func.sum(Transaction.amount))
-        .filter(
-            Transaction.user_id == current_user.id,
-            Transaction.type == TransactionType.EXPENSE,
-            Transaction.is_deleted == False,
-            Transaction.transaction_date >= start_date,
-            Transaction.transaction_date
-            < next_day,  # 使用 < next_day 而不是 <= end_date
-        )
-        .scalar()
-        or 0.0
-    )
-
-    # 计算结余
-    balance = total_income - total_expense
-
-    # 获取交易统计信息
-    transaction_stats = None
-    if include_stats:
-        print("[Summary] Including transaction statistics")
-
-        # 查询交易总笔数
-        total_count = (
-            db.query(func.count(Transaction.id))
-            .filter(
-                Transaction.user_id == current_user.id,
-                Transaction.is_deleted == False,
-                Transaction.transaction_date >= start_date,
-                Transaction.transaction_date < next_day,
-            )
-            .scalar()
-            or 0
-        )
-
-        # 查询收入交易笔数和总金额
-        income_query = (
-            db.query(
-                func.count(Transaction.id).label("count"),
-                func.sum(Transaction.amount).label("sum"),
-            )
-            .filter(
-                Transaction.user_id == current_user.id,
-                Transaction.type == TransactionType.INCOME,
-                Transaction.is_deleted == False,
-                Transaction.transaction_date >= start_date,
-                Transaction.transaction_date < next_day,
-            )
-            .first()
-        )
-
-        income_count = income_query.count or 0
-        income_sum = income_query.sum or 0
-
-        # 查询支出交易笔数和总金额
-        expense_query = (
-            db.query(
-                func.count(Transaction.id).label("count"),
-                func.sum(Transaction.amount).label("sum"),
-            )
-            .filter(
-                Transaction.user_id == current_user.id,
-                Transaction.type == TransactionType.EXPENSE,
-                Transaction.is_deleted == False,
-                Transaction.transaction_date >= start_date,
-                Transaction.transaction_date < next_day,
-            )
-            .first()
-        )
-
-        expense_count = expense_query.count or 0
-        expense_sum = expense_query.sum or 0
-
-        # 计算平均每笔金额
-        avg_income = income_sum / income_count if income_count > 0 else 0
-        avg_expense = expense_sum / expense_count if expense_count > 0 else 0
-
-        # 计算日均交易笔数
-        days_count = (end_date - start_date).days + 1
-        daily_avg = total_count / days_count if days_count > 0 else 0
-
-        transaction_stats = {
-            "total_count": total_count,
-            "income_count": income_count,
-            "expense_count": expense_count,
-            "avg_income": avg_income,
-            "avg_expense": avg_expense,
-            "daily_avg": round(daily_avg, 1),
-        }
-
+    # 未指定日期时默认查询当月数据
     return TotalSummary(
-        total_income=total_income,
-        total_expense=total_expense,
-        balance=balance,
-        start_date=start_date,
-        end_date=end_date,
-        transaction_stats=transaction_stats,
+        **query_summary(db, current_user.id, start_date, end_date, include_stats)
     )
 
 
@@ -339,84 +208,14 @@ def get_category_ranking(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    # 如果未指定日期，默认查询当月数据
-    if not start_date:
-        today = date.today()
-        start_date = date(today.year, today.month, 1)
-    if not end_date:
-        today = date.today()
-        if today.month == 12:
-            end_date = date(today.year + 1, 1, 1) - timedelta(days=1)
-        else:
-            end_date = date(today.year, today.month + 1, 1) - timedelta(days=1)
-
-    # 确保参数是date类型而不是datetime类型
-    if isinstance(start_date, datetime):
-        start_date = start_date.date()
-    if isinstance(end_date, datetime):
-        end_date = end_date.date()
-
-    # 修复日期范围查询
-    print(f"[Category Ranking] Using date range: {start_date} to {end_date}")
-
-    # 创建下一天日期，用于查询条件
-    next_day = end_date + timedelta(days=1)
-    print(
-        f"[Category Ranking] Using < {next_day} instead of <= {end_date} for end date condition"
-    )
-
     try:
-        # 查询所有满足条件的交易记录总金额
-        total_amount_query = db.query(func.sum(Transaction.amount)).filter(
-            Transaction.user_id == current_user.id,
-            Transaction.type == transaction_type,
-            Transaction.is_deleted == False,
-            Transaction.transaction_date >= start_date,
-            Transaction.transaction_date
-            < next_day,  # 使用 < next_day 而不是 <= end_date
-        )
-        total_amount = total_amount_query.scalar() or 0
-
-        # 查询每个类别的总金额和记录数量
-        category_stats = (
-            db.query(
-                Transaction.category,
-                func.sum(Transaction.amount).label("total_amount"),
-                func.count(Transaction.id).label("count"),
+        # 未指定日期时默认查询当月数据
+        return [
+            CategorySummary(**item)
+            for item in query_category_ranking(
+                db, current_user.id, transaction_type, start_date, end_date
             )
-            .filter(
-                Transaction.user_id == current_user.id,
-                Transaction.type == transaction_type,
-                Transaction.is_deleted == False,
-                Transaction.transaction_date >= start_date,
-                Transaction.transaction_date
-                < next_day,  # 使用 < next_day 而不是 <= end_date
-            )
-            .group_by(Transaction.category)
-            .order_by(desc("total_amount"))
-            .all()
-        )
-
-        # 准备返回数据，计算百分比
-        result = []
-        for item in category_stats:
-            category = item.category or "未分类"
-            amount = float(item.total_amount)
-            count = item.count
-            percentage = (
-                round((amount / total_amount * 100), 2) if total_amount > 0 else 0
-            )
-
-            result.append(
-                CategorySummary(
-                    category=category,
-                    total_amount=amount,
-                    percentage=percentage,
-                    count=count,
-                )
-            )
-
-        return result
+        ]
     except Exception as e:
         print(f"Error in get_category_ranking: {str(e)}")
         raise HTTPException(
@@ -437,82 +236,19 @@ def get_transaction_ranking(
     current_user: User = Depends(get_current_user),
 ):
     try:
-        # 如果未指定日期，默认查询当月数据
-        if not start_date:
-            today = date.today()
-            start_date = date(today.year, today.month, 1)
-        if not end_date:
-            today = date.today()
-            if today.month == 12:
-                end_date = date(today.year + 1, 1, 1) - timedelta(days=1)
-            else:
-                end_date = date(today.year, today.month + 1, 1) - timedelta(days=1)
-
-        # 确保参数是date类型而不是datetime类型
-        if isinstance(start_date, datetime):
-            start_date = start_date.date()
-        if isinstance(end_date, datetime):
-            end_date = end_date.date()
-
-        # 修复日期范围查询
-        print(f"[Transaction Ranking] Using date range: {start_date} to {end_date}")
-
-        # 创建下一天日期，用于查询条件
-        next_day = end_date + timedelta(days=1)
-        print(
-            f"[Transaction Ranking] Using < {next_day} instead of <= {end_date} for end date condition"
-        )
-
-        # 查询交易记录，按金额降序排列
-        transactions = (
-            db.query(
-                Transaction.id,
-                Transaction.transaction_date,
-                Transaction.description,
-                Transaction.category,
-                Transaction.amount,
-                Transaction.type,
-            )
-            .filter(
-                Transaction.user_id == current_user.id,
-                Transaction.type == transaction_type,
-                Transaction.is_deleted == False,
-                Transaction.transaction_date >= start_date,
-                Transaction.transaction_date
-                < next_day,  # 使用 < next_day 而不是 <= end_date
-            )
-            .order_by(desc(Transaction.amount))
-            .limit(limit)
-            .all()
-        )
-
-        # 记录找到的交易记录及其日期
-        print(f"[Transaction Ranking] Found {len(transactions)} transactions")
-        for tx in transactions:
-            print(
-                f"[Transaction Ranking] Transaction date: {tx.transaction_date}, amount: {tx.amount}"
+        # 未指定日期时默认查询当月数据
+        return [
+            DetailedTransaction(**item)
+            for item in query_transaction_ranking(
+                db,
+                current_user.id,
+                transaction_type,
+                start_date,
+                end_date,
+                limit,
+                category,
             )
-
-        # 整理数据
-        result = []
-        for tx in transactions:
-            # 确保日期是date类型
-            tx_date = tx.transaction_date
-            if isinstance(tx_date, datetime):
-                tx_date = tx_date.date()
-
-            result.append(
-                DetailedTransaction(
-                    id=tx.id,
-                    date=tx_date,
-                    description=tx.description or "",
-                    category=tx.category or "未分类",
-                    amount=tx.amount,
-                    transaction_type=tx.type,
-                )
-            )
-
-        return result
+        ]
     except Exception as e:
         # 记录错误并返回友好错误信息
         print(f"Error in get_transaction_ranking: {str(e)}")
@@ -780,6 +516,14 @@ def get_spending_habits(
     current_user: User = Depends(get_current_user),
 ):
     """分析用户消费习惯"""
+    try:
+        check_llm_quota(current_user.id, "analysis")
+    except QuotaExceededError as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=e.message,
+            headers={"Retry-After": str(e.retry_after)},
+        )
     try:
         # 调用消费习惯分析服务
         habits_analysis = analyze_spending_habits(
@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from typing import List, Optional, Dict, Any
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from passlib.context import CryptContext
@@ -9,7 +9,9 @@ from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 import os
 
 from ..models.database import get_db
-from ..models.models import User, AIPersonality
+from ..models.models import User
+from ..services.auto_commit import AUTO_COMMIT_THRESHOLD
+from ..services.personality_registry import personality_registry
 
 router = APIRouter()
 
@@ -55,6 +57,9 @@ class TokenData(BaseModel):
 
 class UserSettings(BaseModel):
     personality_id: Optional[int] = None
+    # 高置信度的提取结果是否直接记账，以及生效的置信度阈值
+    auto_commit_transactions: bool = False
+    auto_commit_threshold: float = AUTO_COMMIT_THRESHOLD
 
 
 class PersonalityUpdate(BaseModel):
@@ -68,6 +73,10 @@ class PasswordUpdate(BaseModel):
 
 class UserSettingsUpdate(BaseModel):
     email: Optional[str] = None
+    personality_id: Optional[int] = None
+    auto_commit_transactions: Optional[bool] = None
+    # 阈值过低时容易把识别错误的交易直接记账，限制在0.5到1之间
+    auto_commit_threshold: Optional[float] = Field(None, ge=0.5, le=1.0)
 
 
 class AccountDelete(BaseModel):
@@ -115,6 +124,10 @@ def get_current_user(db: Session = Depends(get_db), token: str = Depends(token_s
     try:
         print(f"尝试解码Token...")
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        # 登录令牌没有 typ 声明，撤销令牌等其他用途的令牌不能用于登录
+        if payload.get("typ") is not None:
+            print(f"错误: 不是登录令牌")
+            raise credentials_exception
         username: str = payload.get("sub")
         print(f"Token中的用户名: {username}")
 
@@ -302,6 +315,16 @@ def update_user_settings(
 
         current_user.email = settings.email
 
+    if settings.personality_id is not None:
+        if not personality_registry.exists(settings.personality_id):
+            raise HTTPException(status_code=404, detail="助手ID不存在")
+        current_user.personality_id = settings.personality_id
+
+    if settings.auto_commit_transactions is not None:
+        current_user.auto_commit_transactions = settings.auto_commit_transactions
+    if settings.auto_commit_threshold is not None:
+        current_user.auto_commit_threshold = settings.auto_commit_threshold
+
     db.commit()
     return {"message": "用户设置已更新"}
 
@@ -331,12 +354,18 @@ def get_user_settings(
     db: Session = Depends(get_db), current_user: User = Depends(get_current_user)
 ):
     """获取用户设置，包括当前选择的AI助手等"""
-    default_personality = (
-        db.query(AIPersonality).filter(AIPersonality.is_default == True).first()
-    )
-    personality_id = default_personality.id if default_personality else 1
+    # 用户未选择或选择的助手已不存在时返回默认助手
+    personality_id = personality_registry.resolve_id(current_user.personality_id)
 
-    return {"personality_id": personality_id}
+    return {
+        "personality_id": personality_id,
+        "auto_commit_transactions": bool(current_user.auto_commit_transactions),
+        "auto_commit_threshold": (
+            current_user.auto_commit_threshold
+            if current_user.auto_commit_threshold is not None
+            else AUTO_COMMIT_THRESHOLD
+        ),
+    }
 
 
 @router.post("/settings/personality", response_model=Dict[str, Any])
@@ -346,17 +375,14 @@ def update_user_personality(
     current_user: User = Depends(get_current_user),
 ):
     """更新用户选择的AI助手"""
-    # 验证提供的personality_id是否有效
-    db_personality = (
-        db.query(AIPersonality)
-        .filter(AIPersonality.id == personality.personality_id)
-        .first()
-    )
-    if not db_personality:
+    # 助手ID从内存注册表验证，聊天时按用户设置的助手回复
+    if not personality_registry.exists(personality.personality_id):
         raise HTTPException(status_code=404, detail="助手ID不存在")
 
-    # 由于当前User模型中没有personality_id字段，返回未实现错误
-    raise HTTPException(
-        status_code=status.HTTP_501_NOT_IMPLEMENTED,
-        detail="服务器尚未实现此功能，需要添加personality_id字段到用户表",
-    )
+    current_user.personality_id = personality.personality_id
+    db.commit()
+
+    return {
+        "message": "AI助手已更新",
+        "personality_id": personality.personality_id,
+    }
@@ -0,0 +1,142 @@
+"""
+高置信度提取结果自动记账
+
+用户开启自动记账后，置信度不低于阈值、没有缺失字段的大模型提取结果在聊天请求的写入事务中
+直接写入交易表，不再生成草稿等待 /chat/confirm-transaction，每条记账消息少一次请求。
+响应附带撤销令牌，用户撤销时凭令牌软删除这些交易，只执行一条UPDATE。
+撤销令牌使用单独的签名密钥并带有 typ 声明，不能当作登录令牌使用。
+"""
+
+import hashlib
+import hmac
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from jose import JWTError, jwt
+from sqlalchemy.orm import Session
+
+from ..models.models import Transaction
+
+# 用户未设置阈值时使用的默认置信度阈值
+AUTO_COMMIT_THRESHOLD = float(os.getenv("AUTO_COMMIT_THRESHOLD", "0.95"))
+# 撤销令牌的有效期（分钟）
+AUTO_COMMIT_UNDO_MINUTES = int(os.getenv("AUTO_COMMIT_UNDO_MINUTES", "30"))
+# 撤销令牌的签名密钥，未设置时由登录令牌的密钥派生
+UNDO_TOKEN_SECRET = os.getenv("UNDO_TOKEN_SECRET")
+
+# 撤销令牌的 typ 声明，登录令牌没有该声明
+UNDO_TOKEN_TYPE = "undo"
+# 自动记账要求提取结果包含的字段
+REQUIRED_FIELDS = ("type", "amount", "description", "category", "date")
+# 可以自动记账的提取来源：本地规则的置信度是启发式打分，与模型给出的置信度不可比，只生成草稿
+AUTO_COMMIT_SOURCES = ("llm",)
+
+
+class InvalidUndoTokenError(Exception):
+    """撤销令牌无效、已过期或不属于当前用户"""
+
+
+def auto_commit_threshold(user) -> Optional[float]:
+    """用户开启自动记账时返回生效的置信度阈值，未开启时返回None"""
+    if not getattr(user, "auto_commit_transactions", False):
+        return None
+    threshold = getattr(user, "auto_commit_threshold", None)
+    return threshold if threshold is not None else AUTO_COMMIT_THRESHOLD
+
+
+def is_auto_committable(item: Dict[str, Any], threshold: float) -> bool:
+    """单笔提取结果是否可以直接记账：来自大模型、字段完整、没有缺失字段且置信度不低于阈值"""
+    if item.get("source") not in AUTO_COMMIT_SOURCES:
+        return False
+    if item.get("missing_fields"):
+        return False
+    if any(item.get(field) in (None, "") for field in REQUIRED_FIELDS):
+        return False
+    try:
+        confidence = float(item.get("confidence"))
+        amount = float(item["amount"])
+    except (TypeError, ValueError):
+        return False
+    return confidence >= threshold and amount > 0
+
+
+def _undo_token_key() -> str:
+    """撤销令牌的签名密钥，与登录令牌的密钥不同"""
+    if UNDO_TOKEN_SECRET:
+        return UNDO_TOKEN_SECRET
+    from ..routers.users import SECRET_KEY
+
+    return hmac.new(
+        SECRET_KEY.encode("utf-8"), b"auto-commit-undo", hashlib.sha256
+    ).hexdigest()
+
+
+def create_undo_token(
+    user_id: int,
+    transaction_ids: List[int],
+    expires_minutes: int = AUTO_COMMIT_UNDO_MINUTES,
+) -> str:
+    """生成撤销自动记账的令牌，令牌中包含用户ID和交易ID，撤销时不需要额外查询"""
+    from ..routers.users import ALGORITHM
+
+    payload = {
+        "typ": UNDO_TOKEN_TYPE,
+        "uid": user_id,
+        "tx": list(transaction_ids),
+        "exp": datetime.utcnow() + timedelta(minutes=expires_minutes),
+    }
+    return jwt.encode(payload, _undo_token_key(), algorithm=ALGORITHM)
+
+
+def undo_auto_commit(db: Session, user_id: int, token: str) -> List[Transaction]:
+    """
+    撤销自动记账，软删除令牌中的交易（不提交）
+
+    每笔交易按未删除的条件单独更新，并发撤销同一令牌时每笔交易只会被其中一次撤销，
+    调用方据此回退分类器的学习。
+
+    Returns:
+        list: 本次软删除的交易，已经撤销或删除过的交易不包含在内
+
+    Raises:
+        InvalidUndoTokenError: 令牌无效、已过期或不属于该用户
+    """
+    from ..routers.users import ALGORITHM
+
+    try:
+        payload = jwt.decode(token, _undo_token_key(), algorithms=[ALGORITHM])
+    except JWTError as e:
+        raise InvalidUndoTokenError("撤销令牌无效或已过期") from e
+
+    transaction_ids = payload.get("tx")
+    if (
+        payload.get("typ") != UNDO_TOKEN_TYPE
+        or payload.get("uid") != user_id
+        or not isinstance(transaction_ids, list)
+    ):
+        raise InvalidUndoTokenError("撤销令牌无效或已过期")
+
+    transactions = (
+        db.query(Transaction)
+        .filter(
+            Transaction.user_id == user_id,
+            Transaction.id.in_(transaction_ids),
+            Transaction.is_deleted == False,
+        )
+        .all()
+    )
+    now = datetime.utcnow()
+    undone = []
+    for transaction in transactions:
+        updated = (
+            db.query(Transaction)
+            .filter(Transaction.id == transaction.id, Transaction.is_deleted == False)
+            .update(
+                {Transaction.is_deleted: True, Transaction.updated_at: now},
+                synchronize_session=False,
+            )
+        )
+        if updated == 1:
+            undone.append(transaction)
+    return undone
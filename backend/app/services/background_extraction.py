@@ -0,0 +1,224 @@
+"""
+后台记账信息提取
+
+后台提取模式下聊天接口生成回复后立即返回，提取在线程池中继续执行，
+完成后把草稿写入数据库，结果通过轮询接口或SSE推送给客户端。
+用户开启自动记账时，符合条件的交易在同一事务中直接记账，结果中附带撤销令牌。
+用户感受到的延迟只取决于回复本身，不再等待提取。
+
+任务保存在进程内，按AI回复的消息ID查找，完成后保留 EXTRACTION_JOB_TTL 秒；
+任务状态同时写入AI回复的 extraction_status 列，与草稿在同一事务中提交，
+多进程部署时请求落到别的进程，由调用方根据该列和草稿表返回结果。
+"""
+
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from ..models.database import SessionLocal
+from ..models.models import ChatMessage
+from .transaction_drafts import create_drafts
+
+# 是否默认使用后台提取，单次请求可以用 background_extraction 字段覆盖
+CHAT_BACKGROUND_EXTRACTION = (
+    os.getenv("CHAT_BACKGROUND_EXTRACTION", "false").lower() == "true"
+)
+# 后台提取的线程数
+BACKGROUND_EXTRACTION_WORKERS = int(os.getenv("BACKGROUND_EXTRACTION_WORKERS", "4"))
+# 已完成任务的保留时间（秒）
+EXTRACTION_JOB_TTL = int(os.getenv("EXTRACTION_JOB_TTL", "600"))
+# 内存中最多保留的任务数
+EXTRACTION_JOB_MAX = 10000
+
+# 自动记账钩子: 参数为任务的数据库会话和提取结果，把可直接记账的交易写入会话（不提交），
+# 返回 (仍需确认的提取结果或None, 序列化的交易列表, 撤销令牌, 事务提交后执行的回调或None)
+AutoCommitHook = Callable[
+    [Session, Optional[Dict[str, Any]]],
+    Tuple[
+        Optional[Dict[str, Any]],
+        List[Dict[str, Any]],
+        Optional[str],
+        Optional[Callable[[], None]],
+    ],
+]
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+def set_extraction_status(db: Session, message_id: int, status: str):
+    """更新AI回复的后台提取状态（不提交）"""
+    db.query(ChatMessage).filter(ChatMessage.id == message_id).update(
+        {ChatMessage.extraction_status: status}, synchronize_session=False
+    )
+
+
+class ExtractionJob:
+    """一次后台提取任务"""
+
+    def __init__(self, user_id: int, message_id: int):
+        self.user_id = user_id
+        self.message_id = message_id
+        self.status = PENDING
+        self.extracted_info: Optional[Dict[str, Any]] = None
+        self.draft_ids: List[int] = []
+        self.auto_committed_transactions: List[Dict[str, Any]] = []
+        self.undo_token: Optional[str] = None
+        self.error: Optional[str] = None
+        self.finished_at: Optional[float] = None
+        # 任务完成时设置结果，SSE接口等待它
+        self.future: Future = Future()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "message_id": self.message_id,
+            "status": self.status,
+            "extracted_info": self.extracted_info,
+            "needs_confirmation": self.extracted_info is not None,
+            "draft_id": self.draft_ids[0] if self.draft_ids else None,
+            "draft_ids": list(self.draft_ids),
+            "auto_committed_transactions": list(self.auto_committed_transactions),
+            "undo_token": self.undo_token,
+            "error": self.error,
+        }
+
+
+class BackgroundExtractor:
+    """后台提取任务的执行和状态查询，线程安全"""
+
+    def __init__(
+        self,
+        workers: int = BACKGROUND_EXTRACTION_WORKERS,
+        session_factory: Callable[[], Session] = SessionLocal,
+        ttl: int = EXTRACTION_JOB_TTL,
+        max_jobs: int = EXTRACTION_JOB_MAX,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="background-extraction"
+        )
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.clock = clock
+        self._lock = threading.Lock()
+        # message_id -> ExtractionJob，按提交顺序
+        self._jobs: "OrderedDict[int, ExtractionJob]" = OrderedDict()
+        self.completed = 0
+        self.failed = 0
+
+    def _evict(self):
+        now = self.clock()
+        while self._jobs:
+            job = next(iter(self._jobs.values()))
+            expired = job.finished_at is not None and now - job.finished_at > self.ttl
+            if not expired and len(self._jobs) <= self.max_jobs:
+                break
+            self._jobs.popitem(last=False)
+
+    def submit(
+        self,
+        user_id: int,
+        message_id: int,
+        extract: Callable[[Session], Optional[Dict[str, Any]]],
+        auto_commit: Optional[AutoCommitHook] = None,
+    ) -> ExtractionJob:
+        """
+        提交一个后台提取任务
+
+        Args:
+            user_id: 用户ID
+            message_id: AI回复的消息ID，草稿关联到该消息
+            extract: 提取函数，参数为任务自己的数据库会话，返回提取结果或None
+            auto_commit: 自动记账钩子，用户未开启自动记账时为None
+
+        Returns:
+            ExtractionJob: 任务
+        """
+        job = ExtractionJob(user_id, message_id)
+        with self._lock:
+            self._evict()
+            self._jobs[message_id] = job
+        self.executor.submit(self._run, job, extract, auto_commit)
+        return job
+
+    def _run(self, job: ExtractionJob, extract, auto_commit=None):
+        db = self.session_factory()
+        try:
+            extracted_info = extract(db)
+            auto_committed, undo_token, after_commit = [], None, None
+            if auto_commit is not None:
+                extracted_info, auto_committed, undo_token, after_commit = auto_commit(
+                    db, extracted_info
+                )
+            drafts = (
+                create_drafts(db, job.user_id, extracted_info, job.message_id)
+                if extracted_info is not None
+                else []
+            )
+            draft_ids = [draft.id for draft in drafts]
+            set_extraction_status(db, job.message_id, DONE)
+            db.commit()
+            if after_commit is not None:
+                after_commit()
+            job.extracted_info = extracted_info
+            job.draft_ids = draft_ids
+            job.auto_committed_transactions = auto_committed
+            job.undo_token = undo_token
+            job.status = DONE
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            db.rollback()
+            print(f"[Extraction] 消息 {job.message_id} 后台提取失败: {str(e)}")
+            print(f"错误堆栈:\n{traceback.format_exc()}")
+            try:
+                set_extraction_status(db, job.message_id, FAILED)
+                db.commit()
+            except Exception as status_error:
+                db.rollback()
+                print(f"[Extraction] 记录提取失败状态出错: {str(status_error)}")
+            job.error = str(e)
+            job.status = FAILED
+            with self._lock:
+                self.failed += 1
+        finally:
+            db.close()
+            job.finished_at = self.clock()
+            job.future.set_result(job)
+
+    def get(self, user_id: int, message_id: int) -> Optional[ExtractionJob]:
+        """获取用户的提取任务，不存在、已清理或不属于该用户时返回None"""
+        with self._lock:
+            self._evict()
+            job = self._jobs.get(message_id)
+        if job is None or job.user_id != user_id:
+            return None
+        return job
+
+    def clear(self):
+        with self._lock:
+            self._jobs.clear()
+            self.completed = self.failed = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "jobs": len(self._jobs),
+                "pending": sum(
+                    1 for job in self._jobs.values() if job.status == PENDING
+                ),
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+
+# 全局共享的后台提取
+background_extractor = BackgroundExtractor()
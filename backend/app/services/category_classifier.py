@@ -0,0 +1,259 @@
+"""
+按用户学习的交易分类器
+
+基于字符n-gram的多项式朴素贝叶斯，从用户已确认的交易中增量学习"描述 → 分类"的习惯，
+用于修正或补全记账信息提取中的分类，置信度足够高时可以跳过大模型调用。
+"""
+
+import math
+import os
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from ..models.models import Transaction
+
+# 分类预测概率达到该阈值才采用
+CLASSIFIER_THRESHOLD = float(os.getenv("CLASSIFIER_THRESHOLD", "0.8"))
+# 描述中训练时见过的特征至少占这个比例才预测，避免一个主要分类吸收无关的描述
+CLASSIFIER_MIN_KNOWN_SHARE = float(os.getenv("CLASSIFIER_MIN_KNOWN_SHARE", "0.5"))
+# 至少学习过这么多条交易才开始预测
+CLASSIFIER_MIN_SAMPLES = int(os.getenv("CLASSIFIER_MIN_SAMPLES", "5"))
+# 内存中最多保留的用户分类器数量
+CLASSIFIER_MAX_USERS = int(os.getenv("CLASSIFIER_MAX_USERS", "1000"))
+# 首次加载时从数据库读取的历史交易数量
+CLASSIFIER_BOOTSTRAP_LIMIT = 500
+
+
+def _normalize(text: str) -> str:
+    """去掉数字、标点和空白，只保留描述中的文字"""
+    return re.sub(r"[\d\s.,，。!！?？:：;；、¥￥]+", "", text or "").lower()
+
+
+def _features(text: str):
+    """字符unigram和bigram特征"""
+    text = _normalize(text)
+    features = list(text)
+    features.extend(text[i : i + 2] for i in range(len(text) - 1))
+    return features
+
+
+class NaiveBayesCategoryClassifier:
+    """
+    字符n-gram多项式朴素贝叶斯分类器，支持增量学习
+
+    学习和预测可能在不同线程中同时进行（确认交易和提取记账信息），计数字典的读写都持有
+    实例锁，否则预测遍历字典时可能因为学习插入新分类而出错。
+    """
+
+    def __init__(self, alpha: float = 1.0):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self.sample_count = 0
+        self.category_counts: Dict[str, int] = defaultdict(int)
+        self.feature_counts: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: defaultdict(int)
+        )
+        self.feature_totals: Dict[str, int] = defaultdict(int)
+        self.vocabulary = set()
+        # 每个分类对应的交易类型计数，用于预测时一并给出类型
+        self.type_counts: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: defaultdict(int)
+        )
+
+    def learn(self, description: str, category: str, transaction_type: str = None):
+        """学习一条已确认的交易"""
+        features = _features(description)
+        if not features or not category:
+            return
+
+        with self._lock:
+            self.sample_count += 1
+            self.category_counts[category] += 1
+            for feature in features:
+                self.feature_counts[category][feature] += 1
+                self.feature_totals[category] += 1
+                self.vocabulary.add(feature)
+            if transaction_type:
+                self.type_counts[category][transaction_type] += 1
+
+    def unlearn(self, description: str, category: str, transaction_type: str = None):
+        """撤销一条学习过的交易，如撤销的自动记账"""
+        features = _features(description)
+        if not features:
+            return
+
+        with self._lock:
+            if self.category_counts.get(category, 0) <= 0:
+                return
+            self.sample_count -= 1
+            self.category_counts[category] -= 1
+            if not self.category_counts[category]:
+                del self.category_counts[category]
+            counts = self.feature_counts[category]
+            for feature in features:
+                if counts.get(feature, 0) <= 0:
+                    continue
+                counts[feature] -= 1
+                self.feature_totals[category] -= 1
+                if not counts[feature]:
+                    del counts[feature]
+                    # 其他分类也没有该特征时从词表中移除
+                    if not any(
+                        feature in other for other in self.feature_counts.values()
+                    ):
+                        self.vocabulary.discard(feature)
+            types = self.type_counts.get(category)
+            if transaction_type and types and types.get(transaction_type, 0) > 0:
+                types[transaction_type] -= 1
+                if not types[transaction_type]:
+                    del types[transaction_type]
+
+    def predict(self, description: str) -> Tuple[Optional[str], float]:
+        """
+        预测描述对应的分类
+
+        Returns:
+            tuple: (分类, 后验概率)，样本不足、描述为空或描述中大部分特征没有见过时返回(None, 0.0)
+        """
+        features = _features(description)
+        if not features:
+            return None, 0.0
+
+        with self._lock:
+            if self.sample_count < CLASSIFIER_MIN_SAMPLES:
+                return None, 0.0
+
+            # 后验只在已学习的分类之间归一化，描述大部分没见过时概率仍可能接近1，
+            # 因此要求足够比例的特征在训练中出现过
+            known = [feature for feature in features if feature in self.vocabulary]
+            if len(known) < len(features) * CLASSIFIER_MIN_KNOWN_SHARE:
+                return None, 0.0
+
+            # 未见过的特征也参与平滑后的似然计算
+            vocabulary_size = len(self.vocabulary.union(features))
+            scores = {}
+            for category, count in self.category_counts.items():
+                score = math.log(count / self.sample_count)
+                denominator = (
+                    self.feature_totals.get(category, 0) + self.alpha * vocabulary_size
+                )
+                counts = self.feature_counts.get(category, {})
+                for feature in features:
+                    score += math.log(
+                        (counts.get(feature, 0) + self.alpha) / denominator
+                    )
+                scores[category] = score
+
+        best = max(scores, key=scores.get)
+        # 归一化得到后验概率
+        max_score = scores[best]
+        total = sum(math.exp(score - max_score) for score in scores.values())
+        return best, 1.0 / total
+
+    def predict_type(self, category: str) -> Optional[str]:
+        """返回该分类下最常见的交易类型"""
+        with self._lock:
+            counts = self.type_counts.get(category)
+            if not counts:
+                return None
+            return max(counts, key=counts.get)
+
+
+_classifiers: "OrderedDict[int, NaiveBayesCategoryClassifier]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_user_classifier(user_id: int, db: Session) -> NaiveBayesCategoryClassifier:
+    """
+    获取用户的分类器，首次使用时从该用户的历史交易中加载
+
+    Args:
+        user_id: 用户ID
+        db: 数据库会话
+
+    Returns:
+        NaiveBayesCategoryClassifier: 用户分类器
+    """
+    with _lock:
+        classifier = _classifiers.get(user_id)
+        if classifier is not None:
+            _classifiers.move_to_end(user_id)
+            return classifier
+
+    classifier = NaiveBayesCategoryClassifier()
+    rows = (
+        db.query(Transaction.description, Transaction.category, Transaction.type)
+        .filter(Transaction.user_id == user_id, Transaction.is_deleted == False)
+        .order_by(Transaction.id.desc())
+        .limit(CLASSIFIER_BOOTSTRAP_LIMIT)
+        .all()
+    )
+    for description, category, transaction_type in rows:
+        classifier.learn(
+            description,
+            category,
+            transaction_type.value if transaction_type else None,
+        )
+    print(
+        f"[Classifier] 用户 {user_id} 的分类器已加载，样本数: {classifier.sample_count}"
+    )
+
+    with _lock:
+        # 并发加载时保留先完成的那个
+        existing = _classifiers.get(user_id)
+        if existing is not None:
+            return existing
+        _classifiers[user_id] = classifier
+        while len(_classifiers) > CLASSIFIER_MAX_USERS:
+            _classifiers.popitem(last=False)
+    return classifier
+
+
+def learn_transaction(
+    user_id: int, description: str, category: str, transaction_type: str = None
+):
+    """
+    用户确认交易后增量更新分类器
+
+    未加载过的用户不做处理，下次使用时会从数据库完整加载。
+    """
+    with _lock:
+        classifier = _classifiers.get(user_id)
+    if classifier is not None:
+        classifier.learn(description, category, transaction_type)
+
+
+def unlearn_transaction(
+    user_id: int, description: str, category: str, transaction_type: str = None
+):
+    """撤销已学习的交易后回退分类器，未加载过的用户不做处理"""
+    with _lock:
+        classifier = _classifiers.get(user_id)
+    if classifier is not None:
+        classifier.unlearn(description, category, transaction_type)
+
+
+def classify(
+    user_id: int, db: Session, description: str
+) -> Tuple[Optional[str], Optional[str], float]:
+    """
+    用用户分类器预测分类
+
+    Returns:
+        tuple: (分类, 交易类型, 概率)，概率低于阈值时分类为None
+    """
+    classifier = get_user_classifier(user_id, db)
+    category, probability = classifier.predict(description)
+    if category is None or probability < CLASSIFIER_THRESHOLD:
+        return None, None, probability
+    return category, classifier.predict_type(category), probability
+
+
+def reset_classifiers():
+    """清空内存中的所有分类器"""
+    with _lock:
+        _classifiers.clear()
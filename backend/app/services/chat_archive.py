@@ -0,0 +1,326 @@
+"""
+聊天记录归档
+
+超过保留期的聊天消息按用户分段压缩后移入 chat_message_archives 表，
+chat_messages 只保留近期的消息，表和索引都保持较小。
+归档由后台线程分批执行，每批一个短事务；归档后的消息仍然可以通过聊天记录接口翻页读取。
+"""
+
+import json
+import os
+import threading
+import traceback
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import distinct
+from sqlalchemy.orm import Session
+
+from ..models.database import SessionLocal
+from ..models.models import ChatMessage, ChatMessageArchive, TransactionDraft
+
+# 聊天消息在热表中保留的天数，0表示不归档
+CHAT_RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", "180"))
+# 每个归档包的消息数，也是每批处理的条数
+CHAT_ARCHIVE_BATCH_SIZE = int(os.getenv("CHAT_ARCHIVE_BATCH_SIZE", "500"))
+# 后台归档的间隔（秒）
+CHAT_ARCHIVE_INTERVAL = float(os.getenv("CHAT_ARCHIVE_INTERVAL", "3600"))
+# 是否为每个归档包生成对话摘要（需要调用大模型）
+CHAT_ARCHIVE_SUMMARIES = os.getenv("CHAT_ARCHIVE_SUMMARIES", "false").lower() == "true"
+
+# 消息在对话中的位置，(created_at, id)
+Position = Tuple[datetime, int]
+
+
+def _message_to_row(message: ChatMessage) -> Dict[str, Any]:
+    return {
+        "id": message.id,
+        "content": message.content,
+        "is_user": message.is_user,
+        "personality_id": message.personality_id,
+        "created_at": message.created_at.isoformat() if message.created_at else None,
+    }
+
+
+def _row_to_message(row: Dict[str, Any], user_id: int) -> Dict[str, Any]:
+    created_at = row.get("created_at")
+    return {
+        "id": row["id"],
+        "content": row.get("content"),
+        "is_user": row.get("is_user", True),
+        "personality_id": row.get("personality_id"),
+        "user_id": user_id,
+        "created_at": (
+            datetime.fromisoformat(created_at) if created_at else datetime.min
+        ),
+    }
+
+
+def compress_messages(rows: List[Dict[str, Any]]) -> bytes:
+    return zlib.compress(json.dumps(rows, ensure_ascii=False).encode("utf-8"), 9)
+
+
+def decompress_messages(archive: ChatMessageArchive) -> List[Dict[str, Any]]:
+    """解压归档包，返回与聊天记录接口相同字段的消息，按时间正序"""
+    rows = json.loads(zlib.decompress(archive.data).decode("utf-8"))
+    return [_row_to_message(row, archive.user_id) for row in rows]
+
+
+def _position(message: Dict[str, Any]) -> Position:
+    return message["created_at"], message["id"]
+
+
+def archive_user_batch(
+    db: Session,
+    user_id: int,
+    cutoff: datetime,
+    batch_size: int = CHAT_ARCHIVE_BATCH_SIZE,
+    summarize: Optional[Callable[[List[ChatMessage], int], Optional[str]]] = None,
+) -> int:
+    """
+    把用户最早的一批过期消息压缩归档并从热表删除，在一个事务中提交
+
+    每个worker进程都会运行归档线程，删除的消息数与读取的不一致时说明其他进程已归档这批消息，
+    本批回滚，不写入重复的归档包。
+
+    Returns:
+        int: 归档的消息条数，没有过期消息或本批已被其他进程归档时返回0
+    """
+    messages = (
+        db.query(ChatMessage)
+        .filter(ChatMessage.user_id == user_id, ChatMessage.created_at < cutoff)
+        .order_by(ChatMessage.created_at, ChatMessage.id)
+        .limit(batch_size)
+        .all()
+    )
+    if not messages:
+        return 0
+
+    rows = [_message_to_row(message) for message in messages]
+    message_ids = [message.id for message in messages]
+
+    summary = None
+    if summarize is not None:
+        # 生成摘要期间不占用数据库连接
+        db.close()
+        summary = summarize(messages, user_id)
+
+    archive = ChatMessageArchive(
+        user_id=user_id,
+        first_message_id=rows[0]["id"],
+        last_message_id=rows[-1]["id"],
+        start_at=messages[0].created_at,
+        end_at=messages[-1].created_at,
+        message_count=len(rows),
+        data=compress_messages(rows),
+        summary=summary,
+    )
+    try:
+        db.add(archive)
+        # 引用这些消息的草稿早已过期，随消息一起清理
+        db.query(TransactionDraft).filter(
+            TransactionDraft.message_id.in_(message_ids)
+        ).delete(synchronize_session=False)
+        deleted = (
+            db.query(ChatMessage)
+            .filter(ChatMessage.id.in_(message_ids))
+            .delete(synchronize_session=False)
+        )
+        if deleted != len(message_ids):
+            # 多个进程同时归档时，这批消息已被其他进程归档（生成摘要期间没有持有连接），
+            # 放弃本批，避免聊天记录中出现重复消息
+            db.rollback()
+            print(
+                f"[Archive] 用户 {user_id} 的 {len(message_ids)} 条消息中只有 {deleted} 条"
+                f"仍在热表中，已由其他进程归档，放弃本批"
+            )
+            return 0
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(rows)
+
+
+def _summarize_archive(messages: List[ChatMessage], user_id: int) -> Optional[str]:
+    from .chat_context import summarize_turns
+
+    return summarize_turns(None, messages, user_id)
+
+
+def run_archive_pass(
+    session_factory: Callable[[], Session] = SessionLocal,
+    retention_days: int = CHAT_RETENTION_DAYS,
+    batch_size: int = CHAT_ARCHIVE_BATCH_SIZE,
+    summaries: bool = CHAT_ARCHIVE_SUMMARIES,
+    now: Optional[datetime] = None,
+) -> int:
+    """
+    归档所有用户超过保留期的消息，每批消息单独提交
+
+    Returns:
+        int: 本次归档的消息总数
+    """
+    if retention_days <= 0:
+        return 0
+    cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    summarize = _summarize_archive if summaries else None
+
+    db = session_factory()
+    try:
+        user_ids = [
+            row[0]
+            for row in db.query(distinct(ChatMessage.user_id))
+            .filter(ChatMessage.created_at < cutoff)
+            .all()
+        ]
+        total = 0
+        for user_id in user_ids:
+            while True:
+                archived = archive_user_batch(
+                    db, user_id, cutoff, batch_size, summarize
+                )
+                total += archived
+                if archived < batch_size:
+                    break
+        if total:
+            print(f"[Archive] 归档 {len(user_ids)} 个用户的 {total} 条聊天消息")
+        return total
+    finally:
+        db.close()
+
+
+def find_archived_position(
+    db: Session, user_id: int, message_id: int
+) -> Optional[Position]:
+    """查找已归档消息的位置，用于以归档消息作为翻页游标"""
+    archive = (
+        db.query(ChatMessageArchive)
+        .filter(
+            ChatMessageArchive.user_id == user_id,
+            ChatMessageArchive.first_message_id <= message_id,
+            ChatMessageArchive.last_message_id >= message_id,
+        )
+        .first()
+    )
+    if archive is None:
+        return None
+    for message in decompress_messages(archive):
+        if message["id"] == message_id:
+            return _position(message)
+    return None
+
+
+def load_archived_before(
+    db: Session,
+    user_id: int,
+    position: Optional[Position],
+    limit: int,
+    offset: int = 0,
+) -> List[Dict[str, Any]]:
+    """
+    读取位置之前的归档消息，按时间倒序
+
+    Args:
+        position: 只取该位置之前的消息，None表示从最新的归档开始
+        offset: 跳过的条数，兼容偏移分页
+    """
+    query = db.query(ChatMessageArchive).filter(ChatMessageArchive.user_id == user_id)
+    if position is not None:
+        query = query.filter(ChatMessageArchive.start_at <= position[0])
+    query = query.order_by(
+        ChatMessageArchive.end_at.desc(), ChatMessageArchive.last_message_id.desc()
+    )
+
+    result = []
+    for archive in query.yield_per(8):
+        for message in reversed(decompress_messages(archive)):
+            if position is not None and _position(message) >= position:
+                continue
+            if offset > 0:
+                offset -= 1
+                continue
+            result.append(message)
+            if len(result) >= limit:
+                return result
+    return result
+
+
+def load_archived_after(
+    db: Session, user_id: int, position: Position, limit: int
+) -> List[Dict[str, Any]]:
+    """读取位置之后的归档消息，按时间正序"""
+    archives = (
+        db.query(ChatMessageArchive)
+        .filter(
+            ChatMessageArchive.user_id == user_id,
+            ChatMessageArchive.end_at >= position[0],
+        )
+        .order_by(ChatMessageArchive.end_at, ChatMessageArchive.last_message_id)
+    )
+    result = []
+    for archive in archives.yield_per(8):
+        for message in decompress_messages(archive):
+            if _position(message) <= position:
+                continue
+            result.append(message)
+            if len(result) >= limit:
+                return result
+    return result
+
+
+class ChatArchiver:
+    """定期执行归档的后台线程"""
+
+    def __init__(
+        self,
+        interval: float = CHAT_ARCHIVE_INTERVAL,
+        run: Callable[[], int] = run_archive_pass,
+    ):
+        self.interval = interval
+        self.run = run
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.archived_total = 0
+        self.last_run_at: Optional[datetime] = None
+
+    def start(self):
+        if CHAT_RETENTION_DAYS <= 0 or self.interval <= 0:
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, name="chat-archiver", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def run_once(self) -> int:
+        try:
+            archived = self.run()
+        except Exception as e:
+            print(f"[Archive] 归档聊天消息失败: {str(e)}")
+            print(f"错误堆栈:\n{traceback.format_exc()}")
+            return 0
+        self.archived_total += archived
+        self.last_run_at = datetime.utcnow()
+        return archived
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "retention_days": CHAT_RETENTION_DAYS,
+            "archived_total": self.archived_total,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+        }
+
+
+# 全局归档线程，应用启动时开始运行
+chat_archiver = ChatArchiver()
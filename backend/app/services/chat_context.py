@@ -0,0 +1,194 @@
+"""
+对话上下文构建
+
+在给定的token预算内选取最近的对话轮次，更早的对话折叠进按用户保存的滚动摘要。
+消息顺序固定为 人设提示词 → 历史摘要 → 最近对话 → 当前消息，
+摘要只在窗口超出预算时整批刷新，两次刷新之间的提示词前缀保持不变，便于命中模型服务商的前缀缓存。
+"""
+
+import os
+import re
+import traceback
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from ..models.models import ChatMessage, ChatSummary
+from .llm_client import llm_client
+
+# 是否在回复时携带历史对话
+CHAT_CONTEXT_ENABLED = os.getenv("CHAT_CONTEXT_ENABLED", "true").lower() == "true"
+# 历史对话（不含人设提示词和当前消息）的token预算
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+# 未折叠进摘要的历史消息条数上限
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", "20"))
+# 摘要本身的最大token数
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+
+SUMMARY_PROMPT = """请把以下记账助手与用户的对话整合进已有摘要，生成一份新的摘要。
+要求：
+- 保留用户的消费习惯、偏好、提到的计划和未完成的事项
+- 已记录的具体账目只需概括，不必逐条罗列
+- 使用第三人称，不超过200字，只输出摘要正文
+
+已有摘要：
+{previous_summary}
+
+新增对话：
+{turns}
+"""
+
+_CJK_PATTERN = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    粗略估算文本的token数：中日韩字符按每字1个token，其余字符按每4个字符1个token
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4 + 1
+
+
+def _role(message: ChatMessage) -> str:
+    return "user" if message.is_user else "assistant"
+
+
+def summarize_turns(
+    previous_summary: Optional[str],
+    turns: List[ChatMessage],
+    user_id: Optional[int] = None,
+) -> Optional[str]:
+    """
+    把一批对话折叠进已有摘要
+
+    Args:
+        previous_summary: 已有摘要
+        turns: 需要折叠的对话
+        user_id: 用户ID，用于统计用量
+
+    Returns:
+        str: 新的摘要，调用失败时返回None
+    """
+    lines = []
+    for message in turns:
+        speaker = "用户" if message.is_user else "助手"
+        lines.append(f"{speaker}: {message.content}")
+
+    try:
+        response = llm_client.chat_completion(
+            "summary",
+            user_id=user_id,
+            messages=[
+                {"role": "system", "content": "你擅长简明准确地总结对话。"},
+                {
+                    "role": "user",
+                    "content": SUMMARY_PROMPT.format(
+                        previous_summary=previous_summary or "（无）",
+                        turns="\n".join(lines),
+                    ),
+                },
+            ],
+            temperature=0.2,
+            max_tokens=SUMMARY_MAX_TOKENS,
+        )
+        summary = response.choices[0].message.content
+        return summary.strip() if summary else None
+    except Exception as e:
+        print(f"[Context] 生成对话摘要失败: {type(e).__name__}: {str(e)}")
+        print(f"错误堆栈:\n{traceback.format_exc()}")
+        return None
+
+
+def _load_unsummarized(
+    db: Session, user_id: int, after_id: int, before_id: Optional[int], limit: int
+) -> List[ChatMessage]:
+    query = db.query(ChatMessage).filter(
+        ChatMessage.user_id == user_id, ChatMessage.id > after_id
+    )
+    if before_id is not None:
+        query = query.filter(ChatMessage.id < before_id)
+    messages = query.order_by(ChatMessage.id.desc()).limit(limit).all()
+    messages.reverse()
+    return messages
+
+
+def build_context_messages(
+    db: Session,
+    user_id: int,
+    system_prompt: str,
+    user_message: str,
+    before_message_id: Optional[int] = None,
+    token_budget: int = None,
+) -> List[Dict[str, Any]]:
+    """
+    构建带历史上下文的对话消息列表
+
+    Args:
+        db: 数据库会话
+        user_id: 用户ID
+        system_prompt: 人设系统提示词
+        user_message: 当前用户消息
+        before_message_id: 只取该ID之前的历史（当前消息已入库时传入其ID）
+        token_budget: 历史对话的token预算，默认使用CONTEXT_TOKEN_BUDGET
+
+    Returns:
+        list: 可直接传给ChatCompletion的messages
+    """
+    messages = [{"role": "system", "content": system_prompt}]
+    if not CHAT_CONTEXT_ENABLED:
+        messages.append({"role": "user", "content": user_message})
+        return messages
+
+    budget = token_budget if token_budget is not None else CONTEXT_TOKEN_BUDGET
+
+    summary_row = db.query(ChatSummary).filter(ChatSummary.user_id == user_id).first()
+    boundary = summary_row.last_message_id if summary_row else 0
+    summary = summary_row.summary if summary_row else None
+
+    # 多取一倍，超出上限的部分用于折叠
+    history = _load_unsummarized(
+        db, user_id, boundary, before_message_id, CONTEXT_MAX_MESSAGES * 2
+    )
+    token_count = sum(estimate_tokens(message.content) for message in history)
+
+    if token_count > budget or len(history) > CONTEXT_MAX_MESSAGES:
+        # 折叠到预算和条数上限的一半，避免每轮对话都刷新摘要、破坏前缀缓存
+        to_fold = []
+        while history and (
+            token_count > budget // 2 or len(history) > CONTEXT_MAX_MESSAGES // 2
+        ):
+            message = history.pop(0)
+            token_count -= estimate_tokens(message.content)
+            to_fold.append(message)
+
+        print(f"[Context] 用户 {user_id} 折叠 {len(to_fold)} 条历史消息进摘要")
+        # 生成摘要期间不占用数据库连接，已加载的消息内容仍然可用
+        db.close()
+        new_summary = summarize_turns(summary, to_fold, user_id)
+        if new_summary:
+            summary = new_summary
+            summary_row = (
+                db.query(ChatSummary).filter(ChatSummary.user_id == user_id).first()
+            )
+            if summary_row is None:
+                summary_row = ChatSummary(user_id=user_id)
+                db.add(summary_row)
+            summary_row.summary = summary
+            summary_row.last_message_id = to_fold[-1].id
+            try:
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                print(f"[Context] 保存对话摘要失败: {str(e)}")
+
+    if summary:
+        messages.append(
+            {"role": "system", "content": f"以下是你与用户之前对话的摘要：\n{summary}"}
+        )
+    for message in history:
+        if message.content:
+            messages.append({"role": _role(message), "content": message.content})
+    messages.append({"role": "user", "content": user_message})
+    return messages
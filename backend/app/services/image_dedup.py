@@ -0,0 +1,132 @@
+"""
+交易凭证图片去重
+
+对处理后的图片计算差值哈希(dHash)，按用户保存最近识别过的图片哈希和识别结果。
+同一张截图重复上传、或经过压缩/缩放后再次上传时，哈希的汉明距离很小，
+可以直接返回上次的识别结果，不再调用视觉模型。
+"""
+
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image
+
+# 哈希边长，16对应256位哈希；同一商家模板的不同小票整体构图相近，哈希需要足够细才能区分
+IMAGE_HASH_SIZE = 16
+# 汉明距离不超过该值视为同一张图片，取值宜保守，误判会返回另一张小票的金额
+IMAGE_DEDUP_THRESHOLD = int(os.getenv("IMAGE_DEDUP_THRESHOLD", "6"))
+# 每个用户保留的最近图片数量
+IMAGE_DEDUP_PER_USER = int(os.getenv("IMAGE_DEDUP_PER_USER", "50"))
+# 识别结果的有效期（秒）
+IMAGE_DEDUP_TTL = int(os.getenv("IMAGE_DEDUP_TTL", str(7 * 24 * 3600)))
+# 内存中最多保留的用户数量
+IMAGE_DEDUP_MAX_USERS = int(os.getenv("IMAGE_DEDUP_MAX_USERS", "1000"))
+
+
+def dhash(image: Image.Image, hash_size: int = IMAGE_HASH_SIZE) -> int:
+    """
+    计算图片的差值哈希：缩小为(hash_size+1)×hash_size的灰度图，比较每行相邻像素的明暗
+
+    Returns:
+        int: hash_size*hash_size 位的哈希值
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class ImageDedupIndex:
+    """按用户保存最近识别过的图片哈希和识别结果，线程安全"""
+
+    def __init__(
+        self,
+        threshold: int = IMAGE_DEDUP_THRESHOLD,
+        per_user: int = IMAGE_DEDUP_PER_USER,
+        ttl: int = IMAGE_DEDUP_TTL,
+        max_users: int = IMAGE_DEDUP_MAX_USERS,
+    ):
+        self.threshold = threshold
+        self.per_user = per_user
+        self.ttl = ttl
+        self.max_users = max_users
+        # user_id -> OrderedDict[hash -> (过期时间, 识别结果)]
+        self._index: "OrderedDict[int, OrderedDict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(
+        self, user_id: int, image_hash: int
+    ) -> Optional[Tuple[Dict[str, Any], int]]:
+        """
+        查找该用户最近识别过的相似图片
+
+        Returns:
+            tuple: (识别结果副本, 汉明距离)，没有相似图片时返回None
+        """
+        now = time.monotonic()
+        with self._lock:
+            entries = self._index.get(user_id)
+            best = None
+            if entries:
+                self._index.move_to_end(user_id)
+                for stored_hash, (expires_at, result) in list(entries.items()):
+                    if expires_at < now:
+                        del entries[stored_hash]
+                        continue
+                    distance = hamming_distance(stored_hash, image_hash)
+                    if distance <= self.threshold and (
+                        best is None or distance < best[1]
+                    ):
+                        best = (stored_hash, distance, result)
+            if best is None:
+                self.misses += 1
+                return None
+            entries.move_to_end(best[0])
+            self.hits += 1
+            return copy.deepcopy(best[2]), best[1]
+
+    def add(self, user_id: int, image_hash: int, result: Dict[str, Any]):
+        with self._lock:
+            entries = self._index.setdefault(user_id, OrderedDict())
+            self._index.move_to_end(user_id)
+            entries[image_hash] = (time.monotonic() + self.ttl, copy.deepcopy(result))
+            entries.move_to_end(image_hash)
+            while len(entries) > self.per_user:
+                entries.popitem(last=False)
+            while len(self._index) > self.max_users:
+                self._index.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "users": len(self._index),
+                "images": sum(len(entries) for entries in self._index.values()),
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+# 图片识别结果去重索引
+image_dedup_index = ImageDedupIndex()
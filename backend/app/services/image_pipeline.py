@@ -0,0 +1,160 @@
+"""
+上传图片的处理流程
+
+读取并检查大小 → 解码 → 按EXIF方向摆正 → 缩小到最长边不超过IMAGE_MAX_EDGE → 重新编码为JPEG，
+读取之后的步骤都在内存中完成。手机拍摄的5-10MB照片通常会缩小到200KB左右再发给模型服务商。
+
+接口函数拿到UploadFile时Starlette已经解析完multipart请求体（超过1MB的文件暂存到临时文件），
+请求体的大小上限由 upload_limit.UploadSizeLimitMiddleware 在解析前检查。
+"""
+
+import base64
+import io
+import os
+from typing import Optional
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .image_dedup import dhash
+
+# 上传图片的大小上限（字节）
+IMAGE_MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_MAX_UPLOAD_BYTES", str(15 * 1024 * 1024)))
+# 发给模型前图片最长边的像素上限
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1600"))
+# 重新编码的JPEG质量
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "80"))
+# 解码像素数上限，防止解压炸弹
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(50_000_000)))
+
+READ_CHUNK_SIZE = 64 * 1024
+EXIF_ORIENTATION = 0x0112
+
+
+class ImageTooLargeError(Exception):
+    """上传的图片超过大小或像素上限"""
+
+
+class InvalidImageError(Exception):
+    """上传的内容无法解码为图片"""
+
+
+class PreparedImage:
+    """处理后的图片"""
+
+    def __init__(
+        self,
+        data: bytes,
+        mime_type: str,
+        width: int,
+        height: int,
+        original_size: int,
+        image_hash: Optional[int] = None,
+    ):
+        self.data = data
+        self.mime_type = mime_type
+        self.width = width
+        self.height = height
+        self.original_size = original_size
+        # 摆正后图片的感知哈希，用于识别重复上传
+        self.image_hash = image_hash
+
+    def to_data_url(self) -> str:
+        encoded = base64.b64encode(self.data).decode("ascii")
+        return f"data:{self.mime_type};base64,{encoded}"
+
+
+async def read_upload(upload, max_bytes: int = IMAGE_MAX_UPLOAD_BYTES) -> bytes:
+    """
+    分块读取上传文件，超过单张图片的大小上限时停止
+
+    文件此时已由Starlette完整接收（内存或临时文件），这里的检查只限制复制到内存中的字节数和
+    单张图片的大小；请求体整体的内存和磁盘占用由 UploadSizeLimitMiddleware 在解析前限制。
+
+    Raises:
+        ImageTooLargeError: 文件超过max_bytes
+    """
+    buffer = bytearray()
+    while True:
+        chunk = await upload.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer.extend(chunk)
+        if len(buffer) > max_bytes:
+            raise ImageTooLargeError(f"图片不能超过 {max_bytes // (1024 * 1024)}MB")
+    return bytes(buffer)
+
+
+def prepare_image(
+    data: bytes,
+    max_edge: int = IMAGE_MAX_EDGE,
+    quality: int = IMAGE_JPEG_QUALITY,
+    max_pixels: Optional[int] = IMAGE_MAX_PIXELS,
+) -> PreparedImage:
+    """
+    解码、摆正、缩小并重新编码图片
+
+    Args:
+        data: 原始图片字节
+        max_edge: 最长边像素上限
+        quality: JPEG质量
+        max_pixels: 解码像素数上限
+
+    Returns:
+        PreparedImage: 处理后的JPEG图片
+
+    Raises:
+        InvalidImageError: 无法解码
+        ImageTooLargeError: 像素数超过上限
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as e:
+        # 像素数远超Pillow的安全上限时在打开阶段就会报错
+        raise ImageTooLargeError("图片分辨率过大") from e
+    except (UnidentifiedImageError, OSError) as e:
+        raise InvalidImageError("无法识别的图片格式") from e
+
+    if max_pixels and image.width * image.height > max_pixels:
+        raise ImageTooLargeError("图片分辨率过大")
+
+    original_format = image.format
+    # 原图尺寸和方向在draft之前取，draft会改变解码尺寸
+    needs_resize = max(image.size) > max_edge
+    needs_rotate = image.getexif().get(EXIF_ORIENTATION, 1) != 1
+
+    # 本身就是足够小的正向JPEG时直接使用原图，避免重复压缩
+    if original_format == "JPEG" and not needs_resize and not needs_rotate:
+        width, height = image.size
+        try:
+            # 不用draft缩小解码，DCT缩放的误差会让同一张图片的哈希与重新编码后的不一致
+            image_hash = dhash(image)
+        except OSError as e:
+            raise InvalidImageError("图片数据已损坏") from e
+        return PreparedImage(data, "image/jpeg", width, height, len(data), image_hash)
+
+    try:
+        # JPEG可以在解码时直接按2的幂缩小，大照片的解码耗时和内存都小得多
+        image.draft("RGB", (max_edge, max_edge))
+        image = ImageOps.exif_transpose(image)
+    except OSError as e:
+        raise InvalidImageError("图片数据已损坏") from e
+
+    if image.mode not in ("RGB", "L"):
+        # 透明背景铺白色，避免转JPEG后变黑
+        rgba = image.convert("RGBA")
+        background = Image.new("RGB", rgba.size, "white")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        image = background
+
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    output = io.BytesIO()
+    try:
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+    except OSError as e:
+        raise InvalidImageError("图片数据已损坏") from e
+    encoded = output.getvalue()
+    return PreparedImage(
+        encoded, "image/jpeg", image.width, image.height, len(data), dhash(image)
+    )
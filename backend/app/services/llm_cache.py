@@ -0,0 +1,172 @@
+"""
+大模型响应缓存
+
+用于缓存记账信息提取结果。用户经常重复发送相同或几乎相同的消息（网络重试、每天的"早餐 8元"），
+命中缓存时可以直接复用上一次的提取结果。默认使用进程内LRU+TTL缓存，
+多进程部署时可以通过 EXTRACTION_CACHE_BACKEND=redis 使用共享缓存（需要安装redis）。
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# 缓存后端: memory / redis
+EXTRACTION_CACHE_BACKEND = os.getenv("EXTRACTION_CACHE_BACKEND", "memory").lower()
+EXTRACTION_CACHE_SIZE = int(os.getenv("EXTRACTION_CACHE_SIZE", "2048"))
+EXTRACTION_CACHE_TTL = int(os.getenv("EXTRACTION_CACHE_TTL", "3600"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+
+def normalize_message(text: str) -> str:
+    """
+    规范化消息文本，使仅有空白、全半角、大小写或结尾标点差异的消息得到相同的键
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("。.!！~～ ")
+
+
+def make_cache_key(message: str, current_date: str, namespace: str = "extract") -> str:
+    """
+    生成缓存键。相对日期（"昨天"）的含义依赖当天日期，所以日期也是键的一部分
+    """
+    digest = hashlib.sha1(normalize_message(message).encode("utf-8")).hexdigest()
+    return f"{namespace}:{current_date}:{digest}"
+
+
+class TTLCache:
+    """线程安全的LRU+TTL缓存，记录命中率等统计信息"""
+
+    def __init__(self, max_size: int = 2048, ttl: int = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": "memory",
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class RedisCache:
+    """基于Redis的共享缓存，淘汰和过期由Redis负责，命中统计为本进程数据"""
+
+    def __init__(self, url: str, ttl: int = 3600, prefix: str = "daodao:"):
+        import redis
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.2)
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        try:
+            raw = self.client.get(self.prefix + key)
+        except Exception as e:
+            # 缓存不可用时按未命中处理，不影响主流程
+            print(f"[Cache] Redis读取失败: {str(e)}")
+            with self._lock:
+                self.errors += 1
+                self.misses += 1
+            return None
+        with self._lock:
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key: str, value: Any):
+        try:
+            self.client.set(
+                self.prefix + key, json.dumps(value, ensure_ascii=False), ex=self.ttl
+            )
+        except Exception as e:
+            print(f"[Cache] Redis写入失败: {str(e)}")
+            with self._lock:
+                self.errors += 1
+
+    def clear(self):
+        with self._lock:
+            self.hits = self.misses = self.errors = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "backend": "redis",
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "errors": self.errors,
+            }
+
+
+def create_cache(backend: str = EXTRACTION_CACHE_BACKEND):
+    """按配置创建缓存，Redis不可用时回退到进程内缓存"""
+    if backend == "redis":
+        try:
+            cache = RedisCache(REDIS_URL, ttl=EXTRACTION_CACHE_TTL)
+            print(f"[Cache] 使用Redis共享缓存: {REDIS_URL}")
+            return cache
+        except ImportError:
+            print("[Cache] 未安装redis，回退到进程内缓存")
+    return TTLCache(max_size=EXTRACTION_CACHE_SIZE, ttl=EXTRACTION_CACHE_TTL)
+
+
+# 记账信息提取结果缓存
+extraction_cache = create_cache()
@@ -0,0 +1,479 @@
+"""
+大模型调用弹性层
+
+所有对 openai.ChatCompletion.create 的调用都经过这里，统一提供：
+- 按操作类型设置的请求超时
+- 带随机抖动的指数退避重试
+- 多端点路由与故障转移（见 llm_router）：按操作选择模型档位，端点出错时切换到下一个
+- 按端点的熔断器：服务商持续出错时快速失败，调用方直接返回兜底回复
+- 可选的对冲请求：首个请求超过一定时间未返回时再发一个相同请求，取先返回的结果
+- 调用次数、重试、超时、延迟分位数，以及每次调用的提示词和输出token数
+"""
+
+import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import openai
+
+from .llm_router import (
+    CircuitBreaker,
+    LLMEndpoint,
+    LLMRouter,
+    PERMIT_PROBE,
+    create_router,
+    percentile,
+)
+from .llm_usage import UsageTracker, estimate_tokens, usage_tracker
+
+# 各操作的请求超时（秒）
+OPERATION_TIMEOUTS = {
+    "extraction": float(os.getenv("LLM_TIMEOUT_EXTRACTION", "15")),
+    "chat": float(os.getenv("LLM_TIMEOUT_CHAT", "30")),
+    "combined": float(os.getenv("LLM_TIMEOUT_CHAT", "30")),
+    "stream": float(os.getenv("LLM_TIMEOUT_CHAT", "30")),
+    "tools": float(os.getenv("LLM_TIMEOUT_CHAT", "30")),
+    "summary": float(os.getenv("LLM_TIMEOUT_SUMMARY", "20")),
+    "image": float(os.getenv("LLM_TIMEOUT_IMAGE", "60")),
+    "analysis": float(os.getenv("LLM_TIMEOUT_ANALYSIS", "120")),
+}
+DEFAULT_TIMEOUT = 30.0
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+
+# 对冲请求的等待时间（秒），0表示关闭；只对列出的操作生效
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "0"))
+LLM_HEDGE_OPERATIONS = set(
+    op.strip()
+    for op in os.getenv("LLM_HEDGE_OPERATIONS", "extraction,chat").split(",")
+    if op.strip()
+)
+
+# 值得重试的服务商错误：超时、限流、连接失败、服务端错误
+RETRYABLE_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.TryAgain,
+)
+# InvalidRequestError等也继承自OpenAIError，属于请求本身的问题，重试无意义
+NON_RETRYABLE_ERRORS = (
+    openai.error.InvalidRequestError,
+    openai.error.AuthenticationError,
+    openai.error.PermissionError,
+)
+
+
+class LLMUnavailableError(Exception):
+    """大模型服务不可用（熔断中），调用方应返回兜底结果"""
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, NON_RETRYABLE_ERRORS):
+        return False
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def _message_chars(messages) -> int:
+    """提示词字符数，图片消息只计文本部分"""
+    total = 0
+    for message in messages or []:
+        content = message.get("content")
+        if isinstance(content, list):
+            total += sum(len(part.get("text", "")) for part in content)
+        elif content:
+            total += len(content)
+    return total
+
+
+def extract_usage(response) -> Optional[Dict[str, int]]:
+    """
+    读取响应中的token用量
+
+    Returns:
+        dict: prompt_tokens / completion_tokens / cached_tokens，响应中没有用量信息时返回None
+    """
+    # 流式响应和测试中的模拟对象都没有用量信息
+    usage = response.get("usage") if isinstance(response, dict) else None
+    if not usage:
+        return None
+    details = usage.get("prompt_tokens_details") or {}
+    return {
+        "prompt_tokens": int(usage.get("prompt_tokens") or 0),
+        "completion_tokens": int(usage.get("completion_tokens") or 0),
+        # 命中服务商前缀缓存的token数（服务商支持时才有）
+        "cached_tokens": int(details.get("cached_tokens") or 0),
+    }
+
+
+def _estimate_prompt_tokens(messages) -> int:
+    total = 0
+    for message in messages or []:
+        content = message.get("content")
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content)
+        total += estimate_tokens(content)
+    return total
+
+
+def _estimate_completion_tokens(response) -> int:
+    if not isinstance(response, dict):
+        return 0
+    try:
+        return estimate_tokens(response["choices"][0]["message"]["content"])
+    except (KeyError, IndexError, TypeError):
+        return 0
+
+
+class LLMMetrics:
+    """按操作类型统计的调用指标"""
+
+    def __init__(self, window: int = 200):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+
+    def incr(self, operation: str, name: str, value: int = 1):
+        with self._lock:
+            self.counters[operation][name] += value
+
+    def observe(self, operation: str, latency: float):
+        with self._lock:
+            self.latencies[operation].append(latency)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            result = {}
+            for operation in set(self.counters) | set(self.latencies):
+                samples = list(self.latencies[operation])
+                p50 = percentile(samples, 0.5)
+                p95 = percentile(samples, 0.95)
+                counters = self.counters[operation]
+                usage_calls = counters.get("usage_calls", 0)
+                result[operation] = dict(
+                    counters,
+                    avg_prompt_tokens=(
+                        round(counters["prompt_tokens"] / usage_calls, 1)
+                        if usage_calls
+                        else None
+                    ),
+                    avg_completion_tokens=(
+                        round(counters["completion_tokens"] / usage_calls, 1)
+                        if usage_calls
+                        else None
+                    ),
+                    latency_p50_ms=round(p50 * 1000, 1) if p50 is not None else None,
+                    latency_p95_ms=round(p95 * 1000, 1) if p95 is not None else None,
+                )
+            return result
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.latencies.clear()
+
+
+class LLMClient:
+    """带超时、重试、多端点故障转移、熔断和对冲请求的大模型调用客户端"""
+
+    def __init__(
+        self,
+        create_fn: Optional[Callable[..., Any]] = None,
+        router: Optional[LLMRouter] = None,
+        max_retries: int = LLM_MAX_RETRIES,
+        backoff_base: float = LLM_BACKOFF_BASE,
+        backoff_max: float = LLM_BACKOFF_MAX,
+        hedge_delay: float = LLM_HEDGE_DELAY,
+        hedge_operations=None,
+        sleep: Callable[[float], None] = time.sleep,
+        usage_tracker: Optional[UsageTracker] = None,
+    ):
+        # 默认在调用时才取 openai.ChatCompletion.create，便于测试中替换
+        self._create_fn = create_fn
+        self.router = router or create_router()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_delay = hedge_delay
+        self.hedge_operations = (
+            LLM_HEDGE_OPERATIONS if hedge_operations is None else set(hedge_operations)
+        )
+        self.sleep = sleep
+        # 为None时不按用户统计用量
+        self.usage_tracker = usage_tracker
+        self.metrics = LLMMetrics()
+        self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm")
+
+    def _create(self, **kwargs):
+        create_fn = self._create_fn or openai.ChatCompletion.create
+        return create_fn(**kwargs)
+
+    def _timed_create(
+        self, endpoint: LLMEndpoint, kwargs: Dict[str, Any], probe: bool = False
+    ):
+        """
+        调用一个端点并记录其延迟和成败，请求参数本身的错误不计入端点健康度
+
+        probe为True表示本次请求占用了半开熔断器的探测名额，无论结果如何都释放，否则探测
+        遇到不可重试的错误后熔断器会一直拒绝请求；其它请求不释放，避免清掉正在进行的探测。
+        """
+        started = time.monotonic()
+        try:
+            response = self._create(**dict(kwargs, **endpoint.request_kwargs()))
+        except Exception as e:
+            if is_retryable(e):
+                endpoint.record(time.monotonic() - started, False)
+            raise
+        else:
+            endpoint.record(time.monotonic() - started, True)
+            return response
+        finally:
+            if probe:
+                endpoint.breaker.release_probe()
+
+    def backoff(self, attempt: int) -> float:
+        """第attempt次重试前的等待时间，使用full jitter"""
+        ceiling = min(self.backoff_max, self.backoff_base * (2**attempt))
+        return random.uniform(0, ceiling)
+
+    def _pick_endpoint(
+        self, candidates, start: int
+    ) -> Tuple[Optional[LLMEndpoint], bool]:
+        """从第start个候选开始轮转，返回第一个熔断器放行的端点及是否占用了探测名额"""
+        for offset in range(len(candidates)):
+            endpoint = candidates[(start + offset) % len(candidates)]
+            permit = endpoint.breaker.allow_request()
+            if permit:
+                return endpoint, permit == PERMIT_PROBE
+        return None, False
+
+    def _call_hedged(
+        self,
+        operation: str,
+        kwargs: Dict[str, Any],
+        endpoint: LLMEndpoint,
+        backup: Optional[LLMEndpoint],
+        probe: bool = False,
+    ):
+        first = self._executor.submit(self._timed_create, endpoint, kwargs, probe)
+        done, _ = wait([first], timeout=self.hedge_delay)
+        if done:
+            return first.result()
+
+        # 有其它可用端点时对冲到另一个服务商，否则对同一端点再发一次
+        self.metrics.incr(operation, "hedged")
+        second = self._executor.submit(self._timed_create, backup or endpoint, kwargs)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self.metrics.incr(operation, "hedge_wins")
+                    # 另一个请求的结果直接丢弃
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def chat_completion(self, operation: str, user_id: Optional[int] = None, **kwargs):
+        """
+        调用 ChatCompletion.create
+
+        模型、api_base、api_key 由路由按操作档位选出的端点决定。
+
+        Args:
+            operation: 操作类型，决定模型档位、超时、是否对冲以及指标归类
+            user_id: 发起调用的用户ID，用于按用户统计用量
+            **kwargs: 透传给 ChatCompletion.create 的参数
+
+        Returns:
+            ChatCompletion.create 的返回值（stream=True时为迭代器）
+
+        Raises:
+            LLMUnavailableError: 所有端点都处于熔断状态
+            Exception: 重试耗尽后的最后一个错误
+        """
+        started = time.monotonic()
+        try:
+            response, endpoint = self._call_with_retries(operation, kwargs)
+        except LLMUnavailableError:
+            raise
+        except Exception:
+            self._track(user_id, operation, None, 0, 0, started, False)
+            raise
+
+        messages = kwargs.get("messages")
+        prompt_chars = _message_chars(messages)
+        self.metrics.incr(operation, "prompt_chars", prompt_chars)
+        if kwargs.get("stream"):
+            return self._track_stream(
+                response, user_id, operation, endpoint.model, messages, started
+            )
+
+        usage = self._record_usage(operation, prompt_chars, response)
+        if usage is None:
+            prompt_tokens = _estimate_prompt_tokens(messages)
+            completion_tokens = _estimate_completion_tokens(response)
+        else:
+            prompt_tokens = usage["prompt_tokens"]
+            completion_tokens = usage["completion_tokens"]
+        self._track(
+            user_id,
+            operation,
+            endpoint.model,
+            prompt_tokens,
+            completion_tokens,
+            started,
+            True,
+        )
+        return response
+
+    def _call_with_retries(self, operation: str, kwargs: Dict[str, Any]):
+        """按候选端点依次调用并重试，返回(响应, 端点)"""
+        kwargs.setdefault(
+            "request_timeout", OPERATION_TIMEOUTS.get(operation, DEFAULT_TIMEOUT)
+        )
+        hedge = (
+            self.hedge_delay > 0
+            and operation in self.hedge_operations
+            and not kwargs.get("stream")
+        )
+        candidates = self.router.candidates(operation)
+        # 每个端点至少尝试一次
+        max_attempts = max(self.max_retries + 1, len(candidates))
+
+        attempt = 0
+        while True:
+            endpoint, probe = self._pick_endpoint(candidates, attempt)
+            if endpoint is None:
+                self.metrics.incr(operation, "short_circuited")
+                raise LLMUnavailableError("AI服务暂时不可用，请稍后再试")
+
+            self.metrics.incr(operation, "attempts")
+            started = time.monotonic()
+            try:
+                if hedge:
+                    backup = next(
+                        (
+                            c
+                            for c in candidates
+                            if c is not endpoint and c.tiers & endpoint.tiers
+                        ),
+                        None,
+                    )
+                    response = self._call_hedged(
+                        operation, kwargs, endpoint, backup, probe
+                    )
+                else:
+                    response = self._timed_create(endpoint, kwargs, probe)
+            except Exception as e:
+                self.metrics.incr(operation, "failures")
+                if isinstance(e, openai.error.Timeout):
+                    self.metrics.incr(operation, "timeouts")
+                if not is_retryable(e):
+                    raise
+                attempt += 1
+                if attempt >= max_attempts:
+                    print(f"[LLM] {operation} 调用失败，不再重试: {type(e).__name__}")
+                    raise
+                self.metrics.incr(operation, "retries")
+                if attempt < len(candidates):
+                    # 还有没试过的端点，立即切换
+                    self.metrics.incr(operation, "failovers")
+                    print(
+                        f"[LLM] {operation} 在端点 {endpoint.name} 调用失败({type(e).__name__})，切换到下一个端点"
+                    )
+                    continue
+                delay = self.backoff(attempt - len(candidates))
+                print(
+                    f"[LLM] {operation} 调用失败({type(e).__name__})，{delay:.2f}秒后第{attempt}次重试"
+                )
+                self.sleep(delay)
+                continue
+
+            self.metrics.incr(operation, "successes")
+            self.metrics.observe(operation, time.monotonic() - started)
+            return response, endpoint
+
+    def _track(
+        self,
+        user_id: Optional[int],
+        operation: str,
+        model: Optional[str],
+        prompt_tokens: int,
+        completion_tokens: int,
+        started: float,
+        success: bool,
+    ):
+        if self.usage_tracker is None:
+            return
+        try:
+            self.usage_tracker.record(
+                user_id,
+                operation,
+                model,
+                prompt_tokens,
+                completion_tokens,
+                time.monotonic() - started,
+                success,
+            )
+        except Exception as e:
+            # 用量统计失败不影响调用结果
+            print(f"[LLM] 记录用量失败: {str(e)}")
+
+    def _track_stream(self, chunks, user_id, operation, model, messages, started):
+        """流式响应没有用量信息，结束后按收到的文本估算"""
+        parts = []
+        completed = False
+        try:
+            for chunk in chunks:
+                try:
+                    delta = chunk.choices[0].get("delta") or {}
+                    parts.append(delta.get("content") or "")
+                except (AttributeError, IndexError, TypeError):
+                    pass
+                yield chunk
+            completed = True
+        finally:
+            self._track(
+                user_id,
+                operation,
+                model,
+                _estimate_prompt_tokens(messages),
+                estimate_tokens("".join(parts)),
+                started,
+                completed,
+            )
+
+    def _record_usage(self, operation: str, prompt_chars: int, response):
+        usage = extract_usage(response)
+        if usage is None:
+            return None
+        self.metrics.incr(operation, "usage_calls")
+        for name, value in usage.items():
+            self.metrics.incr(operation, name, value)
+        print(
+            f"[LLM] {operation} token用量: 提示词 {usage['prompt_tokens']}"
+            f"（缓存命中 {usage['cached_tokens']}），输出 {usage['completion_tokens']}，"
+            f"提示词字符数 {prompt_chars}"
+        )
+        return usage
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "endpoints": self.router.snapshot(),
+            "operations": self.metrics.snapshot(),
+        }
+
+
+# 全局共享的客户端
+llm_client = LLMClient(usage_tracker=usage_tracker)
@@ -0,0 +1,283 @@
+"""
+大模型服务商路由
+
+可以配置多个兼容OpenAI接口的服务商和模型，每个端点属于一个或多个档位：
+- fast: 便宜、延迟低的模型，用于记账提取、日常对话、摘要
+- strong: 能力更强的模型，用于图片识别和消费习惯分析
+
+每次调用按操作类型确定档位，在该档位的端点中按最近一段时间的p95延迟和错误率排序，
+熔断中的端点跳过；同档位都不可用时再退到其它档位的端点。
+
+配置示例（LLM_PROVIDERS，JSON数组）：
+    [
+        {"name": "siliconflow", "api_base": "https://api.siliconflow.cn/v1",
+         "api_key_env": "SILICONFLOW_API_KEY", "model": "Qwen/Qwen2.5-7B-Instruct", "tiers": ["fast"]},
+        {"name": "gemini", "model": "gemini-2.5-flash-preview-05-20", "tiers": ["fast", "strong"]}
+    ]
+未指定 api_base / api_key 的端点使用全局的 API_URL / API_KEY。
+未配置 LLM_PROVIDERS 时只有一个默认端点，模型为 LLM_MODEL（可用 LLM_STRONG_MODEL 单独指定强模型）。
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+DEFAULT_MODEL = os.getenv("LLM_MODEL", "gemini-2.5-flash-preview-05-20")
+STRONG_MODEL = os.getenv("LLM_STRONG_MODEL", DEFAULT_MODEL)
+
+# 连续失败多少次后熔断，熔断多少秒后放行一个探测请求
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("LLM_CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("LLM_CIRCUIT_RESET_TIMEOUT", "30"))
+
+# 每个端点保留的最近调用样本数
+ROUTER_WINDOW = int(os.getenv("LLM_ROUTER_WINDOW", "100"))
+# 错误率对排序得分的放大系数：得分 = p95延迟 × (1 + 系数 × 错误率)
+ROUTER_ERROR_PENALTY = float(os.getenv("LLM_ROUTER_ERROR_PENALTY", "10"))
+
+# 各操作使用的模型档位
+OPERATION_TIERS = {
+    "extraction": "fast",
+    "combined": "fast",
+    "chat": "fast",
+    "stream": "fast",
+    "tools": "fast",
+    "summary": "fast",
+    "image": "strong",
+    "analysis": "strong",
+}
+DEFAULT_TIER = "fast"
+
+# CircuitBreaker.allow_request 的放行结果
+PERMIT_PASS = "pass"
+PERMIT_PROBE = "probe"
+
+
+class CircuitBreaker:
+    """连续失败计数熔断器：closed → open → half_open → closed"""
+
+    def __init__(
+        self,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> Optional[str]:
+        """
+        判断是否放行一个请求
+
+        Returns:
+            None表示拒绝；PERMIT_PASS表示正常放行；PERMIT_PROBE表示本次请求占用了半开状态的
+            探测名额，调用方结束时需要 release_probe()
+        """
+        with self._lock:
+            if self.state == "closed":
+                return PERMIT_PASS
+            if self.state == "open":
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    return None
+                self.state = "half_open"
+                self._probe_in_flight = False
+            # half_open 只放行一个探测请求
+            if self._probe_in_flight:
+                return None
+            self._probe_in_flight = True
+            return PERMIT_PROBE
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """
+        探测请求结束时释放，结果不计入成败（如请求参数错误）时熔断器仍可以放行下一个探测
+
+        只能由 allow_request() 返回 PERMIT_PROBE 的请求调用，否则会清掉其它请求占用的探测名额。
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"[LLM] 熔断器打开，连续失败 {self.failures} 次")
+                self.state = "open"
+                self.opened_at = self.clock()
+                self._probe_in_flight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures}
+
+
+def percentile(samples, q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class LLMEndpoint:
+    """一个服务商上的一个模型，带独立的熔断器和滚动延迟/错误率统计"""
+
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        tiers: Iterable[str] = ("fast", "strong"),
+        api_base: Optional[str] = None,
+        api_key: Optional[str] = None,
+        window: int = ROUTER_WINDOW,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.name = name
+        self.model = model
+        self.tiers = set(tiers)
+        self.api_base = api_base
+        self.api_key = api_key
+        self.breaker = breaker or CircuitBreaker()
+        # (延迟秒数, 是否成功)
+        self._samples: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def request_kwargs(self) -> Dict[str, Any]:
+        """传给 ChatCompletion.create 的端点参数，未配置的项使用openai全局配置"""
+        kwargs = {"model": self.model}
+        if self.api_base:
+            kwargs["api_base"] = self.api_base
+        if self.api_key:
+            kwargs["api_key"] = self.api_key
+        return kwargs
+
+    def record(self, latency: float, success: bool):
+        with self._lock:
+            self._samples.append((latency, success))
+        if success:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def _stats(self):
+        with self._lock:
+            samples = list(self._samples)
+        if not samples:
+            return None, 0.0, 0
+        latencies = [latency for latency, success in samples if success]
+        errors = sum(1 for _, success in samples if not success)
+        return percentile(latencies, 0.95), errors / len(samples), len(samples)
+
+    def score(self) -> float:
+        """排序得分，越小越优先；没有样本的端点得分为0，保证新端点会被尝试"""
+        p95, error_rate, count = self._stats()
+        if count == 0:
+            return 0.0
+        if p95 is None:
+            # 全部失败，没有成功延迟可参考
+            return float("inf")
+        return p95 * (1 + ROUTER_ERROR_PENALTY * error_rate)
+
+    def snapshot(self) -> Dict[str, Any]:
+        p95, error_rate, count = self._stats()
+        return {
+            "model": self.model,
+            "tiers": sorted(self.tiers),
+            "samples": count,
+            "latency_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "error_rate": round(error_rate, 4),
+            "circuit_breaker": self.breaker.snapshot(),
+        }
+
+
+class LLMRouter:
+    """按操作档位和端点健康状况给出候选端点顺序"""
+
+    def __init__(
+        self,
+        endpoints: List[LLMEndpoint],
+        operation_tiers: Optional[Dict[str, str]] = None,
+    ):
+        if not endpoints:
+            raise ValueError("至少需要配置一个大模型端点")
+        self.endpoints = endpoints
+        self.operation_tiers = operation_tiers or OPERATION_TIERS
+
+    def tier_for(self, operation: str) -> str:
+        return self.operation_tiers.get(operation, DEFAULT_TIER)
+
+    def candidates(self, operation: str) -> List[LLMEndpoint]:
+        """
+        返回该操作的候选端点，按优先级排序
+
+        同档位的端点在前，其它档位的端点作为最后的兜底；
+        熔断中的端点排在末尾，由调用方在使用前检查是否放行。
+        """
+        tier = self.tier_for(operation)
+
+        def key(endpoint: LLMEndpoint):
+            return (
+                tier not in endpoint.tiers,
+                endpoint.breaker.state == "open",
+                endpoint.score(),
+            )
+
+        return sorted(self.endpoints, key=key)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {endpoint.name: endpoint.snapshot() for endpoint in self.endpoints}
+
+
+def load_endpoints(raw: Optional[str] = None) -> List[LLMEndpoint]:
+    """从 LLM_PROVIDERS 读取端点配置，未配置或配置有误时使用默认端点"""
+    raw = os.getenv("LLM_PROVIDERS") if raw is None else raw
+    if raw:
+        try:
+            endpoints = []
+            for index, item in enumerate(json.loads(raw)):
+                api_key = item.get("api_key")
+                if not api_key and item.get("api_key_env"):
+                    api_key = os.getenv(item["api_key_env"])
+                endpoints.append(
+                    LLMEndpoint(
+                        name=item.get("name") or f"provider-{index}",
+                        model=item["model"],
+                        tiers=item.get("tiers") or ("fast", "strong"),
+                        api_base=item.get("api_base"),
+                        api_key=api_key,
+                    )
+                )
+            if endpoints:
+                return endpoints
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"[LLM] LLM_PROVIDERS 配置解析失败，使用默认端点: {str(e)}")
+
+    if STRONG_MODEL == DEFAULT_MODEL:
+        return [LLMEndpoint("default", DEFAULT_MODEL, tiers=("fast", "strong"))]
+    return [
+        LLMEndpoint("default", DEFAULT_MODEL, tiers=("fast",)),
+        LLMEndpoint("default-strong", STRONG_MODEL, tiers=("strong",)),
+    ]
+
+
+def create_router() -> LLMRouter:
+    router = LLMRouter(load_endpoints())
+    for endpoint in router.endpoints:
+        print(
+            f"[LLM] 端点 {endpoint.name}: 模型 {endpoint.model}, 档位 {sorted(endpoint.tiers)}"
+        )
+    return router
@@ -0,0 +1,352 @@
+"""
+按用户统计大模型用量并限流
+
+- 每次大模型调用的token用量和延迟先写入内存缓冲，由后台线程批量写入 llm_usage 表，
+  同时累加到按用户和日期汇总的 llm_usage_daily 表
+- 调用模型前检查用户的令牌桶（限制请求速率）和当天的token配额，超限时抛出
+  QuotaExceededError，由路由返回429和重试等待时间，不再排队等待模型服务商
+
+令牌桶和当天用量计数保存在进程内，当天用量在进程首次遇到该用户时从汇总表加载。
+令牌桶按最近使用顺序保存，已恢复满的桶与新建的桶等价，新用户加入时淘汰；
+数量超过上限时淘汰最久未使用的桶。
+"""
+
+import math
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ..models.database import SessionLocal
+from ..models.models import LLMUsage, LLMUsageDaily
+
+# 是否启用限流和配额检查
+LLM_QUOTA_ENABLED = os.getenv("LLM_QUOTA_ENABLED", "true").lower() == "true"
+# 令牌桶容量（允许的突发请求数）和每秒恢复的令牌数
+USER_RATE_LIMIT_BURST = float(os.getenv("USER_RATE_LIMIT_BURST", "20"))
+USER_RATE_LIMIT_PER_SECOND = float(os.getenv("USER_RATE_LIMIT_PER_SECOND", "0.5"))
+# 每个用户每天的token配额，0表示不限制
+USER_DAILY_TOKEN_QUOTA = int(os.getenv("USER_DAILY_TOKEN_QUOTA", "200000"))
+# 内存中最多保留的用户令牌桶数量
+USER_RATE_LIMIT_MAX_USERS = int(os.getenv("USER_RATE_LIMIT_MAX_USERS", "10000"))
+# 用量记录批量写入数据库的间隔（秒）
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+
+# 各接口消耗的令牌数，图片识别和消费分析的调用更贵
+REQUEST_COSTS = {
+    "chat": 1,
+    "image": 3,
+    "analysis": 5,
+}
+
+
+class QuotaExceededError(Exception):
+    """用户超出限流或配额"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """令牌桶：容量为capacity，每秒恢复rate个令牌"""
+
+    def __init__(
+        self,
+        capacity: float,
+        rate: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.capacity = capacity
+        self.rate = rate
+        self.clock = clock
+        self.tokens = capacity
+        self.updated_at = clock()
+
+    def consume(self, cost: float = 1) -> Tuple[bool, float]:
+        """
+        尝试取出cost个令牌
+
+        Returns:
+            tuple: (是否成功, 失败时需要等待的秒数)
+        """
+        now = self.clock()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True, 0.0
+        if self.rate <= 0:
+            return False, float("inf")
+        return False, (cost - self.tokens) / self.rate
+
+    def is_full(self) -> bool:
+        """令牌是否已恢复满，满的桶可以丢弃，下次按新桶创建"""
+        elapsed = self.clock() - self.updated_at
+        return self.tokens + elapsed * self.rate >= self.capacity
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """服务商没有返回用量时粗略估算token数，与对话上下文的估算方式一致"""
+    from .chat_context import estimate_tokens as _estimate
+
+    return _estimate(text)
+
+
+def _seconds_until_tomorrow(now: datetime) -> int:
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return max(1, int(math.ceil((tomorrow - now).total_seconds())))
+
+
+class UsageTracker:
+    """用户大模型用量统计、限流和配额检查"""
+
+    def __init__(
+        self,
+        burst: float = USER_RATE_LIMIT_BURST,
+        rate: float = USER_RATE_LIMIT_PER_SECOND,
+        daily_quota: int = USER_DAILY_TOKEN_QUOTA,
+        flush_interval: float = USAGE_FLUSH_INTERVAL,
+        max_users: int = USER_RATE_LIMIT_MAX_USERS,
+        session_factory: Optional[Callable[[], Any]] = SessionLocal,
+        clock: Callable[[], float] = time.monotonic,
+        now: Callable[[], datetime] = datetime.now,
+    ):
+        self.burst = burst
+        self.rate = rate
+        self.daily_quota = daily_quota
+        self.flush_interval = flush_interval
+        self.max_users = max_users
+        # 为None时只在内存中统计，不写数据库
+        self.session_factory = session_factory
+        self.clock = clock
+        self.now = now
+        self._lock = threading.Lock()
+        # 按最近使用排序，最久未使用的在前
+        self._buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        # user_id -> (日期, 当天已用token数)
+        self._daily: Dict[int, Tuple[date, int]] = {}
+        self._pending: List[Dict[str, Any]] = []
+        self._flusher: Optional[threading.Thread] = None
+        self.rejected = 0
+
+    def _load_daily_tokens(self, user_id: int, day: date) -> int:
+        if self.session_factory is None:
+            return 0
+        db = self.session_factory()
+        try:
+            row = (
+                db.query(LLMUsageDaily)
+                .filter(LLMUsageDaily.user_id == user_id, LLMUsageDaily.day == day)
+                .first()
+            )
+            return (row.prompt_tokens + row.completion_tokens) if row else 0
+        except Exception as e:
+            print(f"[Usage] 读取用户 {user_id} 当天用量失败: {str(e)}")
+            return 0
+        finally:
+            db.close()
+
+    def daily_tokens(self, user_id: int) -> int:
+        """用户当天已用的token数"""
+        today = self.now().date()
+        with self._lock:
+            cached = self._daily.get(user_id)
+            if cached and cached[0] == today:
+                return cached[1]
+        used = self._load_daily_tokens(user_id, today)
+        with self._lock:
+            cached = self._daily.get(user_id)
+            # 加载期间已有新记录时以内存中的计数为准
+            if not cached or cached[0] != today:
+                self._daily[user_id] = (today, used)
+            return self._daily[user_id][1]
+
+    def check(self, user_id: int, cost: float = 1):
+        """
+        调用模型前检查用户的速率限制和当天配额
+
+        Raises:
+            QuotaExceededError: 超出限制，retry_after为建议的等待秒数
+        """
+        if self.daily_quota and self.daily_tokens(user_id) >= self.daily_quota:
+            with self._lock:
+                self.rejected += 1
+            raise QuotaExceededError(
+                "今日AI用量已达上限，请明天再试", _seconds_until_tomorrow(self.now())
+            )
+
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                self._evict_buckets()
+                bucket = TokenBucket(self.burst, self.rate, self.clock)
+                self._buckets[user_id] = bucket
+            else:
+                self._buckets.move_to_end(user_id)
+            allowed, wait = bucket.consume(cost)
+            if not allowed:
+                self.rejected += 1
+        if not allowed:
+            raise QuotaExceededError(
+                "请求过于频繁，请稍后再试", max(1, int(math.ceil(wait)))
+            )
+
+    def _evict_buckets(self):
+        """新建令牌桶前淘汰已恢复满的桶，数量仍达到上限时淘汰最久未使用的，需持有锁"""
+        while self._buckets:
+            user_id, bucket = next(iter(self._buckets.items()))
+            if not bucket.is_full() and len(self._buckets) < self.max_users:
+                break
+            del self._buckets[user_id]
+
+    def record(
+        self,
+        user_id: Optional[int],
+        operation: str,
+        model: Optional[str],
+        prompt_tokens: int,
+        completion_tokens: int,
+        latency: float,
+        success: bool = True,
+    ):
+        """记录一次大模型调用"""
+        if user_id is not None and success:
+            total = prompt_tokens + completion_tokens
+            today = self.now().date()
+            self.daily_tokens(user_id)
+            with self._lock:
+                day, used = self._daily.get(user_id, (today, 0))
+                self._daily[user_id] = (today, used + total if day == today else total)
+
+        if self.session_factory is None:
+            return
+        with self._lock:
+            self._pending.append(
+                {
+                    "user_id": user_id,
+                    "operation": operation,
+                    "model": model,
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "latency_ms": int(latency * 1000),
+                    "success": success,
+                    "created_at": datetime.utcnow(),
+                    "day": self.now().date(),
+                }
+            )
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self.flush_interval <= 0:
+            self.flush()
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name="llm-usage-flusher", daemon=True
+            )
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self) -> int:
+        """把缓冲中的用量记录批量写入数据库，返回写入条数"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending or self.session_factory is None:
+            return 0
+
+        # 先在内存中按用户和日期汇总，每个用户每天只更新一行
+        rollups: Dict[Tuple[int, date], Dict[str, int]] = {}
+        for item in pending:
+            if item["user_id"] is None or not item["success"]:
+                continue
+            rollup = rollups.setdefault(
+                (item["user_id"], item["day"]),
+                {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0},
+            )
+            rollup["requests"] += 1
+            rollup["prompt_tokens"] += item["prompt_tokens"]
+            rollup["completion_tokens"] += item["completion_tokens"]
+
+        db = self.session_factory()
+        try:
+            db.bulk_insert_mappings(
+                LLMUsage,
+                [{k: v for k, v in item.items() if k != "day"} for item in pending],
+            )
+            for (user_id, day), rollup in rollups.items():
+                row = (
+                    db.query(LLMUsageDaily)
+                    .filter(LLMUsageDaily.user_id == user_id, LLMUsageDaily.day == day)
+                    .first()
+                )
+                if row is None:
+                    db.add(LLMUsageDaily(user_id=user_id, day=day, **rollup))
+                else:
+                    row.requests += rollup["requests"]
+                    row.prompt_tokens += rollup["prompt_tokens"]
+                    row.completion_tokens += rollup["completion_tokens"]
+            db.commit()
+            return len(pending)
+        except Exception as e:
+            db.rollback()
+            print(f"[Usage] 写入用量记录失败，丢弃 {len(pending)} 条: {str(e)}")
+            print(f"错误堆栈:\n{traceback.format_exc()}")
+            return 0
+        finally:
+            db.close()
+
+    def reset(self):
+        """清空内存中的限流状态和计数"""
+        with self._lock:
+            self._buckets.clear()
+            self._daily.clear()
+            self._pending.clear()
+            self.rejected = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "tracked_users": len(self._buckets),
+                "pending_records": len(self._pending),
+                "rejected": self.rejected,
+                "burst": self.burst,
+                "rate_per_second": self.rate,
+                "daily_token_quota": self.daily_quota,
+            }
+
+
+# 全局共享的用量统计
+usage_tracker = UsageTracker()
+
+
+def check_llm_quota(user_id: int, kind: str = "chat"):
+    """
+    检查用户是否可以发起一次大模型请求，聊天、图片识别和报表接口共用
+
+    Args:
+        user_id: 用户ID
+        kind: 请求类型(chat/image/analysis)，决定消耗的令牌数
+
+    Raises:
+        QuotaExceededError: 超出限流或当天配额，由路由转换为429和Retry-After
+    """
+    if not LLM_QUOTA_ENABLED:
+        return
+    try:
+        usage_tracker.check(user_id, REQUEST_COSTS.get(kind, 1))
+    except QuotaExceededError as e:
+        print(f"用户 {user_id} 的请求被限流: {e.message}，{e.retry_after}秒后可重试")
+        raise
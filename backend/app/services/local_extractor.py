@@ -0,0 +1,673 @@
+"""
+本地规则记账信息提取
+
+针对"午饭35"、"打车 二十块"这类简短记账消息，在本地用规则提取金额、日期、时间和分类，
+置信度足够高时可以跳过一次大模型调用。输出字段与大模型提取结果保持一致。
+"""
+
+import re
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+# 中文数字
+CN_DIGITS = {
+    "零": 0,
+    "〇": 0,
+    "一": 1,
+    "壹": 1,
+    "二": 2,
+    "贰": 2,
+    "两": 2,
+    "三": 3,
+    "叁": 3,
+    "四": 4,
+    "肆": 4,
+    "五": 5,
+    "伍": 5,
+    "六": 6,
+    "陆": 6,
+    "七": 7,
+    "柒": 7,
+    "八": 8,
+    "捌": 8,
+    "九": 9,
+    "玖": 9,
+}
+CN_UNITS = {"十": 10, "拾": 10, "百": 100, "佰": 100, "千": 1000, "仟": 1000}
+CN_BIG_UNITS = {"万": 10000, "亿": 100000000}
+CN_NUMBER_CHARS = "".join(CN_DIGITS) + "".join(CN_UNITS) + "".join(CN_BIG_UNITS)
+
+# 数字后的金额倍数单位
+AMOUNT_MULTIPLIERS = {"k": 1000, "千": 1000, "w": 10000, "万": 10000}
+
+# 分类关键词，同一分类内按出现顺序匹配，所有关键词整体按长度优先匹配
+EXPENSE_CATEGORY_KEYWORDS = {
+    "餐饮美食": [
+        "早餐",
+        "早饭",
+        "早点",
+        "午餐",
+        "午饭",
+        "中饭",
+        "晚餐",
+        "晚饭",
+        "夜宵",
+        "宵夜",
+        "外卖",
+        "吃饭",
+        "聚餐",
+        "食堂",
+        "奶茶",
+        "咖啡",
+        "饮料",
+        "买水",
+        "矿泉水",
+        "水果",
+        "零食",
+        "火锅",
+        "烧烤",
+        "麻辣烫",
+        "面条",
+        "米粉",
+        "快餐",
+        "麦当劳",
+        "肯德基",
+        "星巴克",
+        "喜茶",
+        "蜜雪",
+        "瑞幸",
+        "餐厅",
+        "饭",
+    ],
+    "交通出行": [
+        "打车",
+        "滴滴",
+        "出租车",
+        "网约车",
+        "地铁",
+        "公交",
+        "高铁",
+        "动车",
+        "火车",
+        "机票",
+        "飞机",
+        "加油",
+        "油费",
+        "停车",
+        "过路费",
+        "高速费",
+        "共享单车",
+        "单车",
+        "车费",
+        "车票",
+    ],
+    "服饰美容": [
+        "衣服",
+        "裤子",
+        "裙子",
+        "外套",
+        "鞋",
+        "帽子",
+        "理发",
+        "剪头",
+        "美发",
+        "化妆品",
+        "护肤",
+        "面膜",
+        "口红",
+        "美甲",
+    ],
+    "日用百货": [
+        "超市",
+        "便利店",
+        "日用品",
+        "纸巾",
+        "卫生纸",
+        "洗发水",
+        "沐浴露",
+        "牙膏",
+        "洗衣液",
+        "洗洁精",
+        "垃圾袋",
+    ],
+    "住房物业": [
+        "房租",
+        "租房",
+        "水电",
+        "电费",
+        "水费",
+        "燃气",
+        "煤气",
+        "物业",
+        "宽带",
+        "房贷",
+    ],
+    "医疗健康": [
+        "医院",
+        "看病",
+        "挂号",
+        "门诊",
+        "体检",
+        "买药",
+        "药店",
+        "药",
+        "牙科",
+        "看牙",
+    ],
+    "文教娱乐": [
+        "电影",
+        "买书",
+        "书",
+        "课程",
+        "学费",
+        "培训",
+        "游戏",
+        "充值",
+        "KTV",
+        "门票",
+        "旅游",
+        "健身",
+        "会员",
+    ],
+    "人情往来": ["发红包", "份子钱", "随礼", "请客", "礼物", "送礼"],
+}
+
+INCOME_CATEGORY_KEYWORDS = {
+    "工资薪酬": ["发工资", "工资", "薪水", "薪资"],
+    "奖金": ["年终奖", "奖金", "绩效"],
+    "退款": ["退款", "退货", "退钱"],
+    "投资理财": ["理财", "利息", "股票", "基金", "分红"],
+    "兼职收入": ["兼职", "外快", "副业"],
+    "租金收入": ["收房租", "收租", "租金"],
+    "礼金收入": ["收到红包", "收红包", "抢红包", "礼金"],
+    "中奖收入": ["中奖", "彩票"],
+    "意外所得": ["捡到", "捡了"],
+}
+
+# 表示收入的动词，命中但没有具体分类时归为"其他收入"
+INCOME_HINTS = ["收到", "到账", "进账", "入账", "赚了", "挣了"]
+
+# 疑问句交给大模型处理，可能是查询而非记账
+QUESTION_HINTS = ["?", "？", "吗", "多少", "怎么", "什么", "是不是", "几笔", "哪"]
+
+# 描述中需要去掉的口语填充词
+FILLER_WORDS = [
+    "帮我记一下",
+    "帮我记",
+    "记一笔",
+    "记一下",
+    "记账",
+    "记下",
+    "一共花了",
+    "总共花了",
+    "一共",
+    "总共",
+    "大概",
+    "花了",
+    "花费",
+    "用了",
+    "付了",
+    "支付",
+    "消费",
+    "我",
+    "了",
+]
+
+# 数字后紧跟这些量词时不是金额
+NON_AMOUNT_SUFFIXES = "个只件斤次岁号点天月年%人楼层位杯碗份瓶张本"
+
+WEEKDAY_CHARS = {
+    "一": 0,
+    "二": 1,
+    "三": 2,
+    "四": 3,
+    "五": 4,
+    "六": 5,
+    "日": 6,
+    "天": 6,
+    "1": 0,
+    "2": 1,
+    "3": 2,
+    "4": 3,
+    "5": 4,
+    "6": 5,
+    "7": 6,
+}
+
+RELATIVE_DAYS = [
+    ("大前天", -3),
+    ("前天", -2),
+    ("昨天", -1),
+    ("昨日", -1),
+    ("昨晚", -1),
+    ("今天", 0),
+    ("今日", 0),
+    ("今早", 0),
+    ("今晚", 0),
+]
+
+_CN_NUM = f"[{CN_NUMBER_CHARS}]+(?:点[{''.join(CN_DIGITS)}]+)?"
+
+DATE_PATTERNS = [
+    re.compile(r"(\d{4})[-/年.](\d{1,2})[-/月.](\d{1,2})[日号]?"),
+    re.compile(r"(\d{1,2})月(\d{1,2})[日号]"),
+]
+WEEKDAY_PATTERN = re.compile(r"(上上|上|这|本)?(?:周|星期|礼拜)([一二三四五六日天1-7])")
+TIME_PATTERN = re.compile(
+    r"(早上|上午|中午|下午|晚上|凌晨)?\s*(?:(\d{1,2})[:：](\d{2})"
+    rf"|(\d{{1,2}}|[{''.join(CN_DIGITS)}十]+)点(半|(\d{{1,2}})分?)?)"
+)
+# "三点五元"、"两点五块"中的"点"是小数点，不是时间
+POINT_DECIMAL_PATTERN = re.compile(
+    rf"点([\d{''.join(CN_DIGITS)}]+)\s*(块钱|块|元|角|毛)?"
+)
+# 千分位写法"1,500"优先于普通数字匹配，取值时去掉逗号；
+# 后面跟货币单位的"3点5元"按小数处理
+ARABIC_AMOUNT_PATTERN = re.compile(
+    r"[¥￥]?\s*(\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+|点\d+(?=\s*[块元]))?)\s*([kKwW千万])?\s*(块钱|块|元|rmb|RMB)?"
+    r"(?:\s*(\d|[一二三四五六七八九])\s*(?:毛|角)?)?"
+)
+CN_AMOUNT_PATTERN = re.compile(
+    rf"({_CN_NUM})\s*(块钱|块|元)?(?:\s*([{''.join(CN_DIGITS)}])\s*(?:毛|角)?)?"
+)
+
+
+def chinese_to_number(text: str) -> Optional[float]:
+    """
+    将中文数字转换为数值，支持"二十"、"一百零五"、"三点五"、"两万"等写法
+
+    口语中最后一个单位后直接跟的数字表示下一位，如"一百五"是150、"两千五"是2500、"一万五"是15000；
+    中间有"零"时按个位处理，如"一百零五"是105。
+
+    Returns:
+        float: 转换结果，无法转换时返回None
+    """
+    if not text:
+        return None
+
+    integer_part, _, decimal_part = text.partition("点")
+
+    total = 0
+    section = 0
+    number = 0
+    # 最近一个单位的值，遇到"零"后清空
+    last_unit = 0
+    for ch in integer_part:
+        if ch in CN_DIGITS:
+            number = CN_DIGITS[ch]
+            if number == 0:
+                last_unit = 0
+        elif ch in CN_UNITS:
+            # "十五"中的十前面没有数字，按一十处理
+            section += (number or 1) * CN_UNITS[ch]
+            number = 0
+            last_unit = CN_UNITS[ch]
+        elif ch in CN_BIG_UNITS:
+            section += number
+            total += (section or 1) * CN_BIG_UNITS[ch]
+            section = 0
+            number = 0
+            last_unit = CN_BIG_UNITS[ch]
+        else:
+            return None
+    if number and last_unit >= 100:
+        number *= last_unit // 10
+    value = float(total + section + number)
+
+    if decimal_part:
+        digits = ""
+        for ch in decimal_part:
+            if ch not in CN_DIGITS:
+                return None
+            digits += str(CN_DIGITS[ch])
+        value += float(f"0.{digits}")
+
+    return value
+
+
+def _parse_fraction(ch: Optional[str]) -> float:
+    """解析"块五"、"3块5毛"中的角位"""
+    if not ch:
+        return 0.0
+    if ch.isdigit():
+        return int(ch) / 10
+    return CN_DIGITS.get(ch, 0) / 10
+
+
+def parse_date(
+    text: str, today: date
+) -> Tuple[Optional[date], Optional[Tuple[int, int]]]:
+    """
+    解析消息中的绝对或相对日期
+
+    Returns:
+        tuple: (日期, 匹配位置)，未提及日期时返回(None, None)
+    """
+    match = DATE_PATTERNS[0].search(text)
+    if match:
+        try:
+            return (
+                date(int(match.group(1)), int(match.group(2)), int(match.group(3))),
+                match.span(),
+            )
+        except ValueError:
+            pass
+
+    match = DATE_PATTERNS[1].search(text)
+    if match:
+        try:
+            parsed = date(today.year, int(match.group(1)), int(match.group(2)))
+            # 未写年份且日期在未来，视为去年
+            if parsed > today:
+                parsed = parsed.replace(year=today.year - 1)
+            return parsed, match.span()
+        except ValueError:
+            pass
+
+    for word, offset in RELATIVE_DAYS:
+        index = text.find(word)
+        if index != -1:
+            return today + timedelta(days=offset), (index, index + len(word))
+
+    match = WEEKDAY_PATTERN.search(text)
+    if match:
+        prefix, weekday_char = match.group(1), match.group(2)
+        monday = today - timedelta(days=today.weekday())
+        weeks_back = {"上上": 2, "上": 1}.get(prefix, 0)
+        parsed = (
+            monday
+            - timedelta(weeks=weeks_back)
+            + timedelta(days=WEEKDAY_CHARS[weekday_char])
+        )
+        # 只说"周五"且还没到，指的是上周
+        if prefix is None and parsed > today:
+            parsed -= timedelta(weeks=1)
+        return parsed, match.span()
+
+    return None, None
+
+
+def _is_decimal_point(text: str, match: "re.Match") -> bool:
+    """
+    "X点Y"是否是小数金额而不是时间
+
+    后面跟货币单位（"三点五元"）时是金额；没有"下午"等时段词时，
+    中文数字的"三点五"也按小数处理，交给金额解析，不当作03:00。
+    """
+    if (
+        match.group(4) is None
+        or match.group(5) == "半"
+        or match.group(0).endswith("分")
+    ):
+        return False
+    decimal = POINT_DECIMAL_PATTERN.match(text, match.end(4))
+    if not decimal:
+        return False
+    if decimal.group(2):
+        return True
+    return not match.group(1) and not match.group(4).isdigit()
+
+
+def parse_time(text: str) -> Tuple[Optional[str], Optional[Tuple[int, int]]]:
+    """
+    解析消息中的时间，返回HH:MM格式
+
+    Returns:
+        tuple: (时间字符串, 匹配位置)，未提及时间时返回(None, None)
+    """
+    match = next(
+        (m for m in TIME_PATTERN.finditer(text) if not _is_decimal_point(text, m)),
+        None,
+    )
+    if not match:
+        return None, None
+
+    period = match.group(1)
+    if match.group(2) is not None:
+        hour, minute = int(match.group(2)), int(match.group(3))
+    else:
+        hour_text = match.group(4)
+        hour = int(hour_text) if hour_text.isdigit() else chinese_to_number(hour_text)
+        if hour is None:
+            return None, None
+        hour = int(hour)
+        if match.group(5) == "半":
+            minute = 30
+        elif match.group(6):
+            minute = int(match.group(6))
+        else:
+            minute = 0
+
+    if period in ("下午", "晚上") and hour < 12:
+        hour += 12
+    elif period == "中午" and hour < 11:
+        hour += 12
+
+    if hour > 23 or minute > 59:
+        return None, None
+    return f"{hour:02d}:{minute:02d}", match.span()
+
+
+def find_amounts(text: str) -> List[Tuple[float, Tuple[int, int]]]:
+    """
+    找出消息中所有金额表述
+
+    Returns:
+        list: [(金额, 匹配位置)]，按出现位置排序
+    """
+    amounts = []
+
+    for match in ARABIC_AMOUNT_PATTERN.finditer(text):
+        number, multiplier, unit, fraction = match.groups()
+        end = match.end()
+        # 没有货币单位时，后面跟量词的数字不是金额
+        if not unit and not multiplier and end < len(text):
+            if text[end] in NON_AMOUNT_SUFFIXES:
+                continue
+        value = float(number.replace(",", "").replace("点", "."))
+        if multiplier:
+            value *= AMOUNT_MULTIPLIERS[multiplier.lower()]
+        if unit:
+            value += _parse_fraction(fraction)
+        elif fraction:
+            # "35 5"这种写法没有单位，只取第一个数字
+            end = match.start(4)
+        amounts.append((value, (match.start(), end)))
+
+    for match in CN_AMOUNT_PATTERN.finditer(text):
+        if not match.group(2):
+            # 没有货币单位的中文数字只接受"二十"、"两百"这类独立出现的整数表述
+            end = match.end(1)
+            standalone = end == len(text) or text[end] in " ,，。;；"
+            if not standalone or not any(
+                ch in CN_UNITS or ch in CN_BIG_UNITS for ch in match.group(1)
+            ):
+                continue
+            amounts.append(
+                (chinese_to_number(match.group(1)) or 0, (match.start(), end))
+            )
+            continue
+        value = chinese_to_number(match.group(1))
+        if value is None:
+            continue
+        value += _parse_fraction(match.group(3))
+        amounts.append((value, match.span()))
+
+    amounts = [item for item in amounts if item[0] > 0]
+    amounts.sort(key=lambda item: item[1][0])
+    return amounts
+
+
+def _sorted_keywords(mapping: Dict[str, List[str]]) -> List[Tuple[str, str]]:
+    pairs = [
+        (keyword, category) for category, words in mapping.items() for keyword in words
+    ]
+    return sorted(pairs, key=lambda pair: len(pair[0]), reverse=True)
+
+
+_EXPENSE_KEYWORDS = _sorted_keywords(EXPENSE_CATEGORY_KEYWORDS)
+_INCOME_KEYWORDS = _sorted_keywords(INCOME_CATEGORY_KEYWORDS)
+
+
+def match_category(text: str) -> Tuple[str, Optional[str], bool]:
+    """
+    根据关键词推断交易类型和分类
+
+    Returns:
+        tuple: (交易类型, 分类, 是否由关键词命中)
+    """
+    # 收入关键词优先，避免"收房租"被识别为"房租"支出
+    for keyword, category in _INCOME_KEYWORDS:
+        if keyword in text:
+            return "income", category, True
+    for keyword, category in _EXPENSE_KEYWORDS:
+        if keyword in text:
+            return "expense", category, True
+    if any(hint in text for hint in INCOME_HINTS):
+        return "income", "其他收入", False
+    return "expense", "其他支出", False
+
+
+def _clean_description(text: str, spans: List[Tuple[int, int]]) -> str:
+    """去掉金额、日期、时间和口语填充词后作为交易描述"""
+    chars = list(text)
+    for start, end in spans:
+        for i in range(start, end):
+            chars[i] = " "
+    description = "".join(chars)
+    for word in FILLER_WORDS:
+        description = description.replace(word, " ")
+    description = re.sub(r"[\s,，。.!！:：;；、~～]+", " ", description).strip()
+    return description.replace(" ", "")
+
+
+def extract_locally(
+    message: str, today: Optional[date] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    用本地规则提取记账信息
+
+    Args:
+        message: 用户消息
+        today: 当前日期，用于换算相对日期，默认为今天
+
+    Returns:
+        Dict: 与大模型提取结果相同的字段，另含confidence、missing_fields和source（"local"）；
+        没有识别到金额或消息像是提问时返回None
+    """
+    text = (message or "").strip()
+    if not text or len(text) > 50:
+        return None
+    if any(hint in text for hint in QUESTION_HINTS):
+        return None
+
+    today = today or datetime.now().date()
+
+    # 先去掉日期和时间，避免其中的数字被当成金额
+    parsed_date, date_span = parse_date(text, today)
+    masked = text
+    spans = []
+    if date_span:
+        spans.append(date_span)
+        masked = (
+            masked[: date_span[0]]
+            + " " * (date_span[1] - date_span[0])
+            + masked[date_span[1] :]
+        )
+    parsed_time, time_span = parse_time(masked)
+    if time_span:
+        spans.append(time_span)
+        masked = (
+            masked[: time_span[0]]
+            + " " * (time_span[1] - time_span[0])
+            + masked[time_span[1] :]
+        )
+
+    amounts = find_amounts(masked)
+    if not amounts:
+        return None
+
+    amount = amounts[0][0]
+    spans.extend(span for _, span in amounts)
+
+    transaction_type, category, keyword_hit = match_category(text)
+    description = _clean_description(text, spans)
+
+    missing_fields = []
+    confidence = 0.6
+    if keyword_hit:
+        confidence += 0.25
+    if description:
+        confidence += 0.1
+    else:
+        description = category
+    if len(text) <= 20:
+        confidence += 0.05
+    if len(amounts) > 1:
+        # 一条消息多个金额时无法确定对应关系，交给大模型
+        confidence = min(confidence, 0.5)
+
+    result = {
+        "type": transaction_type,
+        "amount": round(amount, 2),
+        "date": (parsed_date or today).strftime("%Y-%m-%d"),
+        "description": description,
+        "category": category,
+        "confidence": round(min(confidence, 0.99), 2),
+        "missing_fields": missing_fields,
+        # 置信度是本地规则的启发式打分，自动记账据此区分来源
+        "source": "local",
+    }
+    if parsed_time:
+        result["time"] = parsed_time
+    return result
+
+
+# 一条消息记多笔账时的分隔符，英文逗号两侧都是数字时是千分位，不分隔
+TRANSACTION_SEPARATOR_PATTERN = re.compile(
+    r"(?<!\d),|,(?!\d)|[，；;。、\n]|还有|另外|然后"
+)
+# 多笔记账消息的长度上限
+MAX_BATCH_MESSAGE_LENGTH = 200
+
+
+def extract_locally_batch(
+    message: str, today: Optional[date] = None
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    用本地规则提取一条消息中的多笔记账，如"午饭30，打车20，买水3块"
+
+    按逗号、分号等分隔成多段，每一段都必须能单独提取出一笔交易；
+    没有写日期的段沿用前面最近一段的日期，如"昨天午饭30，打车20"两笔都记在昨天。
+
+    Returns:
+        list: 每笔交易的提取结果；消息只有一段或任意一段无法提取时返回None
+    """
+    text = (message or "").strip()
+    if not text or len(text) > MAX_BATCH_MESSAGE_LENGTH:
+        return None
+    if any(hint in text for hint in QUESTION_HINTS):
+        return None
+
+    segments = [
+        segment.strip()
+        for segment in TRANSACTION_SEPARATOR_PATTERN.split(text)
+        if segment.strip()
+    ]
+    if len(segments) < 2:
+        return None
+
+    today = today or datetime.now().date()
+    results = []
+    inherited_date = None
+    for segment in segments:
+        result = extract_locally(segment, today)
+        if result is None:
+            return None
+        explicit_date, _ = parse_date(segment, today)
+        if explicit_date is not None:
+            inherited_date = result["date"]
+        elif inherited_date is not None:
+            result["date"] = inherited_date
+        results.append(result)
+    return results
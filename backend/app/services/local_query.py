@@ -0,0 +1,383 @@
+"""
+本地规则账单查询
+
+"上个月交通花了多少"、"今年最大一笔支出"这类提问大多是几种固定句式：时间范围 + 分类/收支类型 + 汇总方式。
+在本地用规则解析成查询条件，用与报表接口相同的查询（report_queries）取数并生成回答，不调用大模型。
+消息中有任何无法识别的内容时放弃解析，交给大模型处理，避免答非所问。
+"""
+
+import re
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from ..models.models import TransactionType
+from .local_extractor import (
+    CN_DIGITS,
+    EXPENSE_CATEGORY_KEYWORDS,
+    INCOME_CATEGORY_KEYWORDS,
+    chinese_to_number,
+    find_amounts,
+    parse_date,
+)
+from .report_queries import (
+    query_category_ranking,
+    query_summary,
+    query_transaction_ranking,
+)
+
+# 本地解析的提问长度上限，更长的消息通常不是简单查询
+MAX_QUERY_LENGTH = 30
+
+# 汇总方式，按顺序匹配
+AGGREGATE_PATTERNS = [
+    (
+        "top_category",
+        re.compile(
+            r"哪(?:类|一类|个分类|方面|块)|花在哪|什么(?:类|方面)?花[得的]?最多"
+        ),
+    ),
+    ("count", re.compile(r"几笔|多少笔|几次|多少次")),
+    (
+        "max",
+        re.compile(
+            r"最大(?:的)?(?:一笔)?|最贵(?:的)?(?:一笔)?|最多的一笔|最高(?:的)?(?:一笔)?"
+        ),
+    ),
+    ("balance", re.compile(r"结余|余额|剩[了下]?多少|存[了下]?多少")),
+    ("total", re.compile(r"多少钱?|一共|总共|合计|总计|总额")),
+]
+TOP_CATEGORY_SUFFIX_PATTERN = re.compile(r"最多|最大|最高")
+# 本地无法回答的提问
+UNSUPPORTED_PATTERN = re.compile(
+    r"平均|对比|比较|相比|趋势|为什么|怎么|建议|分析|每天|每月|每周|占比|预算|超支"
+)
+INCOME_PATTERN = re.compile(r"收入|赚[了的]?|挣[了的]?|进账|到账|入账")
+EXPENSE_PATTERN = re.compile(r"支出|花销|开销|开支|花[了的得掉费]?|消费|用[了掉]")
+# 解析完所有成分后允许剩下的口语词
+FILLER_PATTERN = re.compile(
+    r"帮我|给我|请问|查一下|查查|查询|查|看一下|看看|看|告诉我|统计一下|统计|算一下|"
+    r"我|的|了|是|有|在|钱|块|元|上|共|总|都|吗|呢|啊|呀|吧|一下|[\s,，。.!！?？~～、]"
+)
+
+_CN_MONTH = f"[{''.join(CN_DIGITS)}十]{{1,3}}"
+RANGE_PATTERNS = [
+    ("this_week", re.compile(r"(?:这|本)(?:周|星期|礼拜)(?![一二三四五六日天1-7])")),
+    ("last_week", re.compile(r"上(?:个)?(?:周|星期|礼拜)(?![一二三四五六日天1-7])")),
+    ("this_month", re.compile(r"(?:这|本)(?:个)?月")),
+    ("last_month", re.compile(r"上(?:个)?月")),
+    ("this_year", re.compile(r"今年|本年")),
+    ("last_year", re.compile(r"去年")),
+    ("recent_days", re.compile(rf"(?:最近|近)(\d{{1,3}}|{_CN_MONTH})天")),
+    ("recent_week", re.compile(r"(?:最近|近)(?:一)?(?:周|星期)")),
+    ("recent_month", re.compile(r"(?:最近|近)(?:一)?个月")),
+    (
+        "month",
+        re.compile(
+            rf"(?:(\d{{4}})年)?(\d{{1,2}}|{_CN_MONTH})月份?(?!\d|[{''.join(CN_DIGITS)}十]+[日号])"
+        ),
+    ),
+]
+RANGE_LABELS = {
+    "this_week": "本周",
+    "last_week": "上周",
+    "this_month": "本月",
+    "last_month": "上个月",
+    "this_year": "今年",
+    "last_year": "去年",
+    "recent_week": "最近一周",
+    "recent_month": "最近一个月",
+}
+
+
+def _category_aliases() -> List[Tuple[str, str, str]]:
+    """分类的叫法：(叫法, 分类, 交易类型)，按长度优先匹配"""
+    aliases = []
+    for mapping, transaction_type in (
+        (EXPENSE_CATEGORY_KEYWORDS, "expense"),
+        (INCOME_CATEGORY_KEYWORDS, "income"),
+    ):
+        for category in mapping:
+            aliases.append((category, category, transaction_type))
+            aliases.append((category[:2], category, transaction_type))
+    extra = {
+        "吃饭": "餐饮美食",
+        "吃喝": "餐饮美食",
+        "饮食": "餐饮美食",
+        "出行": "交通出行",
+        "打车": "交通出行",
+        "衣服": "服饰美容",
+        "房租": "住房物业",
+        "看病": "医疗健康",
+        "娱乐": "文教娱乐",
+        "红包": "人情往来",
+    }
+    aliases.extend((alias, category, "expense") for alias, category in extra.items())
+    return sorted(aliases, key=lambda alias: len(alias[0]), reverse=True)
+
+
+CATEGORY_ALIASES = _category_aliases()
+
+
+def _mask(text: str, span: Tuple[int, int]) -> str:
+    return text[: span[0]] + " " * (span[1] - span[0]) + text[span[1] :]
+
+
+def _parse_number(text: str) -> Optional[int]:
+    if text.isdigit():
+        return int(text)
+    value = chinese_to_number(text)
+    return int(value) if value else None
+
+
+def _month_range(year: int, month: int) -> Tuple[date, date]:
+    start = date(year, month, 1)
+    next_month = date(year + month // 12, month % 12 + 1, 1)
+    return start, next_month - timedelta(days=1)
+
+
+def parse_time_range(
+    text: str, today: date
+) -> Optional[Tuple[date, date, str, Tuple[int, int]]]:
+    """
+    解析提问中的时间范围
+
+    Returns:
+        tuple: (开始日期, 结束日期, 时间描述, 匹配位置)，未提及时间时返回None
+    """
+    for name, pattern in RANGE_PATTERNS:
+        match = pattern.search(text)
+        if not match:
+            continue
+        label = RANGE_LABELS.get(name)
+        monday = today - timedelta(days=today.weekday())
+        if name == "this_week":
+            start, end = monday, today
+        elif name == "last_week":
+            start, end = monday - timedelta(days=7), monday - timedelta(days=1)
+        elif name == "this_month":
+            start, end = date(today.year, today.month, 1), today
+        elif name == "last_month":
+            end = date(today.year, today.month, 1) - timedelta(days=1)
+            start = date(end.year, end.month, 1)
+        elif name == "this_year":
+            start, end = date(today.year, 1, 1), today
+        elif name == "last_year":
+            start, end = date(today.year - 1, 1, 1), date(today.year - 1, 12, 31)
+        elif name == "recent_days":
+            days = _parse_number(match.group(1))
+            if not days:
+                return None
+            start, end = today - timedelta(days=days - 1), today
+            label = f"最近{days}天"
+        elif name == "recent_week":
+            start, end = today - timedelta(days=6), today
+        elif name == "recent_month":
+            start, end = today - timedelta(days=29), today
+        else:
+            month = _parse_number(match.group(2))
+            if not month or month > 12:
+                return None
+            if match.group(1):
+                year = int(match.group(1))
+            else:
+                # 未写年份且月份还没到，指的是去年
+                year = today.year if month <= today.month else today.year - 1
+            start, end = _month_range(year, month)
+            end = min(end, today)
+            label = f"{year}年{month}月" if year != today.year else f"{month}月"
+        return start, end, label, match.span()
+
+    parsed, span = parse_date(text, today)
+    if parsed is not None:
+        word = text[span[0] : span[1]]
+        label = (
+            word if not re.search(r"\d", word) else f"{parsed.month}月{parsed.day}日"
+        )
+        return parsed, parsed, label, span
+    return None
+
+
+def parse_spending_query(
+    message: str, today: Optional[date] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    把收支提问解析为查询条件
+
+    Args:
+        message: 用户消息
+        today: 当前日期，用于换算相对时间，默认为今天
+
+    Returns:
+        dict: start_date、end_date、period、type、category、aggregate；
+        不是简单查询或有无法识别的内容时返回None
+    """
+    text = (message or "").strip()
+    if not text or len(text) > MAX_QUERY_LENGTH or UNSUPPORTED_PATTERN.search(text):
+        return None
+    today = today or datetime.now().date()
+    masked = text
+
+    aggregate = None
+    for name, pattern in AGGREGATE_PATTERNS:
+        if pattern.search(masked):
+            aggregate = name
+            break
+    if aggregate is None:
+        return None
+    # "一共多少"、"哪类支出最多"这类说法里的汇总词全部去掉
+    patterns = [
+        pattern for name, pattern in AGGREGATE_PATTERNS if name in (aggregate, "total")
+    ]
+    if aggregate == "top_category":
+        patterns.append(TOP_CATEGORY_SUFFIX_PATTERN)
+    for pattern in patterns:
+        for match in pattern.finditer(masked):
+            masked = _mask(masked, match.span())
+
+    time_range = parse_time_range(masked, today)
+    if time_range is None:
+        # 没说时间时按本月统计
+        start, end, period = date(today.year, today.month, 1), today, "本月"
+    else:
+        start, end, period, span = time_range
+        masked = _mask(masked, span)
+
+    # 去掉时间后仍有金额，说明是在记账而不是提问
+    if find_amounts(masked):
+        return None
+
+    category = None
+    transaction_type = None
+    for alias, alias_category, alias_type in CATEGORY_ALIASES:
+        index = masked.find(alias)
+        if index != -1:
+            category, transaction_type = alias_category, alias_type
+            masked = _mask(masked, (index, index + len(alias)))
+            break
+
+    for pattern, pattern_type in (
+        (INCOME_PATTERN, "income"),
+        (EXPENSE_PATTERN, "expense"),
+    ):
+        match = pattern.search(masked)
+        if match:
+            transaction_type = transaction_type or pattern_type
+            masked = _mask(masked, match.span())
+    # 收支词之外还剩下别的内容（如"给女朋友花了多少"），本地无法准确回答
+    if FILLER_PATTERN.sub("", masked):
+        return None
+    if aggregate == "top_category" and category:
+        return None
+
+    return {
+        "start_date": start,
+        "end_date": end,
+        "period": period,
+        "type": transaction_type or "expense",
+        "category": category,
+        "aggregate": aggregate,
+    }
+
+
+def _money(value) -> str:
+    return f"{float(value or 0):.2f}"
+
+
+def _totals(
+    db: Session, user_id: int, query: Dict[str, Any], transaction_type
+) -> Tuple[float, int]:
+    """查询范围内某类收支（或其中一个分类）的总金额和笔数"""
+    if query.get("category"):
+        ranking = query_category_ranking(
+            db, user_id, transaction_type, query["start_date"], query["end_date"]
+        )
+        item = next(
+            (item for item in ranking if item["category"] == query["category"]), None
+        )
+        return (item["total_amount"], item["count"]) if item else (0.0, 0)
+
+    summary = query_summary(
+        db, user_id, query["start_date"], query["end_date"], include_stats=True
+    )
+    stats = summary["transaction_stats"]
+    if transaction_type == TransactionType.INCOME:
+        return summary["total_income"], stats["income_count"]
+    return summary["total_expense"], stats["expense_count"]
+
+
+def execute_spending_query(db: Session, user_id: int, query: Dict[str, Any]) -> str:
+    """
+    执行解析出的查询并生成回答，数据来自与 /reports 接口共用的报表查询
+
+    Returns:
+        str: 回答文本
+    """
+    kind = "收入" if query["type"] == "income" else "支出"
+    transaction_type = TransactionType(query["type"])
+    scope = f"{query['period']}（{query['start_date']}至{query['end_date']}）"
+    if query["start_date"] == query["end_date"]:
+        scope = f"{query['period']}（{query['start_date']}）"
+    subject = f"{query['category']}{kind}" if query.get("category") else kind
+
+    if query["aggregate"] == "balance":
+        summary = query_summary(db, user_id, query["start_date"], query["end_date"])
+        return (
+            f"{scope}收入 {_money(summary['total_income'])} 元，"
+            f"支出 {_money(summary['total_expense'])} 元，"
+            f"结余 {_money(summary['balance'])} 元。"
+        )
+
+    if query["aggregate"] == "max":
+        ranking = query_transaction_ranking(
+            db,
+            user_id,
+            transaction_type,
+            query["start_date"],
+            query["end_date"],
+            limit=1,
+            category=query.get("category"),
+        )
+        if not ranking:
+            return f"{scope}没有{subject}记录。"
+        top = ranking[0]
+        return (
+            f"{scope}最大的一笔{subject}是 {top['date']} 的"
+            f"「{top['description'] or top['category']}」，{_money(top['amount'])} 元。"
+        )
+
+    if query["aggregate"] == "top_category":
+        ranking = query_category_ranking(
+            db, user_id, transaction_type, query["start_date"], query["end_date"]
+        )[:3]
+        if not ranking:
+            return f"{scope}没有{kind}记录。"
+        text = "，".join(
+            f"{item['category']} {_money(item['total_amount'])} 元（{item['count']}笔）"
+            for item in ranking
+        )
+        return f"{scope}{kind}最多的是{ranking[0]['category']}。前几名：{text}。"
+
+    total, count = _totals(db, user_id, query, transaction_type)
+    if not count:
+        return f"{scope}没有{subject}记录。"
+    if query["aggregate"] == "count":
+        return f"{scope}共有 {count} 笔{subject}，合计 {_money(total)} 元。"
+    return f"{scope}{subject}共 {_money(total)} 元，{count} 笔。"
+
+
+def answer_locally(
+    message: str, db: Session, user_id: int, today: Optional[date] = None
+) -> Optional[str]:
+    """
+    尝试在本地回答收支提问
+
+    Returns:
+        str: 回答文本，无法解析时返回None，由调用方交给大模型
+    """
+    query = parse_spending_query(message, today)
+    if query is None:
+        return None
+    print(f"[LocalQuery] 本地解析账单查询: {query}")
+    return execute_spending_query(db, user_id, query)
@@ -0,0 +1,207 @@
+"""
+AI助手人设注册表
+
+进程内缓存所有助手的人设提示词和元数据，聊天链路和 /chat/personalities 只读内存，不查数据库：
+- 首次使用时从 ai_personalities 表加载，表为空或不可用时使用代码中预设的助手
+- 每份快照不可变，并带有根据内容计算的ETag，客户端可以用 If-None-Match 协商缓存
+- 每隔 PERSONALITY_RELOAD_INTERVAL 秒用一条轻量查询检查表是否有变化，有变化时重新加载；
+  导入助手后也可以调用 invalidate() 立即重新加载
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+from sqlalchemy import func
+
+from ..models.database import SessionLocal
+from ..models.models import AIPersonality
+from ..prompts.assistant import ASSISTANT_MAP, DEFAULT_ASSISTANT
+
+# 检查助手表是否变化的间隔（秒），0表示每次使用时都检查
+PERSONALITY_RELOAD_INTERVAL = float(os.getenv("PERSONALITY_RELOAD_INTERVAL", "30"))
+
+
+class Personality(NamedTuple):
+    id: int
+    system_prompt: str
+    # 只读的元数据，字段与预设助手的METADATA一致
+    metadata: Mapping[str, Any]
+    is_default: bool
+
+
+class PersonalitySnapshot(NamedTuple):
+    personalities: Mapping[int, Personality]
+    default_id: int
+    etag: str
+    # 生成快照时助手表的指纹，用于判断是否需要重新加载
+    fingerprint: Any
+
+
+def _preset_personalities() -> List[Personality]:
+    return [
+        Personality(
+            id=assistant_id,
+            system_prompt=assistant.SYSTEM_PROMPT,
+            metadata=MappingProxyType(dict(assistant.METADATA, id=assistant_id)),
+            is_default=assistant is DEFAULT_ASSISTANT,
+        )
+        for assistant_id, assistant in ASSISTANT_MAP.items()
+    ]
+
+
+def _row_to_personality(row: AIPersonality) -> Personality:
+    # 数据库中只有名称、描述和提示词，头像、英文名等展示字段沿用同ID预设助手的元数据
+    preset = ASSISTANT_MAP.get(row.id)
+    metadata = dict(preset.METADATA) if preset else {}
+    metadata.update(
+        {
+            "id": row.id,
+            "name": row.name,
+            "description": row.description or metadata.get("description", ""),
+        }
+    )
+    metadata.setdefault("personality_type", "")
+    return Personality(
+        id=row.id,
+        system_prompt=row.system_prompt or (preset.SYSTEM_PROMPT if preset else ""),
+        metadata=MappingProxyType(metadata),
+        is_default=bool(row.is_default),
+    )
+
+
+def build_snapshot(
+    personalities: List[Personality], fingerprint: Any = None
+) -> PersonalitySnapshot:
+    ordered = sorted(personalities, key=lambda p: p.id)
+    default = next((p for p in ordered if p.is_default), ordered[0])
+    payload = json.dumps(
+        [[p.id, p.system_prompt, dict(p.metadata), p.is_default] for p in ordered],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    etag = '"' + hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16] + '"'
+    return PersonalitySnapshot(
+        personalities=MappingProxyType({p.id: p for p in ordered}),
+        default_id=default.id,
+        etag=etag,
+        fingerprint=fingerprint,
+    )
+
+
+class PersonalityRegistry:
+    """助手人设注册表，线程安全"""
+
+    def __init__(
+        self,
+        session_factory: Optional[Callable[[], Any]] = SessionLocal,
+        reload_interval: float = PERSONALITY_RELOAD_INTERVAL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        # 为None时只使用预设助手
+        self.session_factory = session_factory
+        self.reload_interval = reload_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._snapshot: Optional[PersonalitySnapshot] = None
+        self._checked_at = 0.0
+        self.reloads = 0
+
+    def _fingerprint(self, db) -> Tuple:
+        """助手表的指纹：行数、最大ID和最后更新时间"""
+        count, max_id, updated_at = db.query(
+            func.count(AIPersonality.id),
+            func.max(AIPersonality.id),
+            func.max(AIPersonality.updated_at),
+        ).one()
+        return count, max_id, str(updated_at)
+
+    def _load(self) -> PersonalitySnapshot:
+        if self.session_factory is None:
+            return build_snapshot(_preset_personalities())
+        db = self.session_factory()
+        try:
+            fingerprint = self._fingerprint(db)
+            rows = db.query(AIPersonality).all()
+            personalities = [_row_to_personality(row) for row in rows]
+        except Exception as e:
+            print(f"[Personality] 从数据库加载助手失败，使用预设助手: {str(e)}")
+            return build_snapshot(_preset_personalities())
+        finally:
+            db.close()
+        if not personalities:
+            return build_snapshot(_preset_personalities(), fingerprint)
+        return build_snapshot(personalities, fingerprint)
+
+    def _changed(self, snapshot: PersonalitySnapshot) -> bool:
+        if self.session_factory is None:
+            return False
+        db = self.session_factory()
+        try:
+            return self._fingerprint(db) != snapshot.fingerprint
+        except Exception as e:
+            print(f"[Personality] 检查助手表变化失败: {str(e)}")
+            return False
+        finally:
+            db.close()
+
+    def snapshot(self) -> PersonalitySnapshot:
+        """当前快照，到达检查间隔时顺便检查助手表是否变化"""
+        snapshot = self._snapshot
+        now = self.clock()
+        if snapshot is not None and now - self._checked_at < self.reload_interval:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and now - self._checked_at < self.reload_interval:
+                return snapshot
+            if snapshot is None or self._changed(snapshot):
+                snapshot = self._load()
+                if self._snapshot is not None:
+                    print(f"[Personality] 助手配置已重新加载，ETag: {snapshot.etag}")
+                self._snapshot = snapshot
+                self.reloads += 1
+            self._checked_at = now
+            return snapshot
+
+    def invalidate(self):
+        """丢弃当前快照，下次使用时重新加载"""
+        with self._lock:
+            self._snapshot = None
+            self._checked_at = 0.0
+
+    def resolve_id(self, personality_id: Optional[int]) -> int:
+        """返回有效的助手ID，不存在时使用默认助手"""
+        snapshot = self.snapshot()
+        if personality_id in snapshot.personalities:
+            return personality_id
+        return snapshot.default_id
+
+    def exists(self, personality_id: int) -> bool:
+        return personality_id in self.snapshot().personalities
+
+    def get(self, personality_id: Optional[int]) -> Tuple[str, Mapping[str, Any]]:
+        """
+        根据ID获取助手提示词和元数据，与 get_assistant 的返回值一致
+
+        Returns:
+            tuple: (system_prompt, metadata)，ID不存在时返回默认助手
+        """
+        snapshot = self.snapshot()
+        personality = snapshot.personalities.get(personality_id)
+        if personality is None:
+            personality = snapshot.personalities[snapshot.default_id]
+        return personality.system_prompt, personality.metadata
+
+    def metadata_list(self) -> List[Dict[str, Any]]:
+        """所有助手的元数据，按ID排序"""
+        return [dict(p.metadata) for p in self.snapshot().personalities.values()]
+
+
+# 全局共享的助手注册表
+personality_registry = PersonalityRegistry()
@@ -0,0 +1,212 @@
+"""
+报表查询
+
+收支概览、分类排行和明细排行的数据库查询，/reports 接口和聊天中的账单查询工具共用，
+工具不再直接调用路由函数。结果为普通字典，由调用方转换为响应模型或压缩后交给模型。
+"""
+
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import desc, func
+from sqlalchemy.orm import Session
+
+from ..models.models import Transaction, TransactionType
+
+
+def resolve_date_range(
+    start_date: Optional[date] = None, end_date: Optional[date] = None
+) -> Tuple[date, date]:
+    """未指定的开始/结束日期默认为当月第一天/最后一天，datetime转换为date"""
+    today = date.today()
+    if not start_date:
+        start_date = date(today.year, today.month, 1)
+    if not end_date:
+        # 获取下个月的第一天，然后减去一天得到当月最后一天
+        if today.month == 12:
+            end_date = date(today.year + 1, 1, 1) - timedelta(days=1)
+        else:
+            end_date = date(today.year, today.month + 1, 1) - timedelta(days=1)
+
+    # 确保参数是date类型而不是datetime类型
+    if isinstance(start_date, datetime):
+        start_date = start_date.date()
+    if isinstance(end_date, datetime):
+        end_date = end_date.date()
+    return start_date, end_date
+
+
+def _period_filters(user_id: int, start_date: date, end_date: date) -> list:
+    # 使用 < next_day 而不是 <= end_date，包含结束日期当天的所有交易
+    next_day = end_date + timedelta(days=1)
+    return [
+        Transaction.user_id == user_id,
+        Transaction.is_deleted == False,
+        Transaction.transaction_date >= start_date,
+        Transaction.transaction_date < next_day,
+    ]
+
+
+def query_summary(
+    db: Session,
+    user_id: int,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    include_stats: bool = False,
+) -> Dict[str, Any]:
+    """
+    查询一段时间的总收入、总支出和结余
+
+    Args:
+        include_stats: 是否同时统计交易笔数、平均金额和日均笔数
+
+    Returns:
+        dict: total_income、total_expense、balance、start_date、end_date、transaction_stats
+    """
+    start_date, end_date = resolve_date_range(start_date, end_date)
+    print(f"[Summary] Using date range: {start_date} to {end_date}")
+    filters = _period_filters(user_id, start_date, end_date)
+
+    # 按收支类型一次查出笔数和总金额
+    totals = {
+        row.type: (row.count or 0, float(row.sum or 0))
+        for row in db.query(
+            Transaction.type,
+            func.count(Transaction.id).label("count"),
+            func.sum(Transaction.amount).label("sum"),
+        )
+        .filter(*filters)
+        .group_by(Transaction.type)
+        .all()
+    }
+    income_count, total_income = totals.get(TransactionType.INCOME, (0, 0.0))
+    expense_count, total_expense = totals.get(TransactionType.EXPENSE, (0, 0.0))
+
+    transaction_stats = None
+    if include_stats:
+        print("[Summary] Including transaction statistics")
+        total_count = sum(count for count, _ in totals.values())
+        # 计算日均交易笔数
+        days_count = (end_date - start_date).days + 1
+        daily_avg = total_count / days_count if days_count > 0 else 0
+        transaction_stats = {
+            "total_count": total_count,
+            "income_count": income_count,
+            "expense_count": expense_count,
+            "avg_income": total_income / income_count if income_count > 0 else 0,
+            "avg_expense": total_expense / expense_count if expense_count > 0 else 0,
+            "daily_avg": round(daily_avg, 1),
+        }
+
+    return {
+        "total_income": total_income,
+        "total_expense": total_expense,
+        "balance": total_income - total_expense,
+        "start_date": start_date,
+        "end_date": end_date,
+        "transaction_stats": transaction_stats,
+    }
+
+
+def query_category_ranking(
+    db: Session,
+    user_id: int,
+    transaction_type: TransactionType,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+) -> List[Dict[str, Any]]:
+    """
+    查询各分类的金额、占比和笔数，按金额从高到低
+
+    Returns:
+        list: 每项包含 category、total_amount、percentage、count
+    """
+    start_date, end_date = resolve_date_range(start_date, end_date)
+    print(f"[Category Ranking] Using date range: {start_date} to {end_date}")
+
+    # 查询每个类别的总金额和记录数量，总金额由各类别相加得到
+    category_stats = (
+        db.query(
+            Transaction.category,
+            func.sum(Transaction.amount).label("total_amount"),
+            func.count(Transaction.id).label("count"),
+        )
+        .filter(
+            Transaction.type == transaction_type,
+            *_period_filters(user_id, start_date, end_date),
+        )
+        .group_by(Transaction.category)
+        .order_by(desc("total_amount"))
+        .all()
+    )
+    total_amount = sum(float(item.total_amount or 0) for item in category_stats)
+
+    # 计算百分比
+    result = []
+    for item in category_stats:
+        amount = float(item.total_amount or 0)
+        result.append(
+            {
+                "category": item.category or "未分类",
+                "total_amount": amount,
+                "percentage": (
+                    round((amount / total_amount * 100), 2) if total_amount > 0 else 0
+                ),
+                "count": item.count,
+            }
+        )
+    return result
+
+
+def query_transaction_ranking(
+    db: Session,
+    user_id: int,
+    transaction_type: TransactionType,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    limit: int = 20,
+    category: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    查询金额最大的几笔交易，可按分类筛选
+
+    Returns:
+        list: 每项包含 id、date、description、category、amount、transaction_type
+    """
+    start_date, end_date = resolve_date_range(start_date, end_date)
+    print(f"[Transaction Ranking] Using date range: {start_date} to {end_date}")
+
+    # 查询交易记录，按金额降序排列
+    query = db.query(
+        Transaction.id,
+        Transaction.transaction_date,
+        Transaction.description,
+        Transaction.category,
+        Transaction.amount,
+        Transaction.type,
+    ).filter(
+        Transaction.type == transaction_type,
+        *_period_filters(user_id, start_date, end_date),
+    )
+    if category:
+        query = query.filter(Transaction.category == category)
+    transactions = query.order_by(desc(Transaction.amount)).limit(limit).all()
+    print(f"[Transaction Ranking] Found {len(transactions)} transactions")
+
+    result = []
+    for tx in transactions:
+        # 确保日期是date类型
+        tx_date = tx.transaction_date
+        if isinstance(tx_date, datetime):
+            tx_date = tx_date.date()
+        result.append(
+            {
+                "id": tx.id,
+                "date": tx_date,
+                "description": tx.description or "",
+                "category": tx.category or "未分类",
+                "amount": tx.amount,
+                "transaction_type": tx.type,
+            }
+        )
+    return result
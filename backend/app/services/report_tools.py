@@ -0,0 +1,373 @@
+"""
+账单查询工具调用
+
+用户在聊天中询问自己的收支（如"这个月餐饮花了多少"）时，给模型提供一组固定的本地报表工具：
+收支概览、分类汇总、金额最大的交易。模型按需调用，工具与报表接口共用 report_queries 中的查询，
+结果压缩成紧凑的JSON交还给模型，只把回答问题所需的少量汇总数据放进上下文，
+而不是把账单原始数据塞进提示词。
+"""
+
+import json
+import os
+import re
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ..models.models import TransactionType
+from .local_extractor import find_amounts
+from .report_queries import (
+    query_category_ranking,
+    query_summary,
+    query_transaction_ranking,
+)
+
+# 是否启用聊天中的账单查询工具
+CHAT_REPORT_TOOLS_ENABLED = (
+    os.getenv("CHAT_REPORT_TOOLS_ENABLED", "true").lower() == "true"
+)
+# 一次回答中最多进行的工具调用轮数，超过后要求模型直接回答
+REPORT_TOOL_MAX_ROUNDS = int(os.getenv("REPORT_TOOL_MAX_ROUNDS", "3"))
+# 分类汇总和交易排行返回的最大条数
+REPORT_TOOL_MAX_ITEMS = 10
+
+PERIODS = [
+    "today",
+    "this_week",
+    "this_month",
+    "last_month",
+    "this_year",
+    "last_30_days",
+]
+
+_PERIOD_PROPERTIES = {
+    "period": {
+        "type": "string",
+        "enum": PERIODS,
+        "description": "时间范围，默认this_month",
+    },
+    "start_date": {
+        "type": "string",
+        "description": "开始日期YYYY-MM-DD，填写后覆盖period",
+    },
+    "end_date": {
+        "type": "string",
+        "description": "结束日期YYYY-MM-DD，填写后覆盖period",
+    },
+}
+_TYPE_PROPERTY = {
+    "transaction_type": {
+        "type": "string",
+        "enum": ["expense", "income"],
+        "description": "支出或收入，默认expense",
+    }
+}
+
+REPORT_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_summary",
+            "description": "查询一段时间的总收入、总支出、结余和交易笔数",
+            "parameters": {"type": "object", "properties": dict(_PERIOD_PROPERTIES)},
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_category_totals",
+            "description": "查询一段时间内各分类的金额、占比和笔数，按金额从高到低",
+            "parameters": {
+                "type": "object",
+                "properties": dict(_PERIOD_PROPERTIES, **_TYPE_PROPERTY),
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_top_transactions",
+            "description": "查询一段时间内金额最大的几笔交易，可按分类筛选",
+            "parameters": {
+                "type": "object",
+                "properties": dict(
+                    _PERIOD_PROPERTIES,
+                    **_TYPE_PROPERTY,
+                    category={
+                        "type": "string",
+                        "description": "只看该分类，如餐饮美食",
+                    },
+                    limit={"type": "integer", "description": "返回条数，默认5，最多10"},
+                ),
+            },
+        },
+    },
+]
+
+# 询问收支情况的说法
+REPORT_QUESTION_PATTERN = re.compile(
+    r"多少|几笔|总共|一共|合计|统计|排行|排名|最多|最大|最贵|花在|哪些|哪类|哪个|占比|结余|余额|账单|明细|汇总"
+)
+# 金额后面跟这些字时是日期、笔数、名次等，不是金额
+NON_AMOUNT_SUFFIX_PATTERN = re.compile(r"\s*(?:月|日|号|天|周|年|笔|个|条|名|%)")
+
+
+def _has_amount(message: str) -> bool:
+    """消息中是否有金额，与本地提取使用同样的规则，支持"二十块"、"三十五"等中文数字"""
+    return any(
+        not NON_AMOUNT_SUFFIX_PATTERN.match(message, end)
+        for _, (_, end) in find_amounts(message)
+    )
+
+
+def is_report_question(message: str) -> bool:
+    """
+    判断消息是否在询问自己的收支情况
+
+    带金额的消息按记账处理，如"午饭35，这个月一共花了多少"、"打车一共二十块"仍走正常的提取流程。
+    """
+    if not CHAT_REPORT_TOOLS_ENABLED or not message:
+        return False
+    return bool(REPORT_QUESTION_PATTERN.search(message)) and not _has_amount(message)
+
+
+def resolve_period(
+    period: Optional[str],
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    today: Optional[date] = None,
+) -> Tuple[date, date]:
+    """
+    把工具参数中的时间范围换算为起止日期
+
+    Raises:
+        ValueError: 日期格式错误或开始日期晚于结束日期
+    """
+    today = today or date.today()
+    if period == "today":
+        start, end = today, today
+    elif period == "this_week":
+        start, end = today - timedelta(days=today.weekday()), today
+    elif period == "last_month":
+        end = date(today.year, today.month, 1) - timedelta(days=1)
+        start = date(end.year, end.month, 1)
+    elif period == "this_year":
+        start, end = date(today.year, 1, 1), today
+    elif period == "last_30_days":
+        start, end = today - timedelta(days=29), today
+    else:
+        start, end = date(today.year, today.month, 1), today
+
+    if start_date:
+        start = date.fromisoformat(start_date)
+    if end_date:
+        end = date.fromisoformat(end_date)
+    if start > end:
+        raise ValueError("开始日期不能晚于结束日期")
+    return start, end
+
+
+def _money(value) -> float:
+    return round(float(value or 0), 2)
+
+
+def _transaction_type(arguments: Dict[str, Any]) -> TransactionType:
+    return TransactionType(arguments.get("transaction_type") or "expense")
+
+
+def get_summary_tool(db, user, start: date, end: date, arguments) -> Dict[str, Any]:
+    summary = query_summary(db, user.id, start, end, include_stats=True)
+    stats = summary["transaction_stats"]
+    return {
+        "income": _money(summary["total_income"]),
+        "expense": _money(summary["total_expense"]),
+        "balance": _money(summary["balance"]),
+        "income_count": stats["income_count"],
+        "expense_count": stats["expense_count"],
+    }
+
+
+def get_category_totals_tool(
+    db, user, start: date, end: date, arguments
+) -> Dict[str, Any]:
+    transaction_type = _transaction_type(arguments)
+    ranking = query_category_ranking(db, user.id, transaction_type, start, end)
+    return {
+        "type": transaction_type.value,
+        # [分类, 金额, 占比%, 笔数]
+        "categories": [
+            [
+                item["category"],
+                _money(item["total_amount"]),
+                item["percentage"],
+                item["count"],
+            ]
+            for item in ranking[:REPORT_TOOL_MAX_ITEMS]
+        ],
+        "more": max(0, len(ranking) - REPORT_TOOL_MAX_ITEMS),
+    }
+
+
+def get_top_transactions_tool(
+    db, user, start: date, end: date, arguments
+) -> Dict[str, Any]:
+    try:
+        limit = int(arguments.get("limit") or 5)
+    except (TypeError, ValueError):
+        limit = 5
+    transaction_type = _transaction_type(arguments)
+    transactions = query_transaction_ranking(
+        db,
+        user.id,
+        transaction_type,
+        start,
+        end,
+        limit=max(1, min(limit, REPORT_TOOL_MAX_ITEMS)),
+        category=arguments.get("category") or None,
+    )
+    return {
+        "type": transaction_type.value,
+        # [日期, 描述, 分类, 金额]
+        "transactions": [
+            [
+                tx["date"].isoformat(),
+                tx["description"],
+                tx["category"],
+                _money(tx["amount"]),
+            ]
+            for tx in transactions
+        ],
+    }
+
+
+TOOL_HANDLERS: Dict[str, Callable[..., Dict[str, Any]]] = {
+    "get_summary": get_summary_tool,
+    "get_category_totals": get_category_totals_tool,
+    "get_top_transactions": get_top_transactions_tool,
+}
+
+
+def run_report_tool(
+    name: str, arguments: Any, db, user, today: Optional[date] = None
+) -> str:
+    """
+    执行一次工具调用
+
+    Args:
+        name: 工具名
+        arguments: 模型给出的参数（JSON字符串或字典）
+        db: 数据库会话
+        user: 当前用户
+
+    Returns:
+        str: 紧凑的JSON结果，出错时为 {"error": "..."}，交给模型自行处理
+    """
+    handler = TOOL_HANDLERS.get(name)
+    try:
+        if handler is None:
+            raise ValueError(f"未知工具: {name}")
+        if isinstance(arguments, str):
+            arguments = json.loads(arguments) if arguments.strip() else {}
+        if not isinstance(arguments, dict):
+            raise ValueError("参数必须是JSON对象")
+        start, end = resolve_period(
+            arguments.get("period"),
+            arguments.get("start_date"),
+            arguments.get("end_date"),
+            today,
+        )
+        result = {"start": start.isoformat(), "end": end.isoformat()}
+        result.update(handler(db, user, start, end, arguments))
+    except Exception as e:
+        print(f"[ReportTools] 工具 {name} 调用失败: {type(e).__name__}: {str(e)}")
+        result = {"error": str(e) or type(e).__name__}
+    return json.dumps(result, ensure_ascii=False, separators=(",", ":"))
+
+
+def _tool_calls(message) -> List[Dict[str, Any]]:
+    """读取回复中的工具调用，转换为普通字典"""
+    calls = message.get("tool_calls") if hasattr(message, "get") else None
+    if not isinstance(calls, list):
+        return []
+    return [
+        {
+            "id": call.get("id") or f"call_{index}",
+            "type": "function",
+            "function": {
+                "name": call["function"]["name"],
+                "arguments": call["function"].get("arguments") or "{}",
+            },
+        }
+        for index, call in enumerate(calls)
+    ]
+
+
+def answer_with_report_tools(
+    llm_client,
+    messages: List[Dict[str, Any]],
+    db,
+    user,
+    release: Optional[Callable[[], None]] = None,
+    max_rounds: int = REPORT_TOOL_MAX_ROUNDS,
+) -> Optional[str]:
+    """
+    工具调用循环：模型请求工具时在本地执行并把结果交还给模型，直到模型给出回答
+
+    Args:
+        llm_client: 大模型调用客户端
+        messages: 已拼接好工具说明的对话消息
+        db: 数据库会话，只在执行工具时使用
+        user: 当前用户
+        release: 执行完工具后释放数据库连接的回调，再次等待模型期间不占用连接
+        max_rounds: 最多的工具调用轮数
+
+    Returns:
+        str: 模型的回答，调用失败时返回None，由调用方回退到普通对话
+    """
+    messages = list(messages)
+    user_id = getattr(user, "id", None)
+    # 同一次回答中重复的工具调用直接复用结果
+    results: Dict[Tuple[str, str], str] = {}
+    try:
+        for round_index in range(max_rounds + 1):
+            kwargs = {"tools": REPORT_TOOLS, "tool_choice": "auto"}
+            if round_index == max_rounds:
+                # 轮数用完，不再提供工具，要求模型根据已有结果回答
+                kwargs = {}
+            response = llm_client.chat_completion(
+                "tools",
+                user_id=user_id,
+                messages=messages,
+                temperature=0.3,
+                max_tokens=1000,
+                **kwargs,
+            )
+            message = response.choices[0].message
+            calls = _tool_calls(message)
+            if not calls:
+                content = message.get("content") if hasattr(message, "get") else None
+                return content.strip() if isinstance(content, str) and content else None
+
+            messages.append(
+                {
+                    "role": "assistant",
+                    "content": message.get("content") or "",
+                    "tool_calls": calls,
+                }
+            )
+            for call in calls:
+                key = (call["function"]["name"], call["function"]["arguments"])
+                if key not in results:
+                    results[key] = run_report_tool(key[0], key[1], db, user)
+                print(f"[ReportTools] {key[0]}({key[1]}) -> {results[key]}")
+                messages.append(
+                    {
+                        "role": "tool",
+                        "tool_call_id": call["id"],
+                        "content": results[key],
+                    }
+                )
+            if release is not None:
+                release()
+    except Exception as e:
+        print(f"[ReportTools] 工具调用回答失败: {type(e).__name__}: {str(e)}")
+    return None
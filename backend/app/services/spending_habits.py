@@ -10,6 +10,8 @@ import traceback
 from dotenv import load_dotenv
 
 from ..models.models import Transaction, User, TransactionType
+from ..prompts.analysis import build_analysis_messages
+from .llm_client import llm_client
 
 # 加载环境变量
 load_dotenv()
@@ -17,9 +19,6 @@ load_dotenv()
 # 初始化OpenAI API
 openai.api_key = os.getenv("API_KEY")
 openai.api_base = os.getenv("API_URL")
-use_model = "gemini-2.5-flash-preview-05-20"
-# 设置默认请求配置，关闭超时
-openai.api_requestor.TIMEOUT_SECS = None
 
 
 class SpendingHabitsAnalyzer:
@@ -351,59 +350,21 @@ class SpendingHabitsAnalyzer:
         ]
 
 
-def generate_ai_analysis(spending_data: Dict[str, Any]) -> Dict[str, Any]:
-    """使用AI生成消费习惯分析和建议"""
+def generate_ai_analysis(
+    spending_data: Dict[str, Any], user_id: Optional[int] = None
+) -> Dict[str, Any]:
+    """使用AI生成消费习惯分析和建议，user_id用于统计用量"""
     print("\n***** 开始生成AI消费分析 *****")
 
     try:
-        # 将数据转换为JSON字符串，以便在提示中使用
-        spending_json = json.dumps(spending_data, indent=2, default=str)
-
-        # 构建详细的提示
-        prompt = f"""
-        我需要你帮用户分析他的消费习惯并提供合理的财务建议。以下是用户的消费数据，用您来称呼用户:
-
-        ```json
-        {spending_json}
-        ```
-
-        请根据以上数据进行深入分析，包括但不限于：
-        1. 消费习惯分析：基于消费类别、时间模式和金额特征
-        2. 异常消费模式识别：是否有不寻常的消费行为
-        3. 财务健康评估：基于收入与支出比例
-        4. 节约潜力指出：哪些类别可以减少开支
-        5. 具体的改善建议：实用且易于执行的建议
-
-        将你的回答分为两部分，大标题必须严格是这两个，不要有其他名字标题,严格分点回答，要换行：
-        1. 消费习惯分析：详细分析用户当前的消费模式和特点（4-6条小标题）
-        2. 财务改善建议：4-6条具体的改善建议
-        
-        示例格式：
-        (前面和结尾不要有任何输出）
-        一、消费习惯分析
-            1. ***
-            2. ***
-        二、财务改善建议
-            1. ***
-            2. ***
-        严格按照此格式，在此之外不要有其他任何输出。
-        请使用友好、专业的语气，避免过于生硬或说教的口吻。回答必须是中文。
-        """
-
         print("调用AI API进行消费分析...")
 
-        # 调用API (不设置超时)
-        response = openai.ChatCompletion.create(
-            model=use_model,
-            messages=[
-                {
-                    "role": "assistant",
-                    "content": "你是一位专业的财务顾问和消费行为分析师，擅长分析消费数据，识别消费模式，并提供实用的财务建议。",
-                },
-                {"role": "user", "content": prompt},
-            ],
+        # 调用API，超时和重试由llm_client按analysis操作统一控制
+        response = llm_client.chat_completion(
+            "analysis",
+            user_id=user_id,
+            messages=build_analysis_messages(spending_data),
             temperature=0.5,
-            request_timeout=None,  # 不设置超时
         )
 
         print("AI分析生成成功!")
@@ -466,7 +427,7 @@ def analyze_spending_habits(
     }
 
     # 2. 使用AI生成消费习惯分析和建议
-    ai_result = generate_ai_analysis(spending_data)
+    ai_result = generate_ai_analysis(spending_data, user_id)
 
     # 3. 返回原始数据和AI分析结果
     return {
@@ -0,0 +1,262 @@
+"""
+模型输出的JSON增量解析
+
+模型的输出可以分段喂给解析器，每个字符只扫描一次：顶层对象之前的markdown代码块标记和说明文字直接跳过，
+顶层对象闭合后的内容全部忽略，不需要等完整返回后再用正则在整段文本上回溯查找。
+顶层对象的每个字段在值完整时立即产出，指定的字符串字段（如回复文本）还会逐段产出增量，
+流式接口可以在模型输出结束前就开始显示回复和确认卡片。
+"""
+
+import json
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# 嵌套值中常见的尾随逗号，如 [1, 2,] 和 {"a": 1,}
+TRAILING_COMMA_PATTERN = re.compile(r",\s*([}\]])")
+
+ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+# 解析状态
+SEEK = "seek"  # 寻找顶层对象的左括号
+KEY = "key"  # 等待字段名或右括号
+KEY_STRING = "key_string"  # 字段名中
+COLON = "colon"  # 等待冒号
+VALUE = "value"  # 等待字段值
+STRING = "string"  # 字符串值中
+NESTED = "nested"  # 嵌套的对象或数组中
+SCALAR = "scalar"  # 数字或true/false/null中
+COMMA = "comma"  # 字段值之后，等待逗号或右括号
+DONE = "done"  # 顶层对象已闭合
+
+# 解析器产出的事件: ("delta", 字段名, 增量文本) 或 ("field", 字段名, 值)
+Event = Tuple[str, str, Any]
+
+
+class StreamingJSONParser:
+    """
+    顶层JSON对象的增量解析器，容忍代码块标记、前后说明文字和尾随逗号
+
+    顶层对象中格式错误的部分会被跳过：无法解析的字段值丢弃，
+    字段名不是字符串时放弃当前对象，继续向后寻找下一个左括号。
+    """
+
+    def __init__(self, stream_fields: Iterable[str] = ()):
+        """
+        Args:
+            stream_fields: 需要逐段产出增量的字符串字段名
+        """
+        self.stream_fields = set(stream_fields)
+        self.state = SEEK
+        # 已完整解析的字段
+        self.result: Dict[str, Any] = {}
+        # 是否遇到过顶层对象的左括号
+        self.started = False
+        self._key = ""
+        self._chars: List[str] = []
+        self._emitted = 0
+        self._escape = False
+        self._unicode: Optional[str] = None
+        self._high_surrogate: Optional[int] = None
+        # 嵌套值的括号深度及其中字符串的状态
+        self._depth = 0
+        self._nested_in_string = False
+        self._nested_escape = False
+
+    @property
+    def done(self) -> bool:
+        return self.state == DONE
+
+    def feed(self, text: str) -> List[Event]:
+        """
+        喂入一段模型输出
+
+        Returns:
+            list: 本段产生的事件，按出现顺序
+        """
+        events: List[Event] = []
+        for ch in text:
+            if self.state == DONE:
+                break
+            self._step(ch, events)
+        if self.state == STRING and self._key in self.stream_fields:
+            self._emit_delta(events)
+        return events
+
+    def _reset_value(self):
+        self._chars = []
+        self._emitted = 0
+        self._escape = False
+        self._unicode = None
+        self._high_surrogate = None
+
+    def _emit_delta(self, events: List[Event]):
+        if len(self._chars) > self._emitted:
+            events.append(("delta", self._key, "".join(self._chars[self._emitted :])))
+            self._emitted = len(self._chars)
+
+    def _restart(self, ch: str, events: List[Event]):
+        """当前对象格式错误，丢弃已解析的字段，从当前字符继续寻找下一个对象"""
+        self.result = {}
+        self.state = SEEK
+        if ch == "{":
+            self._step(ch, events)
+
+    def _read_string_char(self, ch: str) -> bool:
+        """处理字符串中的一个字符，遇到结束引号时返回True"""
+        if self._unicode is not None:
+            self._unicode += ch
+            if len(self._unicode) < 4:
+                return False
+            try:
+                code = int(self._unicode, 16)
+            except ValueError:
+                # 不合法的\u转义按原文保留
+                self._chars.append("\\u" + self._unicode)
+                self._unicode = None
+                return False
+            self._unicode = None
+            if 0xD800 <= code < 0xDC00:
+                self._high_surrogate = code
+            elif 0xDC00 <= code < 0xE000 and self._high_surrogate is not None:
+                high, self._high_surrogate = self._high_surrogate, None
+                self._chars.append(
+                    chr(0x10000 + ((high - 0xD800) << 10) + (code - 0xDC00))
+                )
+            else:
+                self._chars.append(chr(code))
+            return False
+        if self._escape:
+            self._escape = False
+            if ch == "u":
+                self._unicode = ""
+            else:
+                self._chars.append(ESCAPES.get(ch, ch))
+            return False
+        if ch == "\\":
+            self._escape = True
+            return False
+        if ch == '"':
+            return True
+        self._chars.append(ch)
+        return False
+
+    def _finish_value(self, value: Any, events: List[Event]):
+        self.result[self._key] = value
+        events.append(("field", self._key, value))
+        self.state = COMMA
+
+    def _step(self, ch: str, events: List[Event]):
+        state = self.state
+        if state == SEEK:
+            if ch == "{":
+                self.started = True
+                self.result = {}
+                self.state = KEY
+        elif state == KEY:
+            if ch == '"':
+                self._reset_value()
+                self.state = KEY_STRING
+            elif ch == "}":
+                self.state = DONE
+            elif not ch.isspace() and ch != ",":
+                self._restart(ch, events)
+        elif state == KEY_STRING:
+            if self._read_string_char(ch):
+                self._key = "".join(self._chars)
+                self.state = COLON
+        elif state == COLON:
+            if ch == ":":
+                self.state = VALUE
+            elif not ch.isspace():
+                self._restart(ch, events)
+        elif state == VALUE:
+            if ch == '"':
+                self._reset_value()
+                self.state = STRING
+            elif ch in "{[":
+                self._chars = [ch]
+                self._depth = 1
+                self._nested_in_string = False
+                self._nested_escape = False
+                self.state = NESTED
+            elif ch == "}":
+                # 缺少字段值，按对象结束处理
+                self.state = DONE
+            elif not ch.isspace() and ch != ",":
+                self._chars = [ch]
+                self.state = SCALAR
+        elif state == STRING:
+            if self._read_string_char(ch):
+                if self._key in self.stream_fields:
+                    self._emit_delta(events)
+                self._finish_value("".join(self._chars), events)
+        elif state == NESTED:
+            self._chars.append(ch)
+            if self._nested_in_string:
+                if self._nested_escape:
+                    self._nested_escape = False
+                elif ch == "\\":
+                    self._nested_escape = True
+                elif ch == '"':
+                    self._nested_in_string = False
+            elif ch == '"':
+                self._nested_in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._finish_nested(events)
+        elif state == SCALAR:
+            if ch in ",}" or ch.isspace():
+                token = "".join(self._chars)
+                try:
+                    self._finish_value(json.loads(token), events)
+                except ValueError:
+                    # 无法识别的值丢弃，继续解析后面的字段
+                    self.state = COMMA
+                self._step(ch, events)
+            else:
+                self._chars.append(ch)
+        elif state == COMMA:
+            if ch == ",":
+                self.state = KEY
+            elif ch == "}":
+                self.state = DONE
+            elif ch == '"':
+                # 容忍字段之间缺少逗号
+                self.state = KEY
+                self._step(ch, events)
+
+    def _finish_nested(self, events: List[Event]):
+        text = "".join(self._chars)
+        try:
+            value = json.loads(text)
+        except ValueError:
+            try:
+                value = json.loads(TRAILING_COMMA_PATTERN.sub(r"\1", text))
+            except ValueError:
+                self.state = COMMA
+                return
+        self._finish_value(value, events)
+
+
+def parse_json_object(text: str) -> Optional[Dict[str, Any]]:
+    """
+    从完整的模型输出中解析第一个顶层JSON对象
+
+    Returns:
+        dict: 解析出的对象，没有闭合的对象时返回None
+    """
+    parser = StreamingJSONParser()
+    parser.feed(text or "")
+    return parser.result if parser.done else None
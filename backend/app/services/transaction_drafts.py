@@ -0,0 +1,163 @@
+"""
+待确认交易草稿
+
+模型提取出的交易信息保存为草稿，确认时客户端只需提交草稿ID和需要修改的字段，
+也可以一次确认多个草稿。草稿超过有效期后不能再确认，并在下次访问时清理。
+"""
+
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from ..models.models import TransactionDraft
+
+# 草稿有效期（小时）
+DRAFT_TTL_HOURS = float(os.getenv("DRAFT_TTL_HOURS", "24"))
+
+# 确认时可以覆盖的草稿字段
+DRAFT_FIELDS = ("type", "amount", "description", "category", "date", "time")
+
+
+def purge_expired_drafts(db: Session, user_id: int) -> int:
+    """删除用户已过期的草稿，返回删除条数（不提交）"""
+    return (
+        db.query(TransactionDraft)
+        .filter(
+            TransactionDraft.user_id == user_id,
+            TransactionDraft.expires_at <= datetime.utcnow(),
+        )
+        .delete(synchronize_session=False)
+    )
+
+
+def create_draft(
+    db: Session,
+    user_id: int,
+    extracted_info: Dict[str, Any],
+    message_id: Optional[int] = None,
+) -> TransactionDraft:
+    """
+    保存一条交易草稿（只flush不提交，由调用方与消息一起提交）
+
+    Returns:
+        TransactionDraft: 已分配ID的草稿
+    """
+    purge_expired_drafts(db, user_id)
+    draft = TransactionDraft(
+        user_id=user_id,
+        message_id=message_id,
+        data=json.dumps(extracted_info, ensure_ascii=False, default=str),
+        expires_at=datetime.utcnow() + timedelta(hours=DRAFT_TTL_HOURS),
+    )
+    db.add(draft)
+    db.flush()
+    return draft
+
+
+def get_active_draft(
+    db: Session, draft_id: int, user_id: int
+) -> Optional[TransactionDraft]:
+    """获取用户未过期的草稿，不存在、已过期或不属于该用户时返回None"""
+    return (
+        db.query(TransactionDraft)
+        .filter(
+            TransactionDraft.id == draft_id,
+            TransactionDraft.user_id == user_id,
+            TransactionDraft.expires_at > datetime.utcnow(),
+        )
+        .first()
+    )
+
+
+def list_active_drafts(db: Session, user_id: int) -> List[TransactionDraft]:
+    return (
+        db.query(TransactionDraft)
+        .filter(
+            TransactionDraft.user_id == user_id,
+            TransactionDraft.expires_at > datetime.utcnow(),
+        )
+        .order_by(TransactionDraft.id)
+        .all()
+    )
+
+
+def list_message_drafts(
+    db: Session, user_id: int, message_id: int
+) -> List[TransactionDraft]:
+    """某条消息提取出的未过期草稿，按创建顺序"""
+    return (
+        db.query(TransactionDraft)
+        .filter(
+            TransactionDraft.user_id == user_id,
+            TransactionDraft.message_id == message_id,
+            TransactionDraft.expires_at > datetime.utcnow(),
+        )
+        .order_by(TransactionDraft.id)
+        .all()
+    )
+
+
+def draft_fields(draft: TransactionDraft) -> Dict[str, Any]:
+    """草稿中可用于创建交易的字段"""
+    data = json.loads(draft.data or "{}")
+    return {field: data.get(field) for field in DRAFT_FIELDS}
+
+
+def draft_to_dict(draft: TransactionDraft) -> Dict[str, Any]:
+    return {
+        "draft_id": draft.id,
+        "message_id": draft.message_id,
+        "extracted_info": json.loads(draft.data or "{}"),
+        "expires_at": draft.expires_at.isoformat() if draft.expires_at else None,
+    }
+
+
+def claim_draft(db: Session, draft_id: int, user_id: int) -> bool:
+    """
+    确认草稿时删除草稿（不提交），用带条件的DELETE判断是否由本次请求确认
+
+    重复点击或重试时并发确认同一草稿，只有删除到草稿的那次请求返回True，
+    其他请求不再创建交易。
+    """
+    deleted = (
+        db.query(TransactionDraft)
+        .filter(
+            TransactionDraft.id == draft_id,
+            TransactionDraft.user_id == user_id,
+            TransactionDraft.expires_at > datetime.utcnow(),
+        )
+        .delete(synchronize_session=False)
+    )
+    return deleted == 1
+
+
+def discard_draft(db: Session, draft_id: int, user_id: int) -> bool:
+    """删除用户拒绝的草稿（不提交），草稿不存在时返回False"""
+    deleted = (
+        db.query(TransactionDraft)
+        .filter(TransactionDraft.id == draft_id, TransactionDraft.user_id == user_id)
+        .delete(synchronize_session=False)
+    )
+    return deleted > 0
+
+
+def create_drafts(
+    db: Session,
+    user_id: int,
+    extracted_info: Dict[str, Any],
+    message_id: Optional[int] = None,
+) -> List[TransactionDraft]:
+    """提取结果包含多笔交易时每笔保存一条草稿，顺序与transactions一致"""
+    items = extracted_info.get("transactions") or [extracted_info]
+    return [
+        create_draft(
+            db,
+            user_id,
+            {k: v for k, v in item.items() if k != "transactions"},
+            message_id,
+        )
+        for item in items
+    ]
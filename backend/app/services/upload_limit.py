@@ -0,0 +1,102 @@
+"""
+上传请求体大小限制
+
+FastAPI在调用接口函数之前就会用Starlette的multipart解析器读完整个请求体，
+超过1MB的文件暂存到临时文件，接口函数中再检查大小已经无法限制内存和磁盘占用。
+这里在ASGI层对指定路径的请求体计数：Content-Length超过上限时不读取请求体直接返回413，
+没有Content-Length（分块传输）时在累计读取的字节数超过上限后立即中止解析并返回413。
+"""
+
+import json
+from typing import Dict
+
+# multipart中除文件内容外的边界、字段头和表单字段的余量（每个文件）
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+class RequestBodyTooLargeError(Exception):
+    """请求体超过上限，中止multipart解析"""
+
+
+def _too_large_body(limit: int) -> bytes:
+    detail = f"上传内容不能超过 {limit // (1024 * 1024)}MB"
+    return json.dumps({"detail": detail}, ensure_ascii=False).encode("utf-8")
+
+
+async def _send_too_large(send, limit: int):
+    body = _too_large_body(limit)
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"connection", b"close"),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+class UploadSizeLimitMiddleware:
+    """按路径限制请求体大小的ASGI中间件"""
+
+    def __init__(self, app, limits: Dict[str, int]):
+        """
+        Args:
+            app: ASGI应用
+            limits: 路径 -> 请求体字节数上限，未列出的路径不限制
+        """
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope.get("path")) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope.get("headers") or []).get(b"content-length")
+        try:
+            declared = int(content_length) if content_length is not None else None
+        except ValueError:
+            declared = None
+        if declared is not None and declared > limit:
+            print(f"[Upload] {scope['path']} 请求体 {declared} 字节超过上限，直接拒绝")
+            await _send_too_large(send, limit)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    raise RequestBodyTooLargeError()
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if exceeded:
+                # 解析中止后框架生成的错误响应替换为413
+                if message["type"] == "http.response.start" and not response_started:
+                    response_started = True
+                    await _send_too_large(send, limit)
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except RequestBodyTooLargeError:
+            if not response_started:
+                await _send_too_large(send, limit)
+        if exceeded:
+            print(f"[Upload] {scope['path']} 请求体超过上限，已中止读取")
@@ -0,0 +1,370 @@
+"""
+本地模拟的OpenAI兼容大模型服务，用于离线压测和延迟测试，不产生真实的模型调用费用
+
+支持 /v1/chat/completions（含 stream=true 和图片输入）以及 /v1/models，
+根据请求中的提示词返回对应格式的内容：
+- 记账信息提取：用本地规则提取器解析用户消息，返回提取JSON
+- 单次调用模式：返回 reply + 提取字段的JSON
+- 图片识别：返回预设的小票识别JSON
+- 其它（对话、摘要、消费分析）：返回预设文本
+
+运行方法：从backend目录下执行
+    python -m tests.fake_llm_server --port 9000 --latency lognormal:800,0.5 --error-rate 0.02
+然后启动后端时设置 API_URL=http://127.0.0.1:9000/v1 即可。
+
+延迟分布格式：
+    fixed:毫秒            固定延迟
+    uniform:最小,最大      均匀分布（毫秒）
+    lognormal:中位数,sigma 对数正态分布，中位数为毫秒
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import date
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 允许以脚本方式运行时导入app包
+backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if backend_dir not in sys.path:
+    sys.path.insert(0, backend_dir)
+
+from app.services.local_extractor import extract_locally, extract_locally_batch
+
+DEFAULT_CHAT_REPLY = "好的，我记下啦！今天也要好好生活哦~"
+DEFAULT_ANALYSIS = (
+    "一、消费习惯分析\n    1. 本期支出以餐饮美食为主，整体消费较为稳定。\n    2. 周末的消费明显高于工作日。\n"
+    "二、财务改善建议\n    1. 适当减少外卖次数。\n    2. 为大额支出提前做预算。"
+)
+DEFAULT_SUMMARY = "用户经常记录餐饮和交通支出，偏好简洁的回复。"
+DEFAULT_IMAGE_RESULT = {
+    "type": "expense",
+    "amount": 86.5,
+    "date": None,
+    "time": "12:30",
+    "description": "超市购买日用品",
+    "category": "日用百货",
+}
+
+# 错误状态码及其在错误中的占比
+DEFAULT_ERROR_STATUSES = {500: 0.4, 503: 0.3, 429: 0.3}
+ERROR_TYPES = {
+    429: "rate_limit_error",
+    500: "server_error",
+    502: "server_error",
+    503: "service_unavailable",
+}
+
+
+class LatencyDistribution:
+    """按配置字符串采样延迟（秒）"""
+
+    def __init__(self, spec: str = "fixed:0", rng: Optional[random.Random] = None):
+        self.spec = spec
+        self.rng = rng or random.Random()
+        kind, _, params = spec.partition(":")
+        self.kind = kind.strip().lower()
+        self.params = [float(p) for p in params.split(",") if p.strip()]
+        if self.kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"不支持的延迟分布: {spec}")
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            millis = self.params[0] if self.params else 0.0
+        elif self.kind == "uniform":
+            low, high = self.params[0], self.params[1]
+            millis = self.rng.uniform(low, high)
+        else:
+            median = self.params[0]
+            sigma = self.params[1] if len(self.params) > 1 else 0.5
+            millis = self.rng.lognormvariate(math.log(median), sigma)
+        return max(0.0, millis) / 1000
+
+
+class FakeLLMConfig:
+    """模拟服务配置，默认值可通过 FAKE_LLM_* 环境变量覆盖"""
+
+    def __init__(
+        self,
+        latency: str = None,
+        token_latency: str = None,
+        error_rate: float = None,
+        error_statuses: Dict[int, float] = None,
+        extraction_result: Dict[str, Any] = None,
+        seed: int = None,
+    ):
+        seed = seed if seed is not None else os.getenv("FAKE_LLM_SEED")
+        self.rng = random.Random(int(seed) if seed is not None else None)
+        self.latency = LatencyDistribution(
+            latency or os.getenv("FAKE_LLM_LATENCY", "fixed:0"), self.rng
+        )
+        # 流式返回时每个片段之间的延迟
+        self.token_latency = LatencyDistribution(
+            token_latency or os.getenv("FAKE_LLM_TOKEN_LATENCY", "fixed:0"), self.rng
+        )
+        self.error_rate = (
+            error_rate
+            if error_rate is not None
+            else float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+        )
+        self.error_statuses = error_statuses or DEFAULT_ERROR_STATUSES
+        # 固定的提取结果，不设置时用本地规则提取器解析用户消息
+        if extraction_result is None and os.getenv("FAKE_LLM_EXTRACTION_JSON"):
+            extraction_result = json.loads(os.getenv("FAKE_LLM_EXTRACTION_JSON"))
+        self.extraction_result = extraction_result
+
+    def pick_error(self) -> Optional[int]:
+        if self.error_rate <= 0 or self.rng.random() >= self.error_rate:
+            return None
+        statuses = list(self.error_statuses)
+        weights = [self.error_statuses[s] for s in statuses]
+        return self.rng.choices(statuses, weights=weights)[0]
+
+
+def _text_of(content) -> str:
+    """取出消息中的文本部分（图片消息的content是列表）"""
+    if isinstance(content, list):
+        return "\n".join(
+            part.get("text", "") for part in content if part.get("type") == "text"
+        )
+    return content or ""
+
+
+def _has_image(messages: List[Dict[str, Any]]) -> bool:
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list) and any(
+            part.get("type") == "image_url" for part in content
+        ):
+            return True
+    return False
+
+
+def _last_user_text(messages: List[Dict[str, Any]]) -> str:
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return _text_of(message.get("content"))
+    return ""
+
+
+def _extraction_for(config: FakeLLMConfig, text: str) -> Dict[str, Any]:
+    if config.extraction_result is not None:
+        return dict(config.extraction_result)
+    batch = extract_locally_batch(text)
+    if batch:
+        return dict(batch[0], has_intent=True, transactions=batch)
+    extracted = extract_locally(text)
+    if not extracted:
+        return {"has_intent": False}
+    extracted["has_intent"] = True
+    return extracted
+
+
+def build_reply(config: FakeLLMConfig, messages: List[Dict[str, Any]]) -> str:
+    """根据提示词判断调用场景，生成对应格式的回复内容"""
+    system_text = "\n".join(
+        _text_of(m.get("content")) for m in messages if m.get("role") == "system"
+    )
+    user_text = _last_user_text(messages)
+
+    if _has_image(messages):
+        result = dict(DEFAULT_IMAGE_RESULT, date=date.today().isoformat())
+        return json.dumps(result, ensure_ascii=False)
+
+    if '"reply"' in system_text and "has_intent" in system_text:
+        result = {"reply": DEFAULT_CHAT_REPLY}
+        result.update(_extraction_for(config, user_text))
+        return json.dumps(result, ensure_ascii=False)
+
+    if "has_intent" in system_text + user_text:
+        # 提取提示词中用户消息的格式为 用户消息: "..."
+        match = re.search(r'用户消息[:：]\s*"(.*)"', user_text)
+        message = match.group(1) if match else user_text
+        return json.dumps(_extraction_for(config, message), ensure_ascii=False)
+
+    if "摘要" in system_text + user_text and "对话" in user_text:
+        return DEFAULT_SUMMARY
+    if "消费习惯分析" in system_text + user_text:
+        return DEFAULT_ANALYSIS
+    return DEFAULT_CHAT_REPLY
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 2)
+
+
+def _usage(messages: List[Dict[str, Any]], content: str) -> Dict[str, int]:
+    prompt_tokens = sum(_estimate_tokens(_text_of(m.get("content"))) for m in messages)
+    completion_tokens = _estimate_tokens(content)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _split_chunks(content: str, size: int = 4) -> List[str]:
+    return [content[i : i + size] for i in range(0, len(content), size)] or [""]
+
+
+class FakeLLMStats:
+    """请求计数，用于压测结束后核对"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.streams = 0
+        self.images = 0
+        self.errors: Dict[int, int] = {}
+
+    def record(self, stream: bool, image: bool, error: Optional[int]):
+        with self._lock:
+            self.requests += 1
+            self.streams += int(stream)
+            self.images += int(image)
+            if error:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "streams": self.streams,
+                "images": self.images,
+                "errors": dict(self.errors),
+            }
+
+
+def create_app(config: FakeLLMConfig = None) -> FastAPI:
+    """创建模拟服务应用"""
+    config = config or FakeLLMConfig()
+    stats = FakeLLMStats()
+    app = FastAPI(title="Fake LLM Server")
+    app.state.config = config
+    app.state.stats = stats
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages") or []
+        model = body.get("model", "fake-model")
+        stream = bool(body.get("stream"))
+        error = config.pick_error()
+        stats.record(stream, _has_image(messages), error)
+
+        await asyncio.sleep(config.latency.sample())
+
+        if error:
+            return JSONResponse(
+                status_code=error,
+                content={
+                    "error": {
+                        "message": f"模拟的服务商错误 ({error})",
+                        "type": ERROR_TYPES.get(error, "server_error"),
+                        "code": None,
+                    }
+                },
+            )
+
+        content = build_reply(config, messages)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+
+        if not stream:
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": _usage(messages, content),
+            }
+
+        async def event_stream():
+            def chunk(delta, finish_reason=None):
+                payload = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                    ],
+                }
+                return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+            yield chunk({"role": "assistant"})
+            for piece in _split_chunks(content):
+                delay = config.token_latency.sample()
+                if delay:
+                    await asyncio.sleep(delay)
+                yield chunk({"content": piece})
+            yield chunk({}, "stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    # API_URL 可以带或不带 /v1
+    app.add_api_route("/v1/chat/completions", chat_completions, methods=["POST"])
+    app.add_api_route("/chat/completions", chat_completions, methods=["POST"])
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {
+            "object": "list",
+            "data": [{"id": "fake-model", "object": "model", "owned_by": "local"}],
+        }
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats.snapshot()
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的OpenAI兼容大模型服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", help="首包延迟分布，如 lognormal:800,0.5")
+    parser.add_argument("--token-latency", help="流式片段间延迟分布，如 fixed:30")
+    parser.add_argument("--error-rate", type=float, help="错误率，0-1")
+    parser.add_argument("--extraction-json", help="固定返回的提取结果JSON")
+    parser.add_argument("--seed", type=int, help="随机数种子")
+    args = parser.parse_args()
+
+    config = FakeLLMConfig(
+        latency=args.latency,
+        token_latency=args.token_latency,
+        error_rate=args.error_rate,
+        extraction_result=(
+            json.loads(args.extraction_json) if args.extraction_json else None
+        ),
+        seed=args.seed,
+    )
+
+    import uvicorn
+
+    print(f"模拟大模型服务: http://{args.host}:{args.port}/v1")
+    print(f"延迟分布: {config.latency.spec}, 错误率: {config.error_rate}")
+    uvicorn.run(create_app(config), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
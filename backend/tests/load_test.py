@@ -0,0 +1,196 @@
+"""
+后端聊天接口压测脚本
+
+配合 tests/fake_llm_server.py 使用，可以离线测量聊天、流式聊天和图片识别接口的吞吐和延迟：
+    1. python -m tests.fake_llm_server --port 9000 --latency lognormal:800,0.5
+    2. API_URL=http://127.0.0.1:9000/v1 uvicorn app.main:app --port 8000 --workers 4
+    3. python -m tests.load_test --base-url http://127.0.0.1:8000 --mode chat --concurrency 20 --requests 500
+
+运行方法：从backend目录下执行 python -m tests.load_test --help
+"""
+
+import argparse
+import io
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+
+SAMPLE_MESSAGES = [
+    "早餐 8元",
+    "午饭花了35块",
+    "打车回家 23.5",
+    "昨天买衣服花了299",
+    "收到工资 8000",
+    "超市买菜 126.8",
+    "今天心情不错",
+    "这个月花了多少钱？",
+    "电影票两张 90",
+    "给妈妈发红包 500",
+]
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def make_receipt_image() -> bytes:
+    """生成一张用于图片识别压测的小票图片"""
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (600, 900), "white")
+    draw = ImageDraw.Draw(image)
+    for row in range(20):
+        draw.text(
+            (40, 40 + row * 40),
+            f"ITEM {row:02d}    {random.randint(1, 99)}.00",
+            fill="black",
+        )
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def login(base_url: str, username: str, password: str) -> str:
+    """登录压测账号，账号不存在时先注册"""
+    requests.post(
+        f"{base_url}/users/register",
+        json={
+            "username": username,
+            "email": f"{username}@loadtest.local",
+            "password": password,
+        },
+        timeout=10,
+    )
+    response = requests.post(
+        f"{base_url}/users/login",
+        data={"username": username, "password": password},
+        timeout=10,
+    )
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+class LoadTestResult:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: List[float] = []
+        self.first_byte: List[float] = []
+        self.statuses: Dict[str, int] = {}
+
+    def record(self, status: str, latency: float, first_byte: float = None):
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if status == "200":
+                self.latencies.append(latency)
+                if first_byte is not None:
+                    self.first_byte.append(first_byte)
+
+
+def run_one(
+    session: requests.Session,
+    base_url: str,
+    mode: str,
+    image: bytes,
+    result: LoadTestResult,
+):
+    started = time.perf_counter()
+    first_byte = None
+    try:
+        if mode == "chat":
+            response = session.post(
+                f"{base_url}/chat/",
+                json={"content": random.choice(SAMPLE_MESSAGES)},
+                timeout=120,
+            )
+        elif mode == "stream":
+            response = session.post(
+                f"{base_url}/chat/stream",
+                json={"content": random.choice(SAMPLE_MESSAGES)},
+                stream=True,
+                timeout=120,
+            )
+            for line in response.iter_lines():
+                if first_byte is None and line.startswith(b"event: token"):
+                    first_byte = time.perf_counter() - started
+            response.close()
+        else:
+            response = session.post(
+                f"{base_url}/chat/image-recognition",
+                files={"image": (f"{uuid.uuid4().hex}.jpg", image, "image/jpeg")},
+                timeout=120,
+            )
+        status = str(response.status_code)
+    except requests.RequestException as e:
+        status = type(e).__name__
+    result.record(status, time.perf_counter() - started, first_byte)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天接口压测")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--mode", choices=["chat", "stream", "image"], default="chat")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument(
+        "--users", type=int, default=5, help="压测账号数量，请求在账号间轮流分配"
+    )
+    parser.add_argument("--password", default="loadtest123")
+    args = parser.parse_args()
+
+    sessions = []
+    for index in range(args.users):
+        token = login(args.base_url, f"loadtest_{index}", args.password)
+        session = requests.Session()
+        session.headers["Authorization"] = f"Bearer {token}"
+        sessions.append(session)
+
+    image = make_receipt_image() if args.mode == "image" else b""
+    result = LoadTestResult()
+    print(
+        f"开始压测: 模式={args.mode}, 并发={args.concurrency}, 请求数={args.requests}"
+    )
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for index in range(args.requests):
+            executor.submit(
+                run_one,
+                sessions[index % len(sessions)],
+                args.base_url,
+                args.mode,
+                image,
+                result,
+            )
+    elapsed = time.perf_counter() - started
+
+    def ms(value):
+        return f"{value * 1000:.0f}ms" if value is not None else "-"
+
+    print("=" * 50)
+    print(f"总耗时: {elapsed:.2f}秒, 吞吐: {args.requests / elapsed:.2f} 请求/秒")
+    print(f"状态分布: {json.dumps(result.statuses, ensure_ascii=False)}")
+    print(
+        f"延迟: p50={ms(percentile(result.latencies, 0.5))} "
+        f"p95={ms(percentile(result.latencies, 0.95))} "
+        f"p99={ms(percentile(result.latencies, 0.99))}"
+    )
+    if result.first_byte:
+        print(
+            f"首个token: p50={ms(percentile(result.first_byte, 0.5))} "
+            f"p95={ms(percentile(result.first_byte, 0.95))}"
+        )
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+from unittest.mock import MagicMock
+
+from app.services.background_extraction import BackgroundExtractor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# 测试提取完成、失败时的任务状态，任务只能由所属用户查询
+def test_job_lifecycle():
+    sessions = []
+
+    def session_factory():
+        sessions.append(MagicMock())
+        return sessions[-1]
+
+    extractor = BackgroundExtractor(workers=1, session_factory=session_factory)
+
+    job = extractor.submit(1, 10, lambda db: None)
+    job.future.result(timeout=5)
+    assert job.to_dict()["status"] == "done"
+    assert job.to_dict()["needs_confirmation"] is False
+    assert sessions[0].commit.called and sessions[0].close.called
+
+    def broken(db):
+        raise RuntimeError("模型不可用")
+
+    failed = extractor.submit(1, 11, broken)
+    failed.future.result(timeout=5)
+    assert failed.status == "failed"
+    assert failed.error == "模型不可用"
+    assert sessions[1].rollback.called
+
+    assert extractor.get(1, 10) is job
+    assert extractor.get(2, 10) is None
+    assert extractor.stats()["completed"] == 1
+    assert extractor.stats()["failed"] == 1
+
+
+# 测试已完成的任务超过保留时间后清理
+def test_job_expiry():
+    clock = FakeClock()
+    extractor = BackgroundExtractor(
+        workers=1, session_factory=MagicMock, ttl=60, clock=clock
+    )
+    extractor.submit(1, 10, lambda db: None).future.result(timeout=5)
+
+    clock.now = 30
+    assert extractor.get(1, 10) is not None
+    clock.now = 100
+    assert extractor.get(1, 10) is None
+
+
+# 测试自动记账钩子：在提交前写入，提交后执行回调，结果中附带撤销令牌
+def test_job_auto_commit_hook():
+    session = MagicMock()
+    calls = []
+
+    def auto_commit(db, extracted_info):
+        assert db is session and extracted_info == {"amount": 35}
+        calls.append("auto_commit")
+        return None, [{"id": 1, "amount": 35}], "token", lambda: calls.append("learned")
+
+    extractor = BackgroundExtractor(workers=1, session_factory=lambda: session)
+    session.commit.side_effect = lambda: calls.append("commit")
+
+    job = extractor.submit(1, 10, lambda db: {"amount": 35}, auto_commit)
+    job.future.result(timeout=5)
+    assert calls == ["auto_commit", "commit", "learned"]
+    result = job.to_dict()
+    assert result["needs_confirmation"] is False
+    assert result["draft_ids"] == []
+    assert result["auto_committed_transactions"] == [{"id": 1, "amount": 35}]
+    assert result["undo_token"] == "token"
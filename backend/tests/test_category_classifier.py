@@ -0,0 +1,136 @@
+import threading
+from collections import defaultdict
+
+from app.services.category_classifier import NaiveBayesCategoryClassifier
+
+
+def _train(classifier, samples):
+    for description, category, transaction_type in samples:
+        classifier.learn(description, category, transaction_type)
+
+
+# 测试分类器学习用户自己的分类习惯
+def test_predict_learned_category():
+    classifier = NaiveBayesCategoryClassifier()
+    _train(
+        classifier,
+        [
+            ("健身房月卡", "医疗健康", "expense"),
+            ("健身房私教课", "医疗健康", "expense"),
+            ("午饭", "餐饮美食", "expense"),
+            ("晚饭", "餐饮美食", "expense"),
+            ("打车回家", "交通出行", "expense"),
+            ("发工资", "工资薪酬", "income"),
+        ],
+    )
+
+    category, probability = classifier.predict("健身房年卡")
+    assert category == "医疗健康"
+    assert probability > 0.8
+    assert classifier.predict_type("工资薪酬") == "income"
+
+    category, _ = classifier.predict("午饭 25")
+    assert category == "餐饮美食"
+
+
+# 测试样本不足或特征未知时不预测
+def test_predict_requires_evidence():
+    classifier = NaiveBayesCategoryClassifier()
+    _train(classifier, [("午饭", "餐饮美食", "expense")])
+    assert classifier.predict("午饭") == (None, 0.0)
+
+    _train(
+        classifier,
+        [("晚饭", "餐饮美食", "expense")] * 2 + [("打车", "交通出行", "expense")] * 2,
+    )
+    assert classifier.predict("电影票") == (None, 0.0)
+    assert classifier.predict("") == (None, 0.0)
+
+
+# 测试一个主要分类不会吸收没有见过的描述
+def test_dominant_category_does_not_absorb_unrelated():
+    classifier = NaiveBayesCategoryClassifier()
+    _train(
+        classifier,
+        [
+            ("超市买牛奶", "日用百货", "expense"),
+            ("超市买纸巾", "日用百货", "expense"),
+            ("超市买洗发水", "日用百货", "expense"),
+            ("超市买水果", "日用百货", "expense"),
+            ("超市买零食", "日用百货", "expense"),
+        ],
+    )
+    assert classifier.predict("超市买牛奶")[0] == "日用百货"
+    assert classifier.predict("买衣服") == (None, 0.0)
+    assert classifier.predict("买机票") == (None, 0.0)
+
+
+# 测试撤销学习后恢复到学习前的状态
+def test_unlearn_restores_state():
+    classifier = NaiveBayesCategoryClassifier()
+    _train(
+        classifier,
+        [
+            ("午饭", "餐饮美食", "expense"),
+            ("晚饭", "餐饮美食", "expense"),
+            ("打车回家", "交通出行", "expense"),
+        ],
+    )
+    before = (
+        classifier.sample_count,
+        dict(classifier.category_counts),
+        set(classifier.vocabulary),
+    )
+
+    classifier.learn("火锅聚餐", "人情往来", "expense")
+    classifier.unlearn("火锅聚餐", "人情往来", "expense")
+    assert (
+        classifier.sample_count,
+        dict(classifier.category_counts),
+        set(classifier.vocabulary),
+    ) == before
+    assert classifier.predict_type("人情往来") is None
+
+    # 没有学习过的分类不受影响
+    classifier.unlearn("午饭", "医疗健康", "expense")
+    assert classifier.sample_count == before[0]
+
+
+class _LearnDuringIteration(defaultdict):
+    """遍历分类计数时在另一个线程学习新分类，模拟预测与学习交错"""
+
+    def __init__(self, classifier, items):
+        super().__init__(int, items)
+        self.classifier = classifier
+        self.learner = None
+
+    def items(self):
+        # 直接遍历字典本身，遍历中插入新键会抛出RuntimeError
+        for index, key in enumerate(dict.__iter__(self)):
+            if index == 0:
+                self.learner = threading.Thread(
+                    target=self.classifier.learn,
+                    args=("房租", "住房物业", "expense"),
+                )
+                self.learner.start()
+                # 有锁时学习会等待预测结束，这里等不到学习完成
+                self.learner.join(0.2)
+            yield key, self[key]
+
+
+# 测试预测过程中其它线程学习新分类不会修改正在遍历的字典
+def test_learn_waits_for_predict():
+    classifier = NaiveBayesCategoryClassifier()
+    _train(
+        classifier,
+        [("午饭", "餐饮美食", "expense")] * 5 + [("打车回家", "交通出行", "expense")],
+    )
+    counts = _LearnDuringIteration(classifier, classifier.category_counts)
+    classifier.category_counts = counts
+
+    category, _ = classifier.predict("午饭")
+    counts.learner.join()
+
+    assert category == "餐饮美食"
+    assert classifier.sample_count == 7
+    assert classifier.predict_type("住房物业") == "expense"
@@ -1,5 +1,7 @@
 import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from jose import jwt
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
@@ -11,6 +13,8 @@ from datetime import datetime
 from app.models.database import Base, get_db
 from app.models.models import ChatMessage, User, AIPersonality, Transaction
 from app.main import app
+from app.routers.users import ALGORITHM, SECRET_KEY, get_current_user
+from app.services.category_classifier import get_user_classifier
 
 
 # 创建内存测试数据库
@@ -87,6 +91,25 @@ def client(db):
         yield c
 
 
+@pytest.fixture(autouse=True)
+def memory_only_usage():
+    # 用量只在内存中统计，不写入开发数据库；每个测试重新开始限流
+    from app.services.llm_usage import usage_tracker
+
+    from app.services.image_dedup import image_dedup_index
+    from app.services.personality_registry import personality_registry
+
+    usage_tracker.reset()
+    image_dedup_index.clear()
+    # 助手注册表只使用预设助手，不读取开发数据库
+    personality_registry.invalidate()
+    with patch.object(usage_tracker, "session_factory", None), patch.object(
+        personality_registry, "session_factory", None
+    ):
+        yield usage_tracker
+    personality_registry.invalidate()
+
+
 @pytest.fixture
 def mock_openai_response():
     with patch("openai.ChatCompletion.create") as mock_create:
@@ -120,7 +143,7 @@ def test_get_ai_personalities(client, db):
 
 
 # 使用模拟测试获取AI助手列表(可选，用于更精确的测试)
-@patch("app.routers.chat.get_all_assistants_metadata")
+@patch("app.routers.chat.personality_registry.metadata_list")
 def test_get_ai_personalities_with_mock(mock_get_assistants, client, db):
     # 设置模拟返回值
     mock_assistants = [
@@ -213,11 +236,20 @@ def test_get_chat_history(client, db):
         assert "created_at" in message
 
 
+def _owned_message_id(db):
+    """创建一条属于测试用户的AI消息，确认交易时作为关联消息"""
+    user = db.query(User).filter(User.username == "testuser").first()
+    message = ChatMessage(user_id=user.id, content="确认交易", is_user=False)
+    db.add(message)
+    db.commit()
+    return message.id
+
+
 # 测试确认交易功能
 def test_confirm_transaction(client, db):
     # 构建交易确认数据
     transaction_data = {
-        "message_id": -1,  # 特殊值，表示不需要依赖数据库查询
+        "message_id": _owned_message_id(db),
         "confirm": True,
         "type": "expense",
         "amount": 100.0,
@@ -240,6 +272,50 @@ def test_confirm_transaction(client, db):
     assert data["transaction"]["category"] == transaction_data["category"]
 
 
+# 测试确认交易必须关联自己的消息或草稿，草稿内容无效时返回400
+def test_confirm_transaction_requires_owned_source(client, db):
+    from app.services.transaction_drafts import create_draft
+
+    transaction_data = {
+        "confirm": True,
+        "type": "expense",
+        "amount": 20.0,
+        "description": "无来源交易",
+        "category": "餐饮美食",
+    }
+    for message_id in (-1, None):
+        response = client.post(
+            "/chat/confirm-transaction",
+            json=dict(transaction_data, message_id=message_id),
+        )
+        assert response.status_code == 400
+
+    other = User(username="confirm_other", email="confirm_other@example.com")
+    db.add(other)
+    db.flush()
+    message = ChatMessage(user_id=other.id, content="别人的消息", is_user=False)
+    db.add(message)
+    db.commit()
+    response = client.post(
+        "/chat/confirm-transaction",
+        json=dict(transaction_data, message_id=message.id),
+    )
+    assert response.status_code == 403
+
+    user = db.query(User).filter(User.username == "testuser").first()
+    draft = create_draft(
+        db, user.id, {"type": "expense", "amount": None, "description": "缺金额"}
+    )
+    db.commit()
+    response = client.post(
+        "/chat/confirm-transaction", json={"confirm": True, "draft_id": draft.id}
+    )
+    assert response.status_code == 400
+    assert (
+        db.query(Transaction).filter(Transaction.description == "缺金额").count() == 0
+    )
+
+
 # 测试图片识别功能
 def test_image_recognition(client, db, mock_openai_response):
     # 修改模拟响应以包含图片识别结果
@@ -605,3 +681,1047 @@ def test_missing_fields_transaction(client, db):
         # 检查是否至少有一个我们期望缺失的字段在错误中被提到
         missing_fields = set(["type", "amount"]) & set(field_errors)
         assert len(missing_fields) > 0, "错误信息应该指出缺少的必要字段"
+
+
+@pytest.fixture
+def no_chat_context():
+    # 统计模型调用次数的测试不携带历史上下文，避免触发摘要刷新
+    with patch("app.services.chat_context.CHAT_CONTEXT_ENABLED", False):
+        yield
+
+
+# 测试单次调用模式返回结果的解析
+def test_parse_combined_response():
+    from app.routers.chat import parse_combined_response
+
+    raw = (
+        "好的，结果如下：\n```json\n"
+        '{"reply": "记好啦，午饭35元{已入账}", "has_intent": true, "type": "expense",'
+        ' "amount": 35, "category": "餐饮美食", "missing_fields": [],}\n```\n以上。'
+    )
+    reply, extracted = parse_combined_response(raw)
+    assert reply == "记好啦，午饭35元{已入账}"
+    assert extracted["amount"] == 35
+    assert "has_intent" not in extracted
+
+    reply, extracted = parse_combined_response(
+        '{"reply": "你好呀", "has_intent": false}'
+    )
+    assert reply == "你好呀"
+    assert extracted is None
+
+    # 多笔交易时顶层字段为第一笔
+    reply, extracted = parse_combined_response(
+        json.dumps(
+            {
+                "reply": "都记下了",
+                "has_intent": True,
+                "type": "expense",
+                "amount": 30,
+                "transactions": [
+                    {"type": "expense", "amount": 30, "description": "午饭"},
+                    {"type": "expense", "amount": 20, "description": "打车"},
+                ],
+            }
+        )
+    )
+    assert extracted["amount"] == 30
+    assert [t["amount"] for t in extracted["transactions"]] == [30, 20]
+
+    # 无法解析或缺少回复时返回None
+    assert parse_combined_response("这是一个测试回复") is None
+    assert parse_combined_response('{"has_intent": true}') is None
+
+
+# 测试单次调用模式只调用一次模型
+def test_combined_mode_single_call(client, db, mock_openai_response, no_chat_context):
+    mock_openai_response.return_value.choices[0].message.content = json.dumps(
+        {
+            "reply": "已经帮你记下午饭35元",
+            "has_intent": True,
+            "type": "expense",
+            "amount": 35,
+            "date": datetime.now().strftime("%Y-%m-%d"),
+            "description": "午饭",
+            "category": "餐饮美食",
+            "confidence": 0.95,
+            "missing_fields": [],
+        },
+        ensure_ascii=False,
+    )
+
+    with patch("app.routers.chat.CHAT_MODE", "combined"):
+        response = client.post(
+            "/chat/", json={"content": "午饭35", "personality_id": 1}
+        )
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["message"]["content"] == "已经帮你记下午饭35元"
+    assert data["extracted_info"]["amount"] == 35
+    assert data["needs_confirmation"] is True
+    assert mock_openai_response.call_count == 1
+
+
+# 测试单次调用模式解析失败时回退到两次调用
+def test_combined_mode_fallback(client, db, mock_openai_response, no_chat_context):
+    with patch("app.routers.chat.CHAT_MODE", "combined"):
+        response = client.post("/chat/", json={"content": "你好", "personality_id": 1})
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["message"]["content"] == "这是一个测试回复"
+    assert data["needs_confirmation"] is False
+    # 单次调用 + 提取 + 回复
+    assert mock_openai_response.call_count == 3
+
+
+# 测试简单记账消息走本地规则提取，不调用大模型提取
+def test_local_fast_path_extraction(client, db, mock_openai_response, no_chat_context):
+    response = client.post("/chat/", json={"content": "午饭35", "personality_id": 1})
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["needs_confirmation"] is True
+    assert data["extracted_info"]["amount"] == 35
+    assert data["extracted_info"]["category"] == "餐饮美食"
+    # 只有生成回复的一次调用
+    assert mock_openai_response.call_count == 1
+
+
+# 测试确认过的交易会训练用户分类器并修正提取的分类
+def test_user_classifier_overrides_category(
+    client, db, mock_openai_response, no_chat_context
+):
+    from app.services.category_classifier import reset_classifiers
+
+    reset_classifiers()
+    message_id = _owned_message_id(db)
+    for _ in range(5):
+        response = client.post(
+            "/chat/confirm-transaction",
+            json={
+                "message_id": message_id,
+                "confirm": True,
+                "type": "expense",
+                "amount": 300.0,
+                "description": "私教课",
+                "category": "医疗健康",
+                "date": datetime.now().strftime("%Y-%m-%d"),
+            },
+        )
+        assert response.status_code == 200
+
+    # 首次使用时从数据库加载，之后增量学习
+    response = client.post(
+        "/chat/", json={"content": "私教课 300", "personality_id": 1}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["extracted_info"]["category"] == "医疗健康"
+    assert mock_openai_response.call_count == 1
+    reset_classifiers()
+
+
+# 测试用户分类器不覆盖关键词命中的分类，也不改变交易类型
+def test_user_category_keeps_keyword_and_type():
+    from app.routers.chat import apply_user_category
+
+    with patch("app.routers.chat.classify", return_value=("工资薪酬", "income", 0.99)):
+        item = {"type": "expense", "description": "买衣服", "category": "服饰美容"}
+        assert apply_user_category(item, 1, object()) is False
+        assert item["category"] == "服饰美容"
+
+        item = {"type": "expense", "description": "私教课", "category": "其他支出"}
+        assert apply_user_category(item, 1, object()) is False
+        assert item == {
+            "type": "expense",
+            "description": "私教课",
+            "category": "其他支出",
+        }
+
+        item = {"description": "私教课", "category": "其他支出"}
+        assert apply_user_category(item, 1, object()) is True
+        assert item["category"] == "工资薪酬" and item["type"] == "income"
+
+
+# 测试重复消息命中提取缓存
+def test_extraction_cache_hit(client, db, mock_openai_response, no_chat_context):
+    from app.services.llm_cache import extraction_cache
+
+    extraction_cache.clear()
+    mock_openai_response.return_value.choices[0].message.content = json.dumps(
+        {
+            "has_intent": True,
+            "type": "expense",
+            "amount": 66.0,
+            "date": datetime.now().strftime("%Y-%m-%d"),
+            "description": "团建聚会AA",
+            "category": "人情往来",
+        },
+        ensure_ascii=False,
+    )
+
+    message_data = {"content": "这周团建聚会大家AA，我出了六十六", "personality_id": 1}
+    first = client.post("/chat/", json=message_data)
+    second = client.post(
+        "/chat/", json=dict(message_data, content=message_data["content"] + "。")
+    )
+
+    assert first.status_code == 200
+    assert second.status_code == 200
+    assert second.json()["extracted_info"]["amount"] == 66.0
+    # 第一次: 提取 + 回复，第二次: 只有回复
+    assert mock_openai_response.call_count == 3
+
+    stats = client.get("/chat/metrics").json()["extraction_cache"]
+    assert stats["hits"] == 1
+    extraction_cache.clear()
+
+
+def _stream_chunks(*parts):
+    from openai.openai_object import OpenAIObject
+
+    return [
+        OpenAIObject.construct_from({"choices": [{"delta": {"content": part}}]})
+        for part in parts
+    ]
+
+
+def _parse_sse(text):
+    events = []
+    for block in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+# 测试流式聊天接口
+def test_chat_stream(client, db, mock_openai_response):
+    reply_response = mock_openai_response.return_value
+
+    def fake_create(*args, **kwargs):
+        if kwargs.get("stream"):
+            return iter(_stream_chunks("记好", "啦，", "午饭35元"))
+        return reply_response
+
+    mock_openai_response.side_effect = fake_create
+    # 提取线程使用自己的数据库会话，不使用请求会话
+    worker_sessions = []
+
+    def session_factory():
+        worker_sessions.append(MagicMock(wraps=TestingSessionLocal()))
+        return worker_sessions[-1]
+
+    with patch("app.routers.chat.SessionLocal", session_factory):
+        response = client.post(
+            "/chat/stream", json={"content": "午饭35", "personality_id": 1}
+        )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert len(worker_sessions) == 1 and worker_sessions[0].close.called
+    events = _parse_sse(response.text)
+    names = [name for name, _ in events]
+    assert names.count("token") == 3
+    assert names.count("extraction") == 1
+    assert names[-1] == "done"
+
+    extraction = next(data for name, data in events if name == "extraction")
+    assert extraction["needs_confirmation"] is True
+    assert extraction["extracted_info"]["amount"] == 35
+
+    done = events[-1][1]
+    assert done["message"]["content"] == "记好啦，午饭35元"
+    saved = (
+        db.query(ChatMessage).filter(ChatMessage.id == done["message"]["id"]).first()
+    )
+    assert saved is not None and saved.content == "记好啦，午饭35元"
+
+
+# 测试单次调用模式的流式接口边接收边解析JSON，提取字段在输出结束前发送
+def test_chat_stream_combined_mode(client, db, mock_openai_response):
+    raw = "```json\n" + json.dumps(
+        {
+            "reply": "记好啦，午饭35元",
+            "has_intent": True,
+            "type": "expense",
+            "amount": 35,
+            "date": datetime.now().strftime("%Y-%m-%d"),
+            "description": "午饭",
+            "category": "餐饮美食",
+            "confidence": 0.95,
+            "missing_fields": [],
+        },
+        ensure_ascii=False,
+    )
+    parts = [raw[i : i + 7] for i in range(0, len(raw), 7)] + ["\n```\n以上"]
+    mock_openai_response.side_effect = lambda *args, **kwargs: iter(
+        _stream_chunks(*parts)
+    )
+
+    with patch("app.routers.chat.CHAT_MODE", "combined"):
+        response = client.post(
+            "/chat/stream", json={"content": "午饭35", "personality_id": 1}
+        )
+
+    assert response.status_code == 200
+    assert mock_openai_response.call_count == 1
+    events = _parse_sse(response.text)
+    names = [name for name, _ in events]
+    tokens = [data["content"] for name, data in events if name == "token"]
+    assert "".join(tokens) == "记好啦，午饭35元"
+    assert len(tokens) > 1
+
+    fields = {data["name"]: data["value"] for name, data in events if name == "field"}
+    assert fields["amount"] == 35
+    # 字段事件在提取结果之前逐个发送
+    assert names.index("field") < names.index("extraction")
+    extraction = next(data for name, data in events if name == "extraction")
+    assert extraction["extracted_info"]["amount"] == 35
+    assert "reply" not in extraction["extracted_info"]
+
+    done = events[-1][1]
+    assert names[-1] == "done"
+    assert done["message"]["content"] == "记好啦，午饭35元"
+    assert len(done["draft_ids"]) == 1
+
+
+# 测试超出请求速率时直接返回429，不调用模型
+def test_chat_rate_limited(client, db, mock_openai_response, memory_only_usage):
+    with patch.object(memory_only_usage, "burst", 2), patch.object(
+        memory_only_usage, "rate", 0.1
+    ):
+        for _ in range(2):
+            assert client.post("/chat/", json={"content": "你好"}).status_code == 200
+        calls = mock_openai_response.call_count
+
+        response = client.post("/chat/", json={"content": "你好"})
+
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert mock_openai_response.call_count == calls
+
+
+# 测试当天token配额用完后返回429
+def test_chat_daily_quota(client, db, mock_openai_response, memory_only_usage):
+    user = db.query(User).filter(User.username == "testuser").first()
+    with patch.object(memory_only_usage, "daily_quota", 100):
+        memory_only_usage.record(user.id, "chat", "m", 80, 30, 0.5)
+        response = client.post("/chat/", json={"content": "你好"})
+        usage = client.get("/chat/usage").json()
+
+    assert response.status_code == 429
+    assert "上限" in response.json()["detail"]
+    assert usage["today_tokens"] == 110
+    assert usage["remaining_tokens"] == 0
+
+
+# 测试图片识别拒绝无法解码和超过大小上限的上传
+def test_image_recognition_rejects_bad_upload(client, db, mock_openai_response):
+    response = client.post(
+        "/chat/image-recognition",
+        files={"image": ("bad.jpg", b"not an image", "image/jpeg")},
+    )
+    assert response.status_code == 400
+
+    with patch("app.routers.chat.read_upload") as mock_read:
+        from app.services.image_pipeline import ImageTooLargeError
+
+        mock_read.side_effect = ImageTooLargeError("图片不能超过 15MB")
+        response = client.post(
+            "/chat/image-recognition",
+            files={"image": ("big.jpg", b"x", "image/jpeg")},
+        )
+    assert response.status_code == 413
+    mock_openai_response.assert_not_called()
+
+
+# 测试重复上传同一张图片时直接返回上次的识别结果，不再调用模型
+def test_image_recognition_deduplicates(client, db, mock_openai_response):
+    from PIL import Image, ImageDraw
+    import io
+
+    mock_openai_response.return_value.choices[0].message.content = json.dumps(
+        {
+            "type": "expense",
+            "amount": 42.0,
+            "date": datetime.now().strftime("%Y-%m-%d"),
+            "description": "便利店",
+            "category": "日用百货",
+        }
+    )
+    image = Image.new("RGB", (400, 600), "white")
+    draw = ImageDraw.Draw(image)
+    for row in range(12):
+        draw.rectangle((40, 40 + row * 45, 120 + row * 20, 60 + row * 45), fill="black")
+    png, jpeg = io.BytesIO(), io.BytesIO()
+    image.save(png, format="PNG")
+    image.save(jpeg, format="JPEG", quality=60)
+
+    first = client.post(
+        "/chat/image-recognition",
+        files={"image": ("receipt.png", png.getvalue(), "image/png")},
+    ).json()
+    calls = mock_openai_response.call_count
+    # 同一张图片重新压缩后再次上传
+    second = client.post(
+        "/chat/image-recognition",
+        files={"image": ("receipt.jpg", jpeg.getvalue(), "image/jpeg")},
+    ).json()
+
+    assert first["deduplicated"] is False
+    assert second["deduplicated"] is True
+    assert second["extracted_info"]["amount"] == 42.0
+    assert mock_openai_response.call_count == calls
+
+
+# 测试批量图片识别逐张返回结果，无法解码的图片单独返回错误
+def test_image_recognition_batch(client, db, mock_openai_response):
+    from PIL import Image
+    import io
+
+    mock_openai_response.return_value.choices[0].message.content = json.dumps(
+        {
+            "type": "expense",
+            "amount": 18.0,
+            "date": datetime.now().strftime("%Y-%m-%d"),
+            "description": "奶茶",
+            "category": "餐饮美食",
+        }
+    )
+    files = []
+    for color in ("red", "blue"):
+        buffer = io.BytesIO()
+        Image.new("RGB", (200, 300), color).save(buffer, format="PNG")
+        files.append(("images", (f"{color}.png", buffer.getvalue(), "image/png")))
+    files.append(("images", ("bad.jpg", b"not an image", "image/jpeg")))
+
+    response = client.post("/chat/image-recognition/batch", files=files)
+
+    assert response.status_code == 200
+    events = _parse_sse(response.text)
+    names = [name for name, _ in events]
+    assert names.count("result") == 2
+    assert names.count("error") == 1
+    assert names[-1] == "done"
+
+    error = next(data for name, data in events if name == "error")
+    assert error["index"] == 2 and error["status_code"] == 400
+    done = events[-1][1]
+    assert done["succeeded"] == 2 and done["failed"] == 1
+    assert [item["index"] for item in done["pending"]] == [0, 1]
+    assert done["pending"][0]["extracted_info"]["amount"] == 18.0
+
+
+# 测试批量识别中同一批的重复图片只调用一次模型，单张图片的解码错误不中断整个批次
+def test_image_recognition_batch_duplicates_and_decode_errors(
+    client, db, mock_openai_response
+):
+    from PIL import Image
+    import io
+    from app.services.image_pipeline import prepare_image
+
+    mock_openai_response.return_value.choices[0].message.content = json.dumps(
+        {"type": "expense", "amount": 26.0, "description": "咖啡"}
+    )
+    buffer = io.BytesIO()
+    Image.linear_gradient("L").convert("RGB").save(buffer, format="PNG")
+    receipt = buffer.getvalue()
+    bomb = b"\x89PNG bomb"
+
+    def fake_prepare(data, *args, **kwargs):
+        if data == bomb:
+            raise Image.DecompressionBombError("too many pixels")
+        return prepare_image(data, *args, **kwargs)
+
+    files = [
+        ("images", ("a.png", receipt, "image/png")),
+        ("images", ("b.png", receipt, "image/png")),
+        ("images", ("bomb.png", bomb, "image/png")),
+    ]
+    with patch("app.routers.chat.prepare_image", side_effect=fake_prepare):
+        response = client.post("/chat/image-recognition/batch", files=files)
+
+    assert response.status_code == 200
+    events = _parse_sse(response.text)
+    results = [data for name, data in events if name == "result"]
+    assert len(results) == 2
+    assert sorted(item["deduplicated"] for item in results) == [False, True]
+    assert all(item["extracted_info"]["amount"] == 26.0 for item in results)
+    error = next(data for name, data in events if name == "error")
+    assert error["index"] == 2 and error["status_code"] == 400
+    assert events[-1][1]["failed"] == 1
+    assert mock_openai_response.call_count == 1
+
+
+# 测试批量确认交易在同一事务中创建，任意一条无效时全部不创建
+def test_confirm_transactions_batch(client, db):
+    today = datetime.now().strftime("%Y-%m-%d")
+    message_id = _owned_message_id(db)
+
+    def item(description, **overrides):
+        data = {
+            "message_id": message_id,
+            "confirm": True,
+            "type": "expense",
+            "amount": 12.0,
+            "description": description,
+            "category": "餐饮美食",
+            "date": today,
+        }
+        data.update(overrides)
+        return data
+
+    response = client.post(
+        "/chat/confirm-transactions",
+        json={"items": [item("批量早餐"), item("批量无效", type="unknown")]},
+    )
+    assert response.status_code == 400
+    assert "第2条" in response.json()["detail"]
+    assert (
+        db.query(Transaction).filter(Transaction.description == "批量早餐").count() == 0
+    )
+
+    response = client.post(
+        "/chat/confirm-transactions",
+        json={
+            "items": [
+                item("批量早餐"),
+                item("批量晚餐", amount=30.0),
+                item("批量取消", confirm=False),
+            ]
+        },
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["confirmed"] == 2 and data["skipped"] == 1
+    assert {t["description"] for t in data["transactions"]} == {"批量早餐", "批量晚餐"}
+    assert (
+        db.query(Transaction).filter(Transaction.description == "批量取消").count() == 0
+    )
+
+
+# 测试提取结果保存为草稿，确认时只提交草稿ID和修改的字段
+def test_confirm_transaction_from_draft(client, db, mock_openai_response):
+    response = client.post("/chat/", json={"content": "午饭35", "personality_id": 1})
+    draft_id = response.json()["draft_id"]
+    assert draft_id is not None
+    assert draft_id in [d["draft_id"] for d in client.get("/chat/drafts").json()]
+
+    response = client.post(
+        "/chat/confirm-transaction",
+        json={"draft_id": draft_id, "confirm": True, "amount": 38.0},
+    )
+    assert response.status_code == 200
+    transaction = response.json()["transaction"]
+    assert transaction["amount"] == 38.0
+    assert transaction["type"] == "expense"
+
+    # 草稿确认后不能再次使用
+    response = client.post(
+        "/chat/confirm-transaction", json={"draft_id": draft_id, "confirm": True}
+    )
+    assert response.status_code == 404
+
+    # 并发确认同一草稿时两次请求都读到了草稿，只有删除到草稿的那次创建交易
+    from app.models.models import TransactionDraft
+
+    draft_id = client.post("/chat/", json={"content": "晚饭45"}).json()["draft_id"]
+    stale = db.query(TransactionDraft).filter(TransactionDraft.id == draft_id).one()
+    db.expunge(stale)
+    response = client.post(
+        "/chat/confirm-transaction", json={"draft_id": draft_id, "confirm": True}
+    )
+    assert response.status_code == 200
+    count = db.query(Transaction).count()
+    with patch("app.routers.chat.get_active_draft", return_value=stale):
+        response = client.post(
+            "/chat/confirm-transaction", json={"draft_id": draft_id, "confirm": True}
+        )
+        assert response.status_code == 409
+        response = client.post(
+            "/chat/confirm-transactions", json={"draft_ids": [draft_id]}
+        )
+        assert response.status_code == 409
+    assert db.query(Transaction).count() == count
+
+
+# 测试批量确认草稿，过期草稿不能确认
+def test_confirm_transactions_with_drafts(client, db, mock_openai_response):
+    from app.models.models import TransactionDraft
+
+    draft_ids = [
+        client.post("/chat/", json={"content": content}).json()["draft_id"]
+        for content in ("早餐12", "晚饭45")
+    ]
+    response = client.post("/chat/confirm-transactions", json={"draft_ids": draft_ids})
+    assert response.status_code == 200
+    assert sorted(t["amount"] for t in response.json()["transactions"]) == [12, 45]
+
+    expired_id = client.post("/chat/", json={"content": "打车20"}).json()["draft_id"]
+    draft = db.query(TransactionDraft).filter(TransactionDraft.id == expired_id).first()
+    draft.expires_at = datetime(2000, 1, 1)
+    db.commit()
+    response = client.post(
+        "/chat/confirm-transactions", json={"draft_ids": [expired_id]}
+    )
+    assert response.status_code == 404
+
+
+# 测试一条消息记多笔账时每笔生成一条草稿，并可一次确认
+def test_multi_transaction_message(client, db, mock_openai_response, no_chat_context):
+    response = client.post("/chat/", json={"content": "午饭30，打车20，买水3块"})
+
+    assert response.status_code == 200
+    data = response.json()
+    transactions = data["extracted_info"]["transactions"]
+    assert [t["amount"] for t in transactions] == [30, 20, 3]
+    assert data["extracted_info"]["amount"] == 30
+    assert len(data["draft_ids"]) == 3 and data["draft_id"] == data["draft_ids"][0]
+    # 本地规则提取，只有生成回复的一次调用
+    assert mock_openai_response.call_count == 1
+
+    response = client.post(
+        "/chat/confirm-transactions", json={"draft_ids": data["draft_ids"]}
+    )
+    assert response.status_code == 200
+    assert response.json()["confirmed"] == 3
+
+
+# 测试大模型返回多笔交易时逐笔拆分
+def test_llm_multi_transaction_extraction(client, db, mock_openai_response):
+    from app.routers.chat import extract_financial_data
+
+    mock_openai_response.return_value.choices[0].message.content = json.dumps(
+        {
+            "has_intent": True,
+            "type": "expense",
+            "amount": 128,
+            "transactions": [
+                {"type": "expense", "amount": 128, "description": "超市采购"},
+                {"type": "income", "amount": 50, "description": "朋友还钱"},
+            ],
+        }
+    )
+    with patch("app.routers.chat.extraction_cache.get", return_value=None):
+        extracted = extract_financial_data("周末超市采购一百二十八，朋友还了我五十")
+
+    assert extracted["amount"] == 128
+    assert "has_intent" not in extracted
+    assert [t["type"] for t in extracted["transactions"]] == ["expense", "income"]
+
+
+# 测试调用大模型期间不占用数据库连接，整轮对话只提交一次
+def test_chat_releases_session_during_llm_call(
+    client, db, mock_openai_response, no_chat_context
+):
+    from sqlalchemy import event
+
+    reply = mock_openai_response.return_value
+    in_transaction = []
+    commits = []
+
+    def fake_create(*args, **kwargs):
+        in_transaction.append(db.in_transaction())
+        return reply
+
+    def count_commit(session):
+        commits.append(1)
+
+    mock_openai_response.side_effect = fake_create
+    # 先创建测试用户，用户创建时的提交不计入
+    client.get("/chat/drafts")
+    event.listen(db, "after_commit", count_commit)
+    try:
+        response = client.post("/chat/", json={"content": "午饭30，打车20"})
+    finally:
+        event.remove(db, "after_commit", count_commit)
+
+    assert response.status_code == 200
+    assert in_transaction and not any(in_transaction)
+    assert len(commits) == 1
+
+    data = response.json()
+    user_message, ai_message = (
+        db.query(ChatMessage)
+        .filter(ChatMessage.id <= data["message"]["id"])
+        .order_by(ChatMessage.id.desc())
+        .limit(2)
+        .all()[::-1]
+    )
+    assert user_message.is_user and user_message.content == "午饭30，打车20"
+    assert user_message.created_at <= ai_message.created_at
+
+
+# 测试聊天记录按游标分页，after只返回更新的消息
+def test_chat_history_cursor(client, db):
+    from datetime import timedelta
+
+    user = db.query(User).filter(User.username == "testuser").first()
+    base = datetime(2030, 1, 1)
+    messages = [
+        ChatMessage(
+            user_id=user.id,
+            content=f"游标消息{i}",
+            is_user=i % 2 == 0,
+            created_at=base + timedelta(minutes=i),
+        )
+        for i in range(5)
+    ]
+    db.add_all(messages)
+    db.commit()
+    ids = [m.id for m in messages]
+
+    latest = client.get("/chat/history?limit=2").json()
+    assert [m["id"] for m in latest] == [ids[4], ids[3]]
+
+    older = client.get(f"/chat/history?limit=2&before={ids[3]}").json()
+    assert [m["id"] for m in older] == [ids[2], ids[1]]
+
+    newer = client.get(f"/chat/history?after={ids[1]}").json()
+    assert [m["id"] for m in newer] == ids[2:]
+    assert client.get(f"/chat/history?after={ids[4]}").json() == []
+
+    assert client.get("/chat/history?after=999999").status_code == 404
+    assert (
+        client.get(f"/chat/history?after={ids[0]}&before={ids[4]}").status_code == 400
+    )
+
+
+# 测试已归档的消息仍然可以通过聊天记录接口翻页读取
+def test_chat_history_reads_archives(client, db):
+    from datetime import timedelta
+
+    from app.services.chat_archive import run_archive_pass
+
+    user = db.query(User).filter(User.username == "testuser").first()
+    old = [
+        ChatMessage(
+            user_id=user.id,
+            content=f"归档消息{i}",
+            created_at=datetime(2000, 1, 1) + timedelta(hours=i),
+        )
+        for i in range(3)
+    ]
+    db.add_all(old)
+    db.commit()
+    ids = [m.id for m in old]
+
+    archived = run_archive_pass(
+        TestingSessionLocal, retention_days=1, now=datetime(2001, 1, 1)
+    )
+    assert archived == 3
+    assert db.query(ChatMessage).filter(ChatMessage.id.in_(ids)).count() == 0
+
+    older = client.get(f"/chat/history?before={ids[2]}").json()
+    assert [m["content"] for m in older] == ["归档消息1", "归档消息0"]
+    newer = client.get(f"/chat/history?after={ids[0]}&limit=2").json()
+    assert [m["content"] for m in newer] == ["归档消息1", "归档消息2"]
+    archives = client.get("/chat/archives").json()
+    assert archives[0]["message_count"] == 3
+
+
+# 测试助手列表的ETag协商缓存
+def test_personalities_etag(client, db):
+    response = client.get("/chat/personalities")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert len(response.json()) >= 1
+
+    cached = client.get("/chat/personalities", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.headers["etag"] == etag
+
+    stale = client.get("/chat/personalities", headers={"If-None-Match": '"stale"'})
+    assert stale.status_code == 200
+
+
+# 测试消息未指定助手时使用用户设置的助手
+def test_chat_uses_user_personality(client, db, mock_openai_response):
+    from app.prompts.assistant import ASSISTANT_MAP
+
+    response = client.post("/users/settings/personality", json={"personality_id": 2})
+    assert response.status_code == 200
+    assert client.get("/users/settings").json()["personality_id"] == 2
+
+    try:
+        response = client.post("/chat/", json={"content": "你好"})
+        assert response.status_code == 200
+        assert response.json()["message"]["personality_id"] == 2
+        system_prompts = [
+            call.kwargs["messages"][0]["content"]
+            for call in mock_openai_response.call_args_list
+        ]
+        assert any(ASSISTANT_MAP[2].SYSTEM_PROMPT in p for p in system_prompts)
+
+        assert (
+            client.post(
+                "/users/settings/personality", json={"personality_id": 99999}
+            ).status_code
+            == 404
+        )
+    finally:
+        user = db.query(User).filter(User.username == "testuser").first()
+        user.personality_id = None
+        db.commit()
+
+
+# 测试询问收支时模型调用本地报表工具回答，不做记账提取
+def test_chat_answers_report_question_with_tools(
+    client, db, mock_openai_response, no_chat_context
+):
+    from openai.openai_object import OpenAIObject
+
+    tool_call = {
+        "id": "call_1",
+        "type": "function",
+        "function": {"name": "get_summary", "arguments": '{"period": "this_month"}'},
+    }
+
+    def fake_create(*args, **kwargs):
+        if any(m["role"] == "tool" for m in kwargs["messages"]):
+            message = {"role": "assistant", "content": "这个月一共支出了0元。"}
+        else:
+            assert kwargs["tools"]
+            message = {"role": "assistant", "content": None, "tool_calls": [tool_call]}
+        return OpenAIObject.construct_from({"choices": [{"message": message}]})
+
+    mock_openai_response.side_effect = fake_create
+
+    response = client.post("/chat/", json={"content": "这个月给女朋友花了多少？"})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["message"]["content"] == "这个月一共支出了0元。"
+    assert data["needs_confirmation"] is False
+    assert data["draft_ids"] == []
+    assert mock_openai_response.call_count == 2
+    tool_message = next(
+        m
+        for m in mock_openai_response.call_args.kwargs["messages"]
+        if m["role"] == "tool"
+    )
+    summary = json.loads(tool_message["content"])
+    assert set(summary) >= {"start", "end", "income", "expense", "balance"}
+
+    mock_openai_response.reset_mock()
+    response = client.post("/chat/stream", json={"content": "这个月给女朋友花了多少？"})
+    events = _parse_sse(response.text)
+    assert [name for name, _ in events] == ["token", "extraction", "done"]
+    assert events[0][1]["content"] == "这个月一共支出了0元。"
+    assert events[1][1]["extracted_info"] is None
+
+
+# 测试本地能解析的账单查询直接查库回答，不调用大模型
+def test_chat_answers_spending_query_locally(client, db, mock_openai_response):
+    response = client.post("/chat/", json={"content": "去年工资一共多少"})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["message"]["content"].startswith("去年")
+    assert data["needs_confirmation"] is False
+    assert mock_openai_response.call_count == 0
+
+    response = client.post("/chat/stream", json={"content": "去年工资一共多少"})
+    events = _parse_sse(response.text)
+    assert [name for name, _ in events] == ["token", "extraction", "done"]
+    assert events[0][1]["content"] == data["message"]["content"]
+    assert mock_openai_response.call_count == 0
+
+
+# 测试后台提取模式：回复立即返回，提取结果通过轮询和SSE获取
+def test_chat_background_extraction(client, db, mock_openai_response):
+    from app.services.background_extraction import background_extractor
+
+    with patch.object(background_extractor, "session_factory", TestingSessionLocal):
+        response = client.post(
+            "/chat/", json={"content": "午饭35", "background_extraction": True}
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["extraction_pending"] is True
+        assert data["extracted_info"] is None
+        assert data["draft_ids"] == []
+
+        message_id = data["message"]["id"]
+        job = background_extractor.get(data["message"]["user_id"], message_id)
+        job.future.result(timeout=5)
+
+    result = client.get(f"/chat/extractions/{message_id}").json()
+    assert result["status"] == "done"
+    assert result["extracted_info"]["amount"] == 35
+    assert len(result["draft_ids"]) == 1
+
+    events = _parse_sse(client.get(f"/chat/extractions/{message_id}/events").text)
+    assert events == [("extraction", result)]
+
+    # 任务从内存中清理后根据消息记录的状态和草稿返回结果
+    background_extractor.clear()
+    fallback = client.get(f"/chat/extractions/{message_id}").json()
+    assert fallback["status"] == "done"
+    assert fallback["draft_ids"] == result["draft_ids"]
+    assert fallback["extracted_info"]["amount"] == 35
+    assert client.get("/chat/extractions/999999").status_code == 404
+
+    # 没有提取到交易的任务在其他进程中同样返回done，而不是404
+    with patch.object(background_extractor, "session_factory", TestingSessionLocal):
+        response = client.post(
+            "/chat/", json={"content": "你好", "background_extraction": True}
+        )
+        empty_id = response.json()["message"]["id"]
+        background_extractor.get(
+            response.json()["message"]["user_id"], empty_id
+        ).future.result(timeout=5)
+    background_extractor.clear()
+    empty = client.get(f"/chat/extractions/{empty_id}").json()
+    assert empty["status"] == "done"
+    assert empty["extracted_info"] is None and empty["draft_ids"] == []
+
+    # 由其他进程执行、仍在进行的任务返回pending，进程退出后超时的任务返回failed
+    ai_message = db.get(ChatMessage, empty_id)
+    ai_message.extraction_status = "pending"
+    db.commit()
+    assert client.get(f"/chat/extractions/{empty_id}").json()["status"] == "pending"
+    events = _parse_sse(client.get(f"/chat/extractions/{empty_id}/events").text)
+    assert [name for name, _ in events] == ["error"]
+    ai_message.created_at = datetime(2000, 1, 1)
+    db.commit()
+    assert client.get(f"/chat/extractions/{empty_id}").json()["status"] == "failed"
+
+
+# 测试开启自动记账后高置信度的交易直接写入，并可以凭令牌撤销
+def test_chat_auto_commit_and_undo(client, db, mock_openai_response, no_chat_context):
+    response = client.put(
+        "/users/settings",
+        json={"auto_commit_transactions": True, "auto_commit_threshold": 0.8},
+    )
+    assert response.status_code == 200
+    settings = client.get("/users/settings").json()
+    assert settings["auto_commit_transactions"] is True
+    assert settings["auto_commit_threshold"] == 0.8
+    assert (
+        client.put("/users/settings", json={"auto_commit_threshold": 0.1}).status_code
+        == 422
+    )
+
+    # 大模型的提取结果，置信度达到阈值
+    mock_openai_response.return_value.choices[0].message.content = json.dumps(
+        {
+            "has_intent": True,
+            "type": "expense",
+            "amount": 128,
+            "date": datetime.now().strftime("%Y-%m-%d"),
+            "description": "火锅聚餐",
+            "category": "餐饮美食",
+            "confidence": 0.95,
+            "missing_fields": [],
+        },
+        ensure_ascii=False,
+    )
+    llm_only = patch("app.routers.chat.LOCAL_EXTRACT_THRESHOLD", 1.0)
+
+    try:
+        # 本地规则的提取结果只生成草稿，不自动记账
+        response = client.post("/chat/", json={"content": "午饭35"})
+        data = response.json()
+        assert data["extracted_info"]["source"] == "local"
+        assert data["needs_confirmation"] is True
+        assert data["auto_committed_transactions"] == []
+
+        user_id = data["message"]["user_id"]
+        classifier = get_user_classifier(user_id, db)
+        with llm_only:
+            response = client.post("/chat/", json={"content": "火锅聚餐128"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["needs_confirmation"] is False
+        assert data["extracted_info"] is None
+        assert data["draft_ids"] == []
+        assert len(data["auto_committed_transactions"]) == 1
+        committed = data["auto_committed_transactions"][0]
+        assert committed["amount"] == 128
+        assert data["undo_token"]
+        samples = classifier.sample_count
+
+        transaction = db.get(Transaction, committed["id"])
+        assert transaction.is_deleted is False
+
+        undo = client.post(
+            "/chat/undo-transaction", json={"undo_token": data["undo_token"]}
+        )
+        assert undo.status_code == 200
+        assert undo.json() == {"undone": 1}
+        db.refresh(transaction)
+        assert transaction.is_deleted is True
+        # 撤销的交易不再计入用户分类器
+        assert classifier.sample_count == samples - 1
+
+        # 重复撤销不会重复计数，伪造的令牌被拒绝
+        again = client.post(
+            "/chat/undo-transaction", json={"undo_token": data["undo_token"]}
+        )
+        assert again.json() == {"undone": 0}
+        assert (
+            client.post(
+                "/chat/undo-transaction", json={"undo_token": "invalid"}
+            ).status_code
+            == 400
+        )
+
+        # 撤销令牌不能当作登录令牌，即使存在名为"undo"的用户
+        db.add(User(username="undo", email="undo@example.com", hashed_password="x"))
+        db.commit()
+        for token in [
+            data["undo_token"],
+            jwt.encode(
+                {"sub": "testuser", "typ": "undo"}, SECRET_KEY, algorithm=ALGORITHM
+            ),
+        ]:
+            with pytest.raises(HTTPException) as excinfo:
+                get_current_user(db=db, token=token)
+            assert excinfo.value.status_code == 401
+
+        # 后台提取模式同样自动记账，撤销令牌随提取结果返回
+        from app.services.background_extraction import background_extractor
+
+        with llm_only, patch.object(
+            background_extractor, "session_factory", TestingSessionLocal
+        ):
+            response = client.post(
+                "/chat/",
+                json={"content": "火锅聚餐128", "background_extraction": True},
+            )
+            message_id = response.json()["message"]["id"]
+            job = background_extractor.get(
+                response.json()["message"]["user_id"], message_id
+            )
+            job.future.result(timeout=5)
+        result = client.get(f"/chat/extractions/{message_id}").json()
+        assert result["status"] == "done"
+        assert result["needs_confirmation"] is False
+        assert result["draft_ids"] == []
+        assert len(result["auto_committed_transactions"]) == 1
+        background_tx = db.get(
+            Transaction, result["auto_committed_transactions"][0]["id"]
+        )
+        assert background_tx.is_deleted is False
+        undo = client.post(
+            "/chat/undo-transaction", json={"undo_token": result["undo_token"]}
+        )
+        assert undo.json() == {"undone": 1}
+        db.refresh(background_tx)
+        assert background_tx.is_deleted is True
+
+        # 置信度达不到阈值时仍然生成草稿等待确认
+        client.put("/users/settings", json={"auto_commit_threshold": 1.0})
+        with llm_only:
+            response = client.post("/chat/", json={"content": "火锅聚餐128"})
+        data = response.json()
+        assert data["needs_confirmation"] is True
+        assert data["auto_committed_transactions"] == []
+        assert data["undo_token"] is None
+    finally:
+        user = db.query(User).filter(User.username == "testuser").first()
+        user.auto_commit_transactions = False
+        user.auto_commit_threshold = None
+        db.query(User).filter(User.username == "undo").delete()
+        db.commit()
@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.models.database import Base
+from app.models.models import ChatMessage, ChatMessageArchive, User
+from app.services.chat_archive import (
+    ChatArchiver,
+    decompress_messages,
+    find_archived_position,
+    load_archived_after,
+    load_archived_before,
+    run_archive_pass,
+)
+
+engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+NOW = datetime(2026, 10, 19)
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    user = User(username="archive_user", email="archive@example.com")
+    db.add(user)
+    db.commit()
+    # 5条超过保留期的消息和2条近期消息
+    for days_ago in (100, 90, 80, 70, 60, 2, 1):
+        db.add(
+            ChatMessage(
+                user_id=user.id,
+                content=f"{days_ago}天前的消息" * 20,
+                is_user=days_ago % 20 == 0,
+                created_at=NOW - timedelta(days=days_ago),
+            )
+        )
+    db.commit()
+    yield db
+    db.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+def _archive(**kwargs):
+    kwargs.setdefault("retention_days", 30)
+    kwargs.setdefault("batch_size", 2)
+    kwargs.setdefault("summaries", False)
+    return run_archive_pass(TestingSessionLocal, now=NOW, **kwargs)
+
+
+# 测试过期消息分批压缩归档，热表只保留近期消息
+def test_archive_pass_moves_old_messages(db):
+    assert _archive() == 5
+
+    assert db.query(ChatMessage).count() == 2
+    archives = db.query(ChatMessageArchive).order_by(ChatMessageArchive.id).all()
+    assert [archive.message_count for archive in archives] == [2, 2, 1]
+    assert len(archives[0].data) < sum(
+        len(m["content"].encode()) for m in decompress_messages(archives[0])
+    )
+    messages = decompress_messages(archives[0])
+    assert messages[0]["content"].startswith("100天前的消息")
+    assert messages[0]["is_user"] is True
+
+    # 再次运行没有需要归档的消息
+    assert _archive() == 0
+
+
+# 测试按位置从归档中向前、向后翻页
+def test_load_archived_pages(db):
+    _archive()
+    user_id = db.query(User).first().id
+
+    latest = load_archived_before(db, user_id, None, 3)
+    assert [m["content"][:5] for m in latest] == ["60天前的", "70天前的", "80天前的"]
+
+    position = find_archived_position(db, user_id, latest[1]["id"])
+    older = load_archived_before(db, user_id, position, 10)
+    assert [m["content"][:5] for m in older] == ["80天前的", "90天前的", "100天前"]
+    newer = load_archived_after(db, user_id, position, 10)
+    assert [m["content"][:5] for m in newer] == ["60天前的"]
+
+    assert load_archived_before(db, user_id, None, 2, offset=4)[0]["content"][:5] == (
+        "100天前"
+    )
+
+
+# 测试开启摘要时为每个归档包生成摘要
+def test_archive_with_summary(db, monkeypatch):
+    summarize = MagicMock(return_value="用户记了几笔餐饮支出")
+    monkeypatch.setattr("app.services.chat_archive._summarize_archive", summarize)
+
+    _archive(batch_size=10, summaries=True)
+
+    archive = db.query(ChatMessageArchive).one()
+    assert archive.summary == "用户记了几笔餐饮支出"
+    assert len(summarize.call_args[0][0]) == 5
+
+
+# 测试多个进程同时归档同一批消息时只写入一个归档包
+def test_concurrent_archive_pass_skips_archived_batch(db, monkeypatch):
+    def summarize(messages, user_id):
+        # 生成摘要期间另一个进程归档了同一批消息
+        assert _archive(batch_size=10) == 5
+        return "摘要"
+
+    monkeypatch.setattr("app.services.chat_archive._summarize_archive", summarize)
+
+    assert _archive(batch_size=10, summaries=True) == 0
+    archive = db.query(ChatMessageArchive).one()
+    assert archive.message_count == 5
+    assert archive.summary is None
+    assert db.query(ChatMessage).count() == 2
+
+
+# 测试归档线程单次运行的异常不会中断后续运行
+def test_archiver_run_once_handles_errors():
+    archiver = ChatArchiver(run=MagicMock(side_effect=[RuntimeError("boom"), 3]))
+    assert archiver.run_once() == 0
+    assert archiver.run_once() == 3
+    assert archiver.stats()["archived_total"] == 3
@@ -0,0 +1,94 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from unittest.mock import patch, MagicMock
+
+from app.models.database import Base
+from app.models.models import ChatMessage, ChatSummary, User
+from app.services.chat_context import build_context_messages, estimate_tokens
+from app.services.llm_usage import usage_tracker
+
+engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@pytest.fixture(autouse=True)
+def memory_only_usage():
+    # 用量只在内存中统计，不写入开发数据库
+    with patch.object(usage_tracker, "session_factory", None):
+        yield
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    user = User(username="context_user", email="context@example.com")
+    db.add(user)
+    db.commit()
+    yield db
+    db.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+def _add_turns(db, user_id, count):
+    for i in range(count):
+        db.add(ChatMessage(user_id=user_id, content=f"第{i}条消息", is_user=i % 2 == 0))
+    db.commit()
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("午饭三十五") > estimate_tokens("lunch")
+
+
+# 测试历史在预算内时原样带上，顺序为 人设 → 历史 → 当前消息
+def test_recent_turns_within_budget(db):
+    user = db.query(User).first()
+    _add_turns(db, user.id, 4)
+
+    with patch("openai.ChatCompletion.create") as mock_create:
+        messages = build_context_messages(db, user.id, "人设", "当前消息")
+
+    mock_create.assert_not_called()
+    assert messages[0] == {"role": "system", "content": "人设"}
+    assert [m["role"] for m in messages[1:-1]] == ["user", "assistant"] * 2
+    assert messages[1]["content"] == "第0条消息"
+    assert messages[-1] == {"role": "user", "content": "当前消息"}
+
+
+# 测试超出预算时旧消息折叠进摘要，且摘要增量刷新
+def test_old_turns_folded_into_summary(db):
+    user = db.query(User).first()
+    _add_turns(db, user.id, 10)
+
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message.content = "用户喜欢记录午饭"
+
+    with patch(
+        "openai.ChatCompletion.create", return_value=mock_response
+    ) as mock_create:
+        messages = build_context_messages(
+            db, user.id, "人设", "当前消息", token_budget=30
+        )
+        assert mock_create.call_count == 1
+
+        summary = db.query(ChatSummary).filter(ChatSummary.user_id == user.id).first()
+        assert summary.summary == "用户喜欢记录午饭"
+        assert messages[1]["content"].endswith("用户喜欢记录午饭")
+        history = [m["content"] for m in messages[2:-1]]
+        assert sum(estimate_tokens(text) for text in history) <= 15
+        # 摘要之后的历史紧接着摘要边界
+        folded_until = summary.last_message_id
+        assert history[0] == f"第{folded_until}条消息"
+
+        # 预算内的下一轮不刷新摘要，前缀保持不变
+        again = build_context_messages(db, user.id, "人设", "下一条", token_budget=30)
+        assert mock_create.call_count == 1
+        assert again[:-1] == messages[:-1]
@@ -0,0 +1,132 @@
+import json
+import socket
+import threading
+import time
+
+import openai
+import pytest
+import uvicorn
+from fastapi.testclient import TestClient
+
+from tests.fake_llm_server import FakeLLMConfig, LatencyDistribution, create_app
+
+
+def _client(**kwargs):
+    kwargs.setdefault("seed", 1)
+    return TestClient(create_app(FakeLLMConfig(**kwargs)))
+
+
+# 测试提取提示词返回本地规则解析出的提取JSON
+def test_extraction_response():
+    client = _client()
+    response = client.post(
+        "/v1/chat/completions",
+        json={
+            "model": "fake",
+            "messages": [
+                {"role": "system", "content": "你是一个专业的财务信息提取助手"},
+                {
+                    "role": "user",
+                    "content": '请返回JSON，包含"has_intent"等字段\n用户消息: "午饭 35元"',
+                },
+            ],
+        },
+    )
+    assert response.status_code == 200
+    body = response.json()
+    extracted = json.loads(body["choices"][0]["message"]["content"])
+    assert extracted["has_intent"] is True
+    assert extracted["amount"] == 35
+    assert body["usage"]["total_tokens"] > 0
+
+
+# 测试图片输入返回小票识别JSON
+def test_image_response():
+    client = _client()
+    response = client.post(
+        "/chat/completions",
+        json={
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": "请分析这张交易凭证"},
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": "data:image/jpeg;base64,AAAA"},
+                        },
+                    ],
+                }
+            ]
+        },
+    )
+    result = json.loads(response.json()["choices"][0]["message"]["content"])
+    assert result["type"] == "expense"
+    assert client.get("/stats").json()["images"] == 1
+
+
+# 测试按配置的错误率返回服务商错误
+def test_error_injection():
+    client = _client(error_rate=1.0, error_statuses={503: 1.0})
+    response = client.post(
+        "/v1/chat/completions", json={"messages": [{"role": "user", "content": "你好"}]}
+    )
+    assert response.status_code == 503
+    assert "error" in response.json()
+
+
+# 测试延迟分布配置
+def test_latency_distribution():
+    assert LatencyDistribution("fixed:200").sample() == pytest.approx(0.2)
+    uniform = LatencyDistribution("uniform:100,200")
+    assert all(0.1 <= uniform.sample() <= 0.2 for _ in range(20))
+    assert LatencyDistribution("lognormal:500,0.3").sample() > 0
+    with pytest.raises(ValueError):
+        LatencyDistribution("poisson:1")
+
+
+@pytest.fixture
+def fake_server():
+    """在后台线程中启动模拟服务，并把openai指向它"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(
+            create_app(FakeLLMConfig(seed=1)),
+            host="127.0.0.1",
+            port=port,
+            log_level="warning",
+        )
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    for _ in range(100):
+        if server.started:
+            break
+        time.sleep(0.05)
+
+    original = openai.api_base, openai.api_key
+    openai.api_base = f"http://127.0.0.1:{port}/v1"
+    openai.api_key = "sk-fake"
+    yield
+    openai.api_base, openai.api_key = original
+    server.should_exit = True
+    thread.join(timeout=5)
+
+
+# 测试openai客户端可以直接调用模拟服务，包括流式返回
+def test_openai_client_compatibility(fake_server):
+    response = openai.ChatCompletion.create(
+        model="fake", messages=[{"role": "user", "content": "你好"}]
+    )
+    reply = response.choices[0].message.content
+    assert reply
+
+    chunks = openai.ChatCompletion.create(
+        model="fake", messages=[{"role": "user", "content": "你好"}], stream=True
+    )
+    streamed = "".join(
+        chunk.choices[0].get("delta", {}).get("content", "") for chunk in chunks
+    )
+    assert streamed == reply
@@ -0,0 +1,68 @@
+import io
+import random
+
+from PIL import Image, ImageDraw
+
+from app.services.image_dedup import ImageDedupIndex, dhash, hamming_distance
+
+
+def _receipt(seed: int) -> Image.Image:
+    rng = random.Random(seed)
+    image = Image.new("RGB", (600, 900), "white")
+    draw = ImageDraw.Draw(image)
+    for row in range(16):
+        width = rng.randint(100, 500)
+        draw.rectangle((40, 40 + row * 50, 40 + width, 65 + row * 50), fill="black")
+    return image
+
+
+def _reencode(image: Image.Image, scale: float, quality: int) -> Image.Image:
+    resized = image.resize((int(image.width * scale), int(image.height * scale)))
+    buffer = io.BytesIO()
+    resized.save(buffer, format="JPEG", quality=quality)
+    return Image.open(io.BytesIO(buffer.getvalue()))
+
+
+# 测试同一张图片缩放、重新压缩后哈希几乎不变，不同图片差异很大
+def test_dhash_is_stable_across_reencoding():
+    original = _receipt(1)
+    base = dhash(original)
+
+    assert hamming_distance(base, dhash(_reencode(original, 0.5, 60))) <= 6
+    assert hamming_distance(base, dhash(_reencode(original, 1.3, 85))) <= 6
+    assert hamming_distance(base, dhash(_receipt(2))) > 30
+
+
+# 测试按阈值匹配相似图片并返回结果副本
+def test_index_lookup_threshold():
+    index = ImageDedupIndex(threshold=2)
+    index.add(1, 0b1111, {"amount": 10})
+
+    result, distance = index.lookup(1, 0b1101)
+    assert result == {"amount": 10} and distance == 1
+    result["amount"] = 99
+    assert index.lookup(1, 0b1111)[0] == {"amount": 10}
+
+    assert index.lookup(1, 0b0000) is None
+    # 不同用户之间互不共享
+    assert index.lookup(2, 0b1111) is None
+    assert index.stats()["hits"] == 2
+
+
+# 测试每个用户只保留最近的图片，过期结果不再返回
+def test_index_eviction_and_ttl():
+    index = ImageDedupIndex(threshold=0, per_user=2, max_users=2)
+    for image_hash in (1, 2, 3):
+        index.add(1, image_hash, {"hash": image_hash})
+    assert index.lookup(1, 1) is None
+    assert index.lookup(1, 3) is not None
+
+    index.add(2, 1, {})
+    index.add(3, 1, {})
+    assert index.stats()["users"] == 2
+    assert index.lookup(1, 3) is None
+
+    expired = ImageDedupIndex(threshold=0, ttl=-1)
+    expired.add(1, 5, {})
+    assert expired.lookup(1, 5) is None
+    assert expired.stats()["images"] == 0
@@ -0,0 +1,91 @@
+import asyncio
+import io
+import random
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+from starlette.datastructures import UploadFile
+
+from app.services.image_pipeline import (
+    ImageTooLargeError,
+    InvalidImageError,
+    prepare_image,
+    read_upload,
+)
+
+
+def _encode(image, format="JPEG", **kwargs):
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **kwargs)
+    return buffer.getvalue()
+
+
+def _noisy_photo(width, height):
+    # 随机噪点图接近真实照片的压缩难度
+    return Image.frombytes(
+        "RGB", (width, height), random.Random(0).randbytes(width * height * 3)
+    )
+
+
+# 测试大图按最长边缩小并重新编码
+def test_downscale_large_photo():
+    data = _encode(_noisy_photo(3000, 2250), quality=95)
+    prepared = prepare_image(data, max_edge=1600, quality=80)
+
+    assert max(prepared.width, prepared.height) == 1600
+    assert prepared.width / prepared.height == pytest.approx(4 / 3, rel=0.01)
+    assert len(prepared.data) < len(data)
+    assert prepared.mime_type == "image/jpeg"
+    assert Image.open(io.BytesIO(prepared.data)).format == "JPEG"
+
+
+# 测试按EXIF方向摆正
+def test_exif_orientation():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # 顺时针旋转90度拍摄
+    data = _encode(Image.new("RGB", (400, 200), "white"), exif=exif)
+
+    prepared = prepare_image(data, max_edge=1600)
+
+    assert (prepared.width, prepared.height) == (200, 400)
+
+
+# 测试足够小的正向JPEG直接使用原图
+def test_small_jpeg_passthrough():
+    data = _encode(Image.new("RGB", (300, 200), "white"))
+    assert prepare_image(data, max_edge=1600).data == data
+
+
+# 测试透明PNG转为白底JPEG
+def test_png_with_alpha():
+    data = _encode(Image.new("RGBA", (50, 50), (0, 0, 0, 0)), format="PNG")
+    prepared = prepare_image(data)
+
+    image = Image.open(io.BytesIO(prepared.data))
+    assert image.format == "JPEG"
+    assert image.getpixel((25, 25))[0] > 240
+    assert prepared.to_data_url().startswith("data:image/jpeg;base64,")
+
+
+# 测试无法解码和分辨率过大的图片
+def test_invalid_images():
+    with pytest.raises(InvalidImageError):
+        prepare_image(b"not an image")
+    data = _encode(Image.new("RGB", (1000, 1000)))
+    with pytest.raises(ImageTooLargeError):
+        prepare_image(data, max_pixels=500_000)
+    # 超过Pillow解压炸弹上限的图片在打开时就报错，同样按图片过大处理
+    with patch.object(Image, "MAX_IMAGE_PIXELS", 100_000):
+        with pytest.raises(ImageTooLargeError):
+            prepare_image(data, max_pixels=None)
+
+
+# 测试读取上传文件时超过大小上限立即停止
+def test_read_upload_limit():
+    upload = UploadFile(io.BytesIO(b"x" * 200_000), filename="big.jpg")
+    with pytest.raises(ImageTooLargeError):
+        asyncio.run(read_upload(upload, max_bytes=100_000))
+
+    upload = UploadFile(io.BytesIO(b"x" * 1000), filename="small.jpg")
+    assert len(asyncio.run(read_upload(upload, max_bytes=100_000))) == 1000
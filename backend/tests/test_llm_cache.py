@@ -0,0 +1,42 @@
+import time
+
+from app.services.llm_cache import TTLCache, make_cache_key, normalize_message
+
+
+# 测试消息规范化
+def test_normalize_message():
+    assert normalize_message("  早餐   8元。") == "早餐 8元"
+    assert normalize_message("ＡＢＣ　早餐８元!") == normalize_message("abc 早餐8元")
+
+
+# 测试缓存键包含日期
+def test_cache_key_depends_on_date():
+    key_today = make_cache_key("昨天午饭30", "2026-10-19")
+    assert key_today == make_cache_key("昨天午饭30 ", "2026-10-19")
+    assert key_today != make_cache_key("昨天午饭30", "2026-10-20")
+
+
+# 测试LRU淘汰和命中统计
+def test_lru_eviction_and_stats():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # b最久未使用，被淘汰
+
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["evictions"] == 1
+    assert stats["size"] == 2
+
+
+# 测试TTL过期
+def test_ttl_expiration():
+    cache = TTLCache(max_size=10, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
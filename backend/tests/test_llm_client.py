@@ -0,0 +1,281 @@
+import threading
+import time
+
+import openai
+import pytest
+
+from app.services.llm_client import LLMClient, LLMUnavailableError, extract_usage
+from app.services.llm_router import (
+    CircuitBreaker,
+    LLMEndpoint,
+    LLMRouter,
+    PERMIT_PROBE,
+    load_endpoints,
+)
+
+
+class FakeProvider:
+    """按预设脚本返回结果或抛出错误的假服务商"""
+
+    def __init__(self, script=None, delay=0.0):
+        self.script = list(script or [])
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, **kwargs):
+        with self._lock:
+            self.calls.append(kwargs)
+            step = self.script.pop(0) if self.script else "ok"
+        delay = step[1] if isinstance(step, tuple) else self.delay
+        if delay:
+            time.sleep(delay)
+        if isinstance(step, tuple):
+            step = step[0]
+        if isinstance(step, Exception):
+            raise step
+        return {"content": step}
+
+
+def _client(provider, endpoints=None, **kwargs):
+    kwargs.setdefault("sleep", lambda seconds: None)
+    kwargs.setdefault("router", LLMRouter(endpoints or [LLMEndpoint("default", "m")]))
+    kwargs.setdefault("hedge_delay", 0)
+    return LLMClient(create_fn=provider, **kwargs)
+
+
+# 测试可重试错误会按退避策略重试
+def test_retry_then_success():
+    provider = FakeProvider(
+        [
+            openai.error.ServiceUnavailableError("down"),
+            openai.error.Timeout("slow"),
+            "ok",
+        ]
+    )
+    sleeps = []
+    client = _client(provider, max_retries=2, sleep=sleeps.append)
+
+    assert client.chat_completion("extraction") == {"content": "ok"}
+    assert len(provider.calls) == 3
+    assert len(sleeps) == 2
+    # 按操作类型设置了超时
+    assert provider.calls[0]["request_timeout"] == 15
+    stats = client.stats()["operations"]["extraction"]
+    assert stats["retries"] == 2
+    assert stats["timeouts"] == 1
+    assert stats["successes"] == 1
+
+
+# 测试请求参数错误不重试
+def test_non_retryable_error():
+    provider = FakeProvider([openai.error.InvalidRequestError("bad", "model")])
+    client = _client(provider)
+
+    with pytest.raises(openai.error.InvalidRequestError):
+        client.chat_completion("chat")
+    assert len(provider.calls) == 1
+
+
+# 测试连续失败后熔断，熔断期间快速失败，超时后探测恢复
+def test_circuit_breaker_opens_and_recovers():
+    now = [0.0]
+    breaker = CircuitBreaker(
+        failure_threshold=2, reset_timeout=10, clock=lambda: now[0]
+    )
+    provider = FakeProvider([openai.error.APIConnectionError("refused")] * 2)
+    client = _client(
+        provider, [LLMEndpoint("default", "m", breaker=breaker)], max_retries=0
+    )
+
+    for _ in range(2):
+        with pytest.raises(openai.error.APIConnectionError):
+            client.chat_completion("chat")
+    assert breaker.state == "open"
+
+    with pytest.raises(LLMUnavailableError):
+        client.chat_completion("chat")
+    assert len(provider.calls) == 2
+
+    now[0] = 11
+    assert client.chat_completion("chat") == {"content": "ok"}
+    assert breaker.state == "closed"
+
+
+# 测试半开状态的探测遇到不可重试的错误后，下一个请求仍然放行
+def test_half_open_probe_non_retryable_error():
+    now = [0.0]
+    breaker = CircuitBreaker(
+        failure_threshold=1, reset_timeout=10, clock=lambda: now[0]
+    )
+    provider = FakeProvider(
+        [
+            openai.error.APIConnectionError("refused"),
+            openai.error.InvalidRequestError("bad", "model"),
+        ]
+    )
+    client = _client(
+        provider, [LLMEndpoint("default", "m", breaker=breaker)], max_retries=0
+    )
+
+    with pytest.raises(openai.error.APIConnectionError):
+        client.chat_completion("chat")
+    assert breaker.state == "open"
+
+    now[0] = 11
+    with pytest.raises(openai.error.InvalidRequestError):
+        client.chat_completion("chat")
+    assert breaker.state == "half_open"
+
+    assert client.chat_completion("chat") == {"content": "ok"}
+    assert breaker.state == "closed"
+    assert len(provider.calls) == 3
+
+
+# 测试熔断前发出的普通请求在半开状态下结束时，不会释放其它请求占用的探测名额
+def test_normal_request_does_not_release_probe():
+    now = [0.0]
+    breaker = CircuitBreaker(
+        failure_threshold=1, reset_timeout=10, clock=lambda: now[0]
+    )
+    started = threading.Event()
+    finish = threading.Event()
+
+    def provider(**kwargs):
+        started.set()
+        finish.wait(5)
+        raise openai.error.InvalidRequestError("bad", "model")
+
+    client = _client(
+        provider, [LLMEndpoint("default", "m", breaker=breaker)], max_retries=0
+    )
+    errors = []
+
+    def slow_request():
+        try:
+            client.chat_completion("chat")
+        except Exception as e:
+            errors.append(e)
+
+    worker = threading.Thread(target=slow_request)
+    worker.start()
+    assert started.wait(5)
+
+    # 其它请求失败打开熔断器，超时后另一个请求占用探测名额
+    breaker.record_failure()
+    now[0] = 11
+    assert breaker.allow_request() == PERMIT_PROBE
+
+    finish.set()
+    worker.join(5)
+    assert isinstance(errors[0], openai.error.InvalidRequestError)
+    assert breaker.allow_request() is None
+
+    breaker.release_probe()
+    assert breaker.allow_request() == PERMIT_PROBE
+
+
+# 测试对冲请求在首个请求过慢时取先返回的结果
+def test_hedged_request():
+    provider = FakeProvider([("slow", 0.5), ("fast", 0.0)])
+    client = _client(provider, hedge_delay=0.05, hedge_operations=["extraction"])
+
+    started = time.monotonic()
+    assert client.chat_completion("extraction") == {"content": "fast"}
+    assert time.monotonic() - started < 0.4
+    stats = client.stats()["operations"]["extraction"]
+    assert stats["hedged"] == 1
+    assert stats["hedge_wins"] == 1
+
+
+# 测试端点出错时立即切换到下一个端点，不等待退避
+def test_failover_to_next_endpoint():
+    provider = FakeProvider([openai.error.APIConnectionError("refused"), "ok"])
+    sleeps = []
+    endpoints = [
+        LLMEndpoint("a", "model-a", api_base="http://a"),
+        LLMEndpoint("b", "model-b", api_base="http://b"),
+    ]
+    client = _client(provider, endpoints, sleep=sleeps.append)
+
+    assert client.chat_completion("chat") == {"content": "ok"}
+    assert [call["model"] for call in provider.calls] == ["model-a", "model-b"]
+    assert provider.calls[1]["api_base"] == "http://b"
+    assert sleeps == []
+    assert client.stats()["operations"]["chat"]["failovers"] == 1
+
+
+# 测试按操作档位选择模型
+def test_tier_selection():
+    provider = FakeProvider()
+    endpoints = [
+        LLMEndpoint("fast", "small", tiers=["fast"]),
+        LLMEndpoint("strong", "large", tiers=["strong"]),
+    ]
+    client = _client(provider, endpoints)
+
+    client.chat_completion("extraction")
+    client.chat_completion("analysis")
+    assert [call["model"] for call in provider.calls] == ["small", "large"]
+
+
+# 测试同档位内按p95延迟和错误率排序
+def test_latency_and_error_aware_ordering():
+    slow = LLMEndpoint("slow", "m1")
+    fast = LLMEndpoint("fast", "m2")
+    flaky = LLMEndpoint("flaky", "m3")
+    for _ in range(10):
+        slow.record(2.0, True)
+        fast.record(0.5, True)
+        flaky.record(0.3, True)
+    for _ in range(5):
+        flaky.record(0.3, False)
+    router = LLMRouter([slow, fast, flaky])
+
+    assert [e.name for e in router.candidates("chat")] == ["fast", "slow", "flaky"]
+
+
+# 测试从环境变量格式的JSON加载端点
+def test_load_endpoints(monkeypatch):
+    monkeypatch.setenv("BACKUP_KEY", "sk-backup")
+    endpoints = load_endpoints(
+        '[{"name": "main", "model": "m1", "tiers": ["fast"]},'
+        ' {"name": "backup", "model": "m2", "api_base": "http://b", "api_key_env": "BACKUP_KEY"}]'
+    )
+    assert [e.name for e in endpoints] == ["main", "backup"]
+    assert endpoints[0].tiers == {"fast"}
+    assert endpoints[1].request_kwargs() == {
+        "model": "m2",
+        "api_base": "http://b",
+        "api_key": "sk-backup",
+    }
+    # 配置有误时回退到默认端点
+    assert load_endpoints("not json")[0].name == "default"
+
+
+# 测试记录每次调用的提示词和输出token数
+def test_usage_metrics():
+    response = {
+        "choices": [],
+        "usage": {
+            "prompt_tokens": 120,
+            "completion_tokens": 30,
+            "prompt_tokens_details": {"cached_tokens": 100},
+        },
+    }
+    client = _client(lambda **kwargs: response)
+
+    client.chat_completion(
+        "extraction", messages=[{"role": "user", "content": "早餐 8元"}]
+    )
+    client.chat_completion(
+        "extraction", messages=[{"role": "user", "content": "午饭 35"}]
+    )
+    stats = client.stats()["operations"]["extraction"]
+    assert stats["prompt_tokens"] == 240
+    assert stats["cached_tokens"] == 200
+    assert stats["avg_prompt_tokens"] == 120
+    assert stats["avg_completion_tokens"] == 30
+    assert stats["prompt_chars"] == 10
+    # 没有用量信息的响应（如流式响应）不计入
+    assert extract_usage({"choices": []}) is None
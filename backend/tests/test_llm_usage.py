@@ -0,0 +1,123 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.models.database import Base
+from app.models.models import LLMUsage, LLMUsageDaily, User
+from app.services.llm_usage import QuotaExceededError, TokenBucket, UsageTracker
+
+engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    db.add(User(username="usage_user", email="usage@example.com"))
+    db.commit()
+    yield db
+    db.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+# 测试令牌桶的消耗、恢复和等待时间
+def test_token_bucket():
+    now = [0.0]
+    bucket = TokenBucket(capacity=2, rate=0.5, clock=lambda: now[0])
+
+    assert bucket.consume()[0]
+    assert bucket.consume()[0]
+    allowed, wait = bucket.consume()
+    assert not allowed
+    assert wait == pytest.approx(2.0)
+
+    now[0] = 2.0
+    assert bucket.consume()[0]
+
+
+# 测试限流时给出重试等待时间
+def test_rate_limit():
+    now = [0.0]
+    tracker = UsageTracker(
+        burst=1, rate=0.25, daily_quota=0, session_factory=None, clock=lambda: now[0]
+    )
+    tracker.check(1)
+    with pytest.raises(QuotaExceededError) as excinfo:
+        tracker.check(1)
+    assert excinfo.value.retry_after == 4
+    # 其他用户不受影响
+    tracker.check(2)
+
+
+# 测试令牌桶数量有上限，恢复满的桶在新用户加入时淘汰
+def test_bucket_eviction():
+    now = [0.0]
+    tracker = UsageTracker(
+        burst=2,
+        rate=1,
+        daily_quota=0,
+        max_users=3,
+        session_factory=None,
+        clock=lambda: now[0],
+    )
+    for user_id in (1, 2, 3):
+        tracker.check(user_id)
+    tracker.check(1)
+    # 超过上限时淘汰最久未使用的用户2
+    tracker.check(4)
+    assert list(tracker._buckets) == [3, 1, 4]
+
+    # 令牌恢复满的桶全部淘汰，限流状态不受影响
+    now[0] = 10.0
+    tracker.check(5)
+    assert list(tracker._buckets) == [5]
+    assert tracker.stats()["tracked_users"] == 1
+
+    # 未恢复满的桶保留，仍然限流
+    tracker.check(5)
+    with pytest.raises(QuotaExceededError):
+        tracker.check(5)
+    tracker.check(6)
+    with pytest.raises(QuotaExceededError):
+        tracker.check(5)
+
+
+# 测试当天配额用完后拒绝，到第二天重置
+def test_daily_quota():
+    day = [datetime(2025, 5, 20, 23, 0, 0)]
+    tracker = UsageTracker(
+        burst=100, rate=1, daily_quota=1000, session_factory=None, now=lambda: day[0]
+    )
+    tracker.record(1, "chat", "m", 800, 200, 1.0)
+    with pytest.raises(QuotaExceededError) as excinfo:
+        tracker.check(1)
+    assert excinfo.value.retry_after == 3600
+
+    day[0] = datetime(2025, 5, 21, 8, 0, 0)
+    tracker.check(1)
+
+
+# 测试用量批量写入明细表和按天汇总表，重启后从汇总表恢复当天用量
+def test_flush_and_rollup(db):
+    user = db.query(User).first()
+    tracker = UsageTracker(flush_interval=0, session_factory=TestingSessionLocal)
+    tracker.record(user.id, "chat", "m", 100, 20, 0.8)
+    tracker.record(user.id, "extraction", "m", 300, 40, 0.4)
+    tracker.record(user.id, "chat", "m", 0, 0, 2.0, success=False)
+
+    assert db.query(LLMUsage).count() == 3
+    daily = db.query(LLMUsageDaily).filter(LLMUsageDaily.user_id == user.id).one()
+    assert daily.requests == 2
+    assert daily.prompt_tokens == 400
+    assert daily.completion_tokens == 60
+
+    restarted = UsageTracker(session_factory=TestingSessionLocal)
+    assert restarted.daily_tokens(user.id) == 460
@@ -0,0 +1,139 @@
+from datetime import date
+
+import pytest
+
+from app.services.local_extractor import (
+    chinese_to_number,
+    extract_locally,
+    extract_locally_batch,
+)
+
+# 2026-10-19 是周一
+TODAY = date(2026, 10, 19)
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("二十", 20),
+        ("十五", 15),
+        ("一百零五", 105),
+        ("两万", 20000),
+        ("三点五", 3.5),
+        ("一千二百三十四", 1234),
+        # 口语中单位后的数字表示下一位
+        ("一百五", 150),
+        ("两千五", 2500),
+        ("一万五", 15000),
+        ("一万二千五", 12500),
+        ("三千零五", 3005),
+    ],
+)
+def test_chinese_to_number(text, expected):
+    assert chinese_to_number(text) == expected
+
+
+# 测试常见简短记账消息
+@pytest.mark.parametrize(
+    "message,amount,category,expected_date",
+    [
+        ("午饭35", 35, "餐饮美食", "2026-10-19"),
+        ("打车 二十块", 20, "交通出行", "2026-10-19"),
+        ("五十块五 奶茶", 50.5, "餐饮美食", "2026-10-19"),
+        ("昨天晚饭花了120元", 120, "餐饮美食", "2026-10-18"),
+        ("上周五 买衣服 1.5k", 1500, "服饰美容", "2026-10-16"),
+        ("3块5毛 买水", 3.5, "餐饮美食", "2026-10-19"),
+        ("10月1号 电影票 80", 80, "文教娱乐", "2026-10-01"),
+        ("午饭一百五", 150, "餐饮美食", "2026-10-19"),
+    ],
+)
+def test_extract_expense(message, amount, category, expected_date):
+    result = extract_locally(message, TODAY)
+    assert result is not None
+    assert result["type"] == "expense"
+    assert result["amount"] == amount
+    assert result["category"] == category
+    assert result["date"] == expected_date
+    assert result["confidence"] >= 0.85
+    assert result["missing_fields"] == []
+
+
+# 测试收入识别
+def test_extract_income():
+    result = extract_locally("发工资 2w", TODAY)
+    assert result["type"] == "income"
+    assert result["amount"] == 20000
+    assert result["category"] == "工资薪酬"
+
+    # 收房租不应被识别为房租支出
+    result = extract_locally("收房租3500", TODAY)
+    assert result["type"] == "income"
+    assert result["category"] == "租金收入"
+
+
+# 测试时间解析
+def test_extract_time():
+    result = extract_locally("今天下午3点打车25", TODAY)
+    assert result["amount"] == 25
+    assert result["time"] == "15:00"
+
+    result = extract_locally("早上8:30 地铁4元", TODAY)
+    assert result["amount"] == 4
+    assert result["time"] == "08:30"
+
+
+# 测试"X点Y"后面跟货币单位或没有时段词时按小数金额处理，不当作时间
+@pytest.mark.parametrize(
+    "message,amount",
+    [("奶茶三点五元", 3.5), ("停车费两点五块", 2.5), ("奶茶3点5元", 3.5)],
+)
+def test_extract_decimal_point_amount(message, amount):
+    result = extract_locally(message, TODAY)
+    assert result["amount"] == amount
+    assert "time" not in result
+
+
+def test_decimal_point_without_period_is_not_time():
+    # 没有单位时无法确定金额，交给大模型
+    assert extract_locally("奶茶三点五", TODAY) is None
+    assert extract_locally("晚上八点半 奶茶15", TODAY)["time"] == "20:30"
+
+
+# 测试不应在本地高置信度提取的消息
+def test_extract_low_confidence_or_none():
+    # 提问交给大模型
+    assert extract_locally("午饭多少钱？", TODAY) is None
+    # 数量不是金额
+    assert extract_locally("我有35个苹果", TODAY) is None
+    # 没有金额
+    assert extract_locally("你好", TODAY) is None
+    # 缺少描述和分类
+    assert extract_locally("35", TODAY)["confidence"] < 0.85
+
+
+# 测试千分位金额和口语化的中文金额
+@pytest.mark.parametrize(
+    "message,amount",
+    [
+        ("1,000元 房租", 1000),
+        ("房租1,500", 1500),
+        ("房租两千五", 2500),
+        ("工资一万五", 15000),
+        ("买衣服1,299.5元", 1299.5),
+    ],
+)
+def test_extract_grouped_and_colloquial_amounts(message, amount):
+    assert extract_locally(message, TODAY)["amount"] == amount
+
+
+# 测试一条消息中的多笔记账，未写日期的段沿用前面的日期
+def test_extract_batch():
+    results = extract_locally_batch("昨天午饭30，打车20，买水3块", TODAY)
+    assert [r["amount"] for r in results] == [30, 20, 3]
+    assert [r["category"] for r in results] == ["餐饮美食", "交通出行", "餐饮美食"]
+    assert {r["date"] for r in results} == {"2026-10-18"}
+
+    # 只有一笔、有一段无法提取或千分位逗号时不按多笔处理
+    assert extract_locally_batch("午饭30", TODAY) is None
+    assert extract_locally_batch("今天好累，午饭30", TODAY) is None
+    assert extract_locally_batch("买衣服1,299元", TODAY) is None
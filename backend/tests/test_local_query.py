@@ -0,0 +1,159 @@
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.models.database import Base
+from app.models.models import Transaction, TransactionType, User
+from app.services.local_query import answer_locally, parse_spending_query
+
+engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# 2026-10-19 是周一
+TODAY = date(2026, 10, 19)
+
+
+@pytest.mark.parametrize(
+    "text,start,end,kind,category,aggregate",
+    [
+        (
+            "上个月交通花了多少",
+            date(2026, 9, 1),
+            date(2026, 9, 30),
+            "expense",
+            "交通出行",
+            "total",
+        ),
+        ("今年最大一笔支出", date(2026, 1, 1), TODAY, "expense", None, "max"),
+        ("这个月一共花了多少？", date(2026, 10, 1), TODAY, "expense", None, "total"),
+        (
+            "3月份哪类支出最多",
+            date(2026, 3, 1),
+            date(2026, 3, 31),
+            "expense",
+            None,
+            "top_category",
+        ),
+        (
+            "昨天花了多少钱",
+            date(2026, 10, 18),
+            date(2026, 10, 18),
+            "expense",
+            None,
+            "total",
+        ),
+        (
+            "最近7天打车一共几笔",
+            date(2026, 10, 13),
+            TODAY,
+            "expense",
+            "交通出行",
+            "count",
+        ),
+        (
+            "上周收入多少",
+            date(2026, 10, 12),
+            date(2026, 10, 18),
+            "income",
+            None,
+            "total",
+        ),
+        (
+            "去年工资一共多少",
+            date(2025, 1, 1),
+            date(2025, 12, 31),
+            "income",
+            "工资薪酬",
+            "total",
+        ),
+        ("这个月结余多少", date(2026, 10, 1), TODAY, "expense", None, "balance"),
+        (
+            "11月花了多少",
+            date(2025, 11, 1),
+            date(2025, 11, 30),
+            "expense",
+            None,
+            "total",
+        ),
+    ],
+)
+def test_parse_spending_query(text, start, end, kind, category, aggregate):
+    query = parse_spending_query(text, TODAY)
+    assert query is not None
+    assert (query["start_date"], query["end_date"]) == (start, end)
+    assert query["type"] == kind
+    assert query["category"] == category
+    assert query["aggregate"] == aggregate
+
+
+# 测试无法完整解析、带金额或不是提问的消息交给大模型
+@pytest.mark.parametrize(
+    "text",
+    [
+        "给女朋友花了多少",
+        "午饭35，这个月一共花了多少",
+        "这个月餐饮占比是多少",
+        "这个月平均每天花多少",
+        "今天心情不错",
+        "午饭35",
+    ],
+)
+def test_parse_spending_query_rejects(text):
+    assert parse_spending_query(text, TODAY) is None
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    user = User(username="query_user", email="query@example.com")
+    db.add(user)
+    db.commit()
+    for day, category, description, amount, kind in [
+        (datetime(2026, 9, 3), "交通出行", "打车", 23.5, TransactionType.EXPENSE),
+        (datetime(2026, 9, 8), "交通出行", "地铁", 4, TransactionType.EXPENSE),
+        (datetime(2026, 9, 9), "餐饮美食", "聚餐", 300, TransactionType.EXPENSE),
+        (datetime(2026, 9, 10), "工资薪酬", "工资", 8000, TransactionType.INCOME),
+    ]:
+        db.add(
+            Transaction(
+                user_id=user.id,
+                amount=amount,
+                type=kind,
+                category=category,
+                description=description,
+                transaction_date=day,
+            )
+        )
+    db.commit()
+    yield db
+    db.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+# 测试直接对交易表聚合生成回答
+def test_answer_locally(db):
+    user_id = db.query(User).first().id
+
+    answer = answer_locally("上个月交通花了多少", db, user_id, TODAY)
+    assert "交通出行支出共 27.50 元，2 笔" in answer
+    assert "2026-09-01至2026-09-30" in answer
+
+    assert "聚餐" in answer_locally("上个月最大一笔支出", db, user_id, TODAY)
+    assert "餐饮美食" in answer_locally("上个月哪类花得最多", db, user_id, TODAY)
+    assert "结余 7672.50 元" in answer_locally("上个月结余多少", db, user_id, TODAY)
+    assert "共有 3 笔支出，合计 327.50 元" in answer_locally(
+        "上个月几笔支出", db, user_id, TODAY
+    )
+    assert "最大的一笔交通出行支出是 2026-09-03 的「打车」" in answer_locally(
+        "上个月交通最大一笔", db, user_id, TODAY
+    )
+    assert "没有" in answer_locally("这个月花了多少", db, user_id, TODAY)
+    assert answer_locally("给女朋友花了多少", db, user_id, TODAY) is None
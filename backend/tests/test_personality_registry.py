@@ -0,0 +1,100 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.models.database import Base
+from app.models.models import AIPersonality
+from app.prompts.assistant import ASSISTANT_MAP
+from app.services.personality_registry import PersonalityRegistry
+
+engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    db.add_all(
+        [
+            AIPersonality(id=1, name="锐记", system_prompt="提示词1", is_default=False),
+            AIPersonality(id=2, name="小暖", system_prompt="提示词2", is_default=True),
+        ]
+    )
+    db.commit()
+    yield db
+    db.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+# 测试从数据库加载助手，展示字段沿用预设助手的元数据，快照不可修改
+def test_load_from_database(db):
+    registry = PersonalityRegistry(session_factory=TestingSessionLocal)
+
+    prompt, metadata = registry.get(1)
+    assert prompt == "提示词1"
+    assert metadata["name"] == "锐记"
+    assert metadata["avatar"] == ASSISTANT_MAP[1].METADATA["avatar"]
+    with pytest.raises(TypeError):
+        metadata["name"] = "x"
+
+    # 不存在的ID使用默认助手
+    assert registry.resolve_id(99) == 2
+    assert registry.resolve_id(None) == 2
+    assert registry.get(99)[0] == "提示词2"
+    assert [p["id"] for p in registry.metadata_list()] == [1, 2]
+    assert registry.reloads == 1
+
+
+# 测试到达检查间隔后发现助手表变化时重新加载，ETag随之改变
+def test_hot_reload(db):
+    clock = FakeClock()
+    registry = PersonalityRegistry(
+        session_factory=TestingSessionLocal, reload_interval=30, clock=clock
+    )
+    etag = registry.snapshot().etag
+
+    db.add(AIPersonality(id=3, name="新助手", system_prompt="提示词3"))
+    db.commit()
+    clock.now = 10
+    assert not registry.exists(3)
+
+    clock.now = 40
+    assert registry.exists(3)
+    assert registry.snapshot().etag != etag
+    assert registry.reloads == 2
+
+    # 没有变化时只检查不重新加载
+    clock.now = 80
+    registry.snapshot()
+    assert registry.reloads == 2
+
+    row = db.query(AIPersonality).get(3)
+    row.system_prompt = "新提示词"
+    db.commit()
+    registry.invalidate()
+    assert registry.get(3)[0] == "新提示词"
+
+
+# 测试助手表为空或不可用时使用预设助手
+def test_fallback_to_presets():
+    registry = PersonalityRegistry(session_factory=TestingSessionLocal)
+    # 表不存在，查询失败
+    assert registry.get(1)[0] == ASSISTANT_MAP[1].SYSTEM_PROMPT
+
+    preset = PersonalityRegistry(session_factory=None)
+    assert len(preset.metadata_list()) == len(ASSISTANT_MAP)
+    assert preset.snapshot().etag == registry.snapshot().etag
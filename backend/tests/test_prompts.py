@@ -0,0 +1,34 @@
+from app.prompts.analysis import ANALYSIS_SYSTEM_PROMPT, build_analysis_messages
+from app.prompts.extraction import EXTRACTION_SYSTEM_PROMPT, build_extraction_messages
+from app.prompts.image import IMAGE_SYSTEM_PROMPT, build_image_messages
+
+
+# 测试提取提示词的前缀不随日期和消息变化，变化部分都在最后
+def test_extraction_prompt_static_prefix():
+    first = build_extraction_messages("早餐 8元", "2025-01-01")
+    second = build_extraction_messages("打车 20", "2025-06-30")
+
+    assert first[0] == second[0]
+    assert first[0]["content"] == EXTRACTION_SYSTEM_PROMPT
+    assert "2025" not in EXTRACTION_SYSTEM_PROMPT
+    assert "餐饮美食" in EXTRACTION_SYSTEM_PROMPT
+    assert first[-1]["content"].endswith('用户消息: "早餐 8元"')
+    assert "2025-06-30" in second[-1]["content"]
+
+
+# 测试图片识别提示词把图片放在最后
+def test_image_prompt_static_prefix():
+    messages = build_image_messages("data:image/jpeg;base64,AAAA", "2025-01-01")
+
+    assert messages[0]["content"] == IMAGE_SYSTEM_PROMPT
+    assert messages[-1]["content"][-1]["image_url"]["url"].endswith("AAAA")
+
+
+# 测试分析提示词的数据部分序列化结果稳定
+def test_analysis_prompt_deterministic():
+    first = build_analysis_messages({"b": 1, "a": "餐饮美食"})
+    second = build_analysis_messages({"a": "餐饮美食", "b": 1})
+
+    assert first == second
+    assert first[0]["content"] == ANALYSIS_SYSTEM_PROMPT
+    assert "餐饮美食" in first[-1]["content"]
@@ -0,0 +1,243 @@
+import json
+from datetime import date, datetime
+from types import SimpleNamespace
+
+import pytest
+from openai.openai_object import OpenAIObject
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.models.database import Base
+from app.models.models import Transaction, TransactionType, User
+from app.routers.reports import (
+    get_category_ranking,
+    get_summary,
+    get_transaction_ranking,
+)
+from app.services.report_queries import query_category_ranking
+from app.services.report_tools import (
+    answer_with_report_tools,
+    is_report_question,
+    resolve_period,
+    run_report_tool,
+)
+
+engine = create_engine(
+    "sqlite:///:memory:",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+TODAY = date(2026, 10, 19)
+
+
+def _response(message):
+    return OpenAIObject.construct_from({"choices": [{"message": message}]})
+
+
+def _tool_call(call_id, name, arguments):
+    return {
+        "id": call_id,
+        "type": "function",
+        "function": {"name": name, "arguments": json.dumps(arguments)},
+    }
+
+
+class FakeLLMClient:
+    """按顺序返回预设回复，并记录每次调用的参数"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def chat_completion(self, operation, user_id=None, **kwargs):
+        self.calls.append(dict(kwargs, messages=list(kwargs["messages"])))
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(bind=engine)
+    db = TestingSessionLocal()
+    user = User(username="report_user", email="report@example.com")
+    db.add(user)
+    db.commit()
+    for day, category, amount, kind in [
+        (3, "餐饮美食", 35, TransactionType.EXPENSE),
+        (5, "餐饮美食", 120, TransactionType.EXPENSE),
+        (8, "交通出行", 23.5, TransactionType.EXPENSE),
+        (10, "工资薪酬", 8000, TransactionType.INCOME),
+    ]:
+        db.add(
+            Transaction(
+                user_id=user.id,
+                amount=amount,
+                type=kind,
+                category=category,
+                description=f"{category}{amount}",
+                transaction_date=datetime(2026, 10, day),
+            )
+        )
+    # 上个月的交易不计入本月
+    db.add(
+        Transaction(
+            user_id=user.id,
+            amount=500,
+            type=TransactionType.EXPENSE,
+            category="餐饮美食",
+            description="聚餐",
+            transaction_date=datetime(2026, 9, 20),
+        )
+    )
+    db.commit()
+    yield db
+    db.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+# 测试识别账单查询，带金额的消息按记账处理
+def test_is_report_question():
+    assert is_report_question("这个月餐饮花了多少")
+    assert is_report_question("3月份哪类支出最多？")
+    assert is_report_question("上个月一共几笔")
+    assert not is_report_question("午饭35，这个月一共花了多少")
+    assert not is_report_question("今天心情不错")
+    # 中文数字金额同样按记账处理
+    assert not is_report_question("打车一共二十块")
+    assert not is_report_question("午饭总共花了三十五")
+    assert not is_report_question("记一笔 总共五十块 买菜")
+    assert is_report_question("最近7天一共花了多少")
+
+
+# 测试时间范围换算
+def test_resolve_period():
+    assert resolve_period("this_month", today=TODAY) == (date(2026, 10, 1), TODAY)
+    assert resolve_period("last_month", today=TODAY) == (
+        date(2026, 9, 1),
+        date(2026, 9, 30),
+    )
+    assert resolve_period("this_week", today=TODAY) == (TODAY, TODAY)
+    assert resolve_period(None, "2026-01-01", "2026-01-31", today=TODAY) == (
+        date(2026, 1, 1),
+        date(2026, 1, 31),
+    )
+    with pytest.raises(ValueError):
+        resolve_period(None, "2026-02-01", "2026-01-01", today=TODAY)
+
+
+# 测试工具复用报表查询并返回紧凑结果
+def test_run_report_tool(db):
+    user = db.query(User).first()
+
+    summary = json.loads(run_report_tool("get_summary", "{}", db, user, TODAY))
+    assert summary["expense"] == 178.5
+    assert summary["income"] == 8000
+    assert summary["expense_count"] == 3
+
+    totals = json.loads(
+        run_report_tool(
+            "get_category_totals", {"period": "this_month"}, db, user, TODAY
+        )
+    )
+    assert totals["categories"][0][:2] == ["餐饮美食", 155]
+
+    top = json.loads(
+        run_report_tool(
+            "get_top_transactions",
+            '{"period": "last_month", "category": "餐饮美食", "limit": 50}',
+            db,
+            user,
+            TODAY,
+        )
+    )
+    assert top["transactions"] == [["2026-09-20", "聚餐", "餐饮美食", 500]]
+
+
+# 测试报表接口与工具共用同一组查询
+def test_report_endpoints_use_shared_queries(db):
+    user = db.query(User).first()
+    start, end = date(2026, 10, 1), TODAY
+
+    summary = get_summary(
+        start_date=start, end_date=end, include_stats=True, db=db, current_user=user
+    )
+    assert summary.total_expense == 178.5
+    assert summary.balance == 8000 - 178.5
+    assert summary.transaction_stats["total_count"] == 4
+    assert summary.transaction_stats["avg_expense"] == pytest.approx(59.5)
+
+    ranking = get_category_ranking(
+        transaction_type=TransactionType.EXPENSE,
+        start_date=start,
+        end_date=end,
+        db=db,
+        current_user=user,
+    )
+    assert [item.dict() for item in ranking] == query_category_ranking(
+        db, user.id, TransactionType.EXPENSE, start, end
+    )
+    assert ranking[0].percentage == round(155 / 178.5 * 100, 2)
+
+    top = get_transaction_ranking(
+        transaction_type=TransactionType.EXPENSE,
+        start_date=start,
+        end_date=end,
+        limit=2,
+        category=None,
+        db=db,
+        current_user=user,
+    )
+    assert [tx.amount for tx in top] == [120, 35]
+
+    assert "error" in json.loads(run_report_tool("drop_tables", "{}", db, user))
+    assert "error" in json.loads(run_report_tool("get_summary", "{bad", db, user))
+
+
+# 测试工具调用循环：执行工具、交还结果、重复调用复用结果，最后返回模型回答
+def test_answer_with_report_tools(db):
+    user = db.query(User).first()
+    call = _tool_call("call_1", "get_category_totals", {"period": "this_month"})
+    client = FakeLLMClient(
+        [
+            _response({"role": "assistant", "content": None, "tool_calls": [call]}),
+            _response({"role": "assistant", "content": None, "tool_calls": [call]}),
+            _response({"role": "assistant", "content": "这个月餐饮花了155元。"}),
+        ]
+    )
+    released = []
+    messages = [{"role": "system", "content": "人设"}, {"role": "user", "content": "?"}]
+
+    answer = answer_with_report_tools(
+        client, messages, db, user, release=lambda: released.append(1)
+    )
+
+    assert answer == "这个月餐饮花了155元。"
+    assert len(client.calls) == 3
+    assert client.calls[0]["tools"]
+    final_messages = client.calls[2]["messages"]
+    tool_results = [m for m in final_messages if m["role"] == "tool"]
+    assert len(tool_results) == 2
+    assert tool_results[0]["content"] == tool_results[1]["content"]
+    assert "餐饮美食" in tool_results[0]["content"]
+    assert len(released) == 2
+    # 调用方的消息列表不被修改
+    assert len(messages) == 2
+
+
+# 测试轮数用完后不再提供工具；调用失败时返回None
+def test_answer_with_report_tools_limits(db):
+    user = SimpleNamespace(id=db.query(User).first().id)
+    call = _tool_call("call_1", "get_summary", {})
+    client = FakeLLMClient(
+        [
+            _response({"role": "assistant", "content": None, "tool_calls": [call]}),
+            _response({"role": "assistant", "content": "本月支出178.5元"}),
+        ]
+    )
+    answer = answer_with_report_tools(client, [], db, user, max_rounds=1)
+    assert answer == "本月支出178.5元"
+    assert "tools" not in client.calls[1]
+
+    assert answer_with_report_tools(FakeLLMClient([]), [], db, user) is None
@@ -0,0 +1,63 @@
+import json
+
+from app.services.stream_json import StreamingJSONParser, parse_json_object
+
+
+# 测试跳过代码块标记和前后说明文字，容忍尾随逗号
+def test_parse_json_object_tolerant():
+    raw = (
+        "好的，结果如下：\n```json\n"
+        '{"reply": "午饭35元{已入账}", "amount": 35, "tags": [1, 2,],}\n'
+        '```\n以上。{"amount": 99}'
+    )
+    assert parse_json_object(raw) == {
+        "reply": "午饭35元{已入账}",
+        "amount": 35,
+        "tags": [1, 2],
+    }
+    # 说明文字中的括号不是JSON对象时继续向后查找
+    assert parse_json_object('用{大括号}标出 {"a": 1}') == {"a": 1}
+    assert parse_json_object('{"a": 1') is None
+    assert parse_json_object("没有JSON") is None
+
+
+# 测试转义字符和\u转义
+def test_parse_json_object_escapes():
+    data = {"reply": '第一行\n"引号"\\反斜杠😀', "n": None, "ok": False}
+    assert parse_json_object(json.dumps(data)) == data
+    assert parse_json_object(json.dumps(data, ensure_ascii=False)) == data
+
+
+# 测试逐字喂入时字段完整后立即产出，回复文本逐段产出
+def test_streaming_events():
+    raw = json.dumps(
+        {
+            "reply": "记好啦",
+            "has_intent": True,
+            "amount": 35.5,
+            "transactions": [{"amount": 35.5}],
+        },
+        ensure_ascii=False,
+    )
+    parser = StreamingJSONParser(stream_fields=("reply",))
+    events = []
+    number_end = raw.index("35.5") + len("35.5")
+    for ch in raw[:number_end]:
+        events.extend(parser.feed(ch))
+    # 数字在遇到分隔符之前还不完整
+    assert parser.result == {"reply": "记好啦", "has_intent": True}
+    for ch in raw[number_end:]:
+        events.extend(parser.feed(ch))
+
+    deltas = [value for kind, _, value in events if kind == "delta"]
+    assert deltas == ["记", "好", "啦"]
+    fields = [(name, value) for kind, name, value in events if kind == "field"]
+    assert fields == [
+        ("reply", "记好啦"),
+        ("has_intent", True),
+        ("amount", 35.5),
+        ("transactions", [{"amount": 35.5}]),
+    ]
+    assert parser.done
+    # 对象闭合后的内容不再解析
+    assert parser.feed('\n```\n{"amount": 1}') == []
@@ -0,0 +1,65 @@
+from fastapi import FastAPI, File, UploadFile
+from fastapi.testclient import TestClient
+
+from app.services.upload_limit import UploadSizeLimitMiddleware
+
+LIMIT = 1024
+
+received = []
+
+app = FastAPI()
+app.add_middleware(UploadSizeLimitMiddleware, limits={"/upload": LIMIT})
+
+
+@app.post("/upload")
+async def upload(file: UploadFile = File(...)):
+    received.append(file.filename)
+    return {"size": len(await file.read())}
+
+
+@app.post("/other")
+async def other(file: UploadFile = File(...)):
+    return {"size": len(await file.read())}
+
+
+client = TestClient(app)
+
+
+# 测试Content-Length超过上限时不解析请求体，接口函数不会执行
+def test_rejects_declared_length():
+    received.clear()
+    response = client.post("/upload", files={"file": ("a.jpg", b"x" * 2048)})
+    assert response.status_code == 413
+    assert received == []
+
+    response = client.post("/upload", files={"file": ("a.jpg", b"x" * 100)})
+    assert response.status_code == 200
+    assert response.json() == {"size": 100}
+    # 未配置的路径不限制
+    response = client.post("/other", files={"file": ("a.jpg", b"x" * 2048)})
+    assert response.status_code == 200
+
+
+# 测试分块传输没有Content-Length时，读取超过上限后中止解析
+def test_rejects_streamed_body():
+    received.clear()
+    boundary = "limit-boundary"
+    head = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="a.jpg"\r\n'
+        "Content-Type: image/jpeg\r\n\r\n"
+    ).encode()
+
+    def chunks():
+        yield head
+        for _ in range(8):
+            yield b"x" * 512
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    response = client.post(
+        "/upload",
+        content=chunks(),
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+    )
+    assert response.status_code == 413
+    assert received == []